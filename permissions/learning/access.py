@@ -0,0 +1,204 @@
+"""
+Bitmask store of the object permissions.
+
+Guardian keeps one row per permission codename, group and object, so a
+Write group costs a ``change`` and a ``delete`` row on every object. The
+access tables of ``ObjectAccessBase`` keep one row per user or group and
+object instead, the permissions being the bits of its ``mask``: bit ``i``
+is the ``i``-th codename of ``get_codenames(model)``, the default
+permissions then the ``Meta.permissions`` of the model, which must only
+be appended to.
+
+The store is selected with ``OBJECT_PERMISSION_STORE = 'bitmask'``
+(default ``'guardian'``) for the models of ``ACCESS_MODELS``: the groups
+are then provisioned into it, and ``CachedPermissionBackend``, the admin
+permission checker and ``learning.permissions.get_objects_for_user``
+read from it. The ``convert_object_permissions`` command fills it from
+the guardian rows. The guardian rows saved or deleted afterwards, by
+``assign_perm``, ``remove_perm`` or the object permission pages of the
+admin, are mirrored into it by ``mirror_guardian_row``.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Exists, F, OuterRef, Q
+
+from .models import Bot, BotAccess, Company, CompanyAccess, User, UserAccess
+
+
+ACCESS_MODELS = {
+    Bot: BotAccess,
+    Company: CompanyAccess,
+    User: UserAccess,
+}
+
+
+def is_store_enabled():
+    return getattr(settings, 'OBJECT_PERMISSION_STORE', 'guardian') == 'bitmask'
+
+
+def is_enabled(model):
+    return is_store_enabled() and model in ACCESS_MODELS
+
+
+def get_codenames(model):
+    opts = model._meta
+    return [
+        *(f'{action}_{opts.model_name}' for action in opts.default_permissions),
+        *(codename for codename, _ in opts.permissions),
+    ]
+
+
+def get_bits(model, perms):
+    """
+    Mask of the permissions ``perms``, codenames with or without app label.
+    """
+    codenames = get_codenames(model)
+    mask = 0
+    for perm in perms:
+        mask |= 1 << codenames.index(perm.split('.', 1)[-1])
+    return mask
+
+
+def get_perms(model, mask):
+    return {
+        codename for bit, codename in enumerate(get_codenames(model))
+        if mask & (1 << bit)
+    }
+
+
+def get_rows(user, model):
+    """
+    The access rows of ``model`` held by ``user``, directly or through a group.
+    """
+    rows = ACCESS_MODELS[model].objects
+    return rows.filter(user=user), rows.filter(group__user=user)
+
+
+def get_masks(user, model, pks):
+    """
+    Mapping of the primary keys of ``pks`` to the mask ``user`` holds on
+    them, in one query.
+    """
+    user_rows, group_rows = get_rows(user, model)
+    masks = dict.fromkeys(pks, 0)
+    rows = user_rows.filter(content_object__in=pks).values_list('content_object', 'mask').union(
+        group_rows.filter(content_object__in=pks).values_list('content_object', 'mask'),
+        all=True)
+    for pk, mask in rows:
+        masks[pk] |= mask
+    return masks
+
+
+def get_filter(user, perm, model):
+    """
+    Condition on the ``model`` objects ``user`` holds the object
+    permission ``perm`` on.
+    """
+    bits = get_bits(model, [perm])
+    user_rows, group_rows = get_rows(user, model)
+    return (
+        Q(Exists(user_rows.filter(content_object=OuterRef('pk'), mask__hasbits=bits))) |
+        Q(Exists(group_rows.filter(content_object=OuterRef('pk'), mask__hasbits=bits)))
+    )
+
+
+def add_access(model, masks, batch_size=1000):
+    """
+    Insert the access rows of ``masks``, a mapping of (object pk, 'user'
+    or 'group', holder id) to mask. Existing rows are left untouched.
+    """
+    access_model = ACCESS_MODELS[model]
+    access_model.objects.bulk_create([
+        access_model(content_object_id=pk, mask=mask, **{f'{holder}_id': holder_id})
+        for (pk, holder, holder_id), mask in masks.items()
+    ], batch_size=batch_size, ignore_conflicts=True)
+
+
+def mirror_guardian_row(row, granted):
+    """
+    Set or clear in the access rows the permission of the guardian user or
+    group object permission ``row``, just saved or deleted. The access row
+    is deleted with its last permission.
+    """
+    model = ContentType.objects.get_for_id(row.permission.content_type_id).model_class()
+    if not is_enabled(model):
+        return
+    if hasattr(row, 'object_pk'):
+        pk = model._meta.pk.to_python(row.object_pk)
+    else:
+        pk = row.content_object_id
+    holder = 'user' if hasattr(row, 'user_id') else 'group'
+    holder_id = getattr(row, f'{holder}_id')
+    bits = get_bits(model, [row.permission.codename])
+
+    rows = ACCESS_MODELS[model].objects.filter(
+        content_object=pk, **{f'{holder}_id': holder_id})
+    if granted:
+        add_access(model, {(pk, holder, holder_id): 0})
+        rows.update(mask=F('mask').bitor(bits))
+    else:
+        rows.update(mask=F('mask') - F('mask').bitand(bits))
+        rows.filter(mask=0).delete()
+
+
+class ObjectPermissionBackend:
+    """
+    Object permissions of the bitmask store, the counterpart of guardian's
+    ObjectPermissionBackend. Wrapped by CachedPermissionBackend.
+    """
+
+    def authenticate(self, request, **credentials):
+        return None
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if obj is None or not user_obj.is_active or user_obj.is_anonymous:
+            return set()
+        model = type(obj)
+        if user_obj.is_superuser:
+            return set(get_codenames(model))
+        return get_perms(model, get_masks(user_obj, model, [obj.pk])[obj.pk])
+
+    def has_perm(self, user_obj, perm, obj=None):
+        return perm.split('.', 1)[-1] in self.get_all_permissions(user_obj, obj)
+
+
+class ObjectPermissionChecker:
+    """
+    Request-scoped checker of the bitmask store, with the interface of
+    guardian's ObjectPermissionChecker used by the admin. Objects of the
+    other models are checked by ``fallback``, a guardian checker.
+    """
+
+    def __init__(self, user, fallback):
+        self.user = user
+        self.fallback = fallback
+        self.masks = defaultdict(dict)
+
+    def prefetch_perms(self, objects):
+        by_model = defaultdict(list)
+        for obj in objects:
+            by_model[type(obj)].append(obj)
+        for model, objs in by_model.items():
+            if not is_enabled(model):
+                self.fallback.prefetch_perms(objs)
+                continue
+            pks = [obj.pk for obj in objs if obj.pk not in self.masks[model]]
+            if pks and self.user.is_active and not self.user.is_superuser:
+                self.masks[model].update(get_masks(self.user, model, pks))
+
+    def get_perms(self, obj):
+        model = type(obj)
+        if not is_enabled(model):
+            return self.fallback.get_perms(obj)
+        if not self.user.is_active:
+            return []
+        if self.user.is_superuser:
+            return get_codenames(model)
+        if obj.pk not in self.masks[model]:
+            self.prefetch_perms([obj])
+        return sorted(get_perms(model, self.masks[model][obj.pk]))
+
+    def has_perm(self, perm, obj):
+        return perm.split('.', 1)[-1] in self.get_perms(obj)
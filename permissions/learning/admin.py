@@ -1,36 +1,174 @@
+from collections import defaultdict
+
 from django.contrib import admin
 from django.contrib import messages
 from django.contrib.auth import get_user_model, get_permission_codename
-from django.contrib.auth.models import Group
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from django.core.exceptions import ValidationError
+from django.contrib.admin.utils import quote, unquote
+from django.contrib.admin.views.main import PAGE_VAR, SEARCH_VAR
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.http import JsonResponse
+from django.urls import path, reverse
+from django.utils.html import format_html
 from django.utils.translation import gettext, gettext_lazy as _
 
 from guardian.admin import GuardedModelAdmin, GuardedModelAdminMixin
-from guardian.shortcuts import get_objects_for_user
-
-from silk.profiling.profiler import silk_profile
 
 from treenode.admin import TreeNodeModelAdmin
 from treenode.forms import TreeNodeForm
 
-from .models import Bot, Company, NoCountPaginator
-from .forms import UserChangeForm, UserCreationForm
+from . import metrics
+from .models import Bot, Company, Job
+from .forms import PaginatedInlineFormSet, UserChangeForm, UserCreationForm
+from .jobs import enqueue, retry
+from .pagination import CURSOR_VAR, KeysetChangeList, KeysetPaginationMixin, KeysetPaginator
+from .permissions import get_objects_for_user, get_permission_checker
+from .policies import filter_queryset
+from .publishing import INLINE_LIMIT, PERMISSION, PublishCount, publish_permitted
+from .search import search_companies, search_users
+from .thumbnails import VARIANTS, get_logo_url
 # Better admin performance https://levelup.gitconnected.com/@angysmark
 
 
+class ObjectPermissionCheckerMixin:
+    """
+    Answer object permission checks from the request-scoped guardian
+    checker, prefetching the permissions of every object listed on the page
+    so a page costs a constant number of queries.
+    """
+
+    def has_object_permission(self, request, perm, obj):
+        if obj is None:
+            return request.user.has_perm(f'{self.opts.app_label}.{perm}')
+        return get_permission_checker(request).has_perm(perm, obj)
+
+    def prefetch_object_permissions(self, request, objs):
+        objs = list(objs)
+        if objs:
+            get_permission_checker(request).prefetch_perms(objs)
+
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        self.prefetch_object_permissions(request, changelist.result_list)
+        return changelist
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field=from_field)
+        if obj is not None:
+            self.prefetch_object_permissions(request, [obj])
+        return obj
+
+    def get_deleted_objects(self, objs, request):
+        self.prefetch_object_permissions(request, objs)
+        return super().get_deleted_objects(objs, request)
+
+
+class VisibilityPolicyMixin:
+    """
+    Answer the object view permission with the visibility rules of
+    learning.policies, the ones ``get_queryset`` lists the objects by, so
+    every listed object can be opened. Objects loaded by ``get_object``
+    went through ``get_queryset`` already and cost no query.
+    """
+
+    def get_queryset(self, request):
+        return filter_queryset(request.user, super().get_queryset(request))
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field=from_field)
+        if obj is not None:
+            self.get_visible_objects(request).add(obj.pk)
+        return obj
+
+    def get_visible_objects(self, request):
+        if not hasattr(request, '_visible_objects'):
+            request._visible_objects = defaultdict(set)
+        return request._visible_objects[self.model]
+
+    def is_visible(self, request, obj):
+        visible = self.get_visible_objects(request)
+        if obj.pk not in visible and filter_queryset(
+                request.user, self.model.objects.filter(pk=obj.pk)).exists():
+            visible.add(obj.pk)
+        return obj.pk in visible
+
+    def has_view_permission(self, request, obj=None):
+        if obj is None or self.is_visible(request, obj):
+            return super().has_view_permission(request, obj=obj)
+
+        return False
+
+
+def render_logo(bot, field='logo_thumbnail'):
+    """
+    The resized variant ``field`` of the logo, never the original upload.
+    """
+    url = get_logo_url(bot, field)
+    if not url:
+        return '-'
+    width, height = VARIANTS[field]
+    return format_html(
+        '<img src="{}" alt="" style="max-width: {}px; max-height: {}px">', url, width, height)
+
+
 # Better performance inline
 class BotsInline(admin.TabularInline):
+    """
+    The first page of the bots of a company, the template loads the next
+    pages and searches from ``CompanyAdmin.bots_view``.
+    """
     model = Bot
+    formset = PaginatedInlineFormSet
+    template = 'admin/learning/bots_inline.html'
+    per_page = 50
+    ordering = ('name',)
 
-    fields = ('name', 'logo', 'created_by')
-    readonly_fields = ('name', 'logo', 'created_by')
+    fields = ('name', 'logo_preview', 'created_by')
+    readonly_fields = ('name', 'logo_preview', 'created_by')
 
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('created_by')
 
-
-class UserAdmin(GuardedModelAdminMixin, BaseUserAdmin):
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.per_page = self.per_page
+        return formset
+
+    def logo_preview(self, bot):
+        return render_logo(bot)
+
+    logo_preview.short_description = _('logo')
+
+    def get_cell(self, bot, name):
+        if name == 'logo_preview':
+            return {'image': get_logo_url(bot)}
+        return str(getattr(bot, name) or '')
+
+    def get_page_data(self, request, company):
+        """
+        The page of the bots of ``company`` after the ``cursor`` parameter,
+        filtered on the ``q`` parameter.
+        """
+        queryset = self.get_queryset(request).filter(company=company)
+        term = request.GET.get(SEARCH_VAR, '').strip()
+        if term:
+            queryset = queryset.filter(name__icontains=term)
+        paginator = KeysetPaginator(
+            queryset, self.per_page, cursor=request.GET.get(CURSOR_VAR))
+        page = paginator.page(1)
+        return {
+            'results': [{
+                'str': str(bot),
+                'url': reverse('admin:learning_bot_change', args=[quote(bot.pk)]),
+                'cells': [self.get_cell(bot, name) for name in self.fields],
+            } for bot in page],
+            'next': page.next_cursor,
+        }
+
+
+class UserAdmin(
+        KeysetPaginationMixin, VisibilityPolicyMixin, ObjectPermissionCheckerMixin,
+        GuardedModelAdminMixin, BaseUserAdmin):
     # The forms to add and change user instances
     form = UserChangeForm
     add_form = UserCreationForm
@@ -65,11 +203,11 @@ class UserAdmin(GuardedModelAdminMixin, BaseUserAdmin):
 
     list_display = ('username', 'email', 'company', 'first_name', 'last_name', 'is_staff')
     list_filter = ('is_staff', 'is_superuser', 'is_active')
-    search_fields = ('username', 'first_name', 'last_name', 'email', 'company')
+    search_fields = ('username', 'first_name', 'last_name', 'email', 'company__name')
     ordering = ('username',)
     filter_horizontal = ('groups', 'user_permissions',)
-    paginator = NoCountPaginator
-    show_full_result_count = False
+    # Maximum queries per view, checked by learning.test_query_budgets
+    query_budgets = {'changelist': 9, 'change': 12, 'save_model': 32}
 
     def get_fieldsets(self, request, obj=None):
         if not obj:
@@ -88,64 +226,54 @@ class UserAdmin(GuardedModelAdminMixin, BaseUserAdmin):
                 self.professionalinfo_fieldsets
             )
 
-    def has_view_permission(self, request, obj=None):
-        if obj is None or request.user.has_perm('view_user', obj):
-            return super().has_view_permission(request, obj=obj)
-
-        return False
-
     def has_delete_permission(self, request, obj=None):
-        if request.user.has_perm('delete_user', obj):
+        if self.has_object_permission(request, 'delete_user', obj):
             return super().has_delete_permission(request, obj=obj)
 
         return False
 
     def has_change_permission(self, request, obj=None):
-        if obj is None or request.user.has_perm('change_user', obj):
+        if obj is None or self.has_object_permission(request, 'change_user', obj):
             return super().has_change_permission(request, obj=obj)
 
         return False
 
     def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        if not request.user.is_superuser:
-            company = request.user.company
-            if company.type == Company.Type.REGULAR_COMPANY:
-                qs = qs.filter(company=company)
-            if company.type == Company.Type.AGENCY:
-                companies = company.children
-                companies.append(company)
-                qs = qs.filter(company__in=companies)
-            return get_objects_for_user(
-                request.user, 'view_user', qs,
-                accept_global_perms=False)
-        return qs
+        # Prefetch rather than join the company, so the page query stays on
+        # the user table and can walk the username index up to the limit.
+        return super().get_queryset(request).prefetch_related('company')
+
+    def get_changelist_instance(self, request):
+        # The change list runs the count and page queries when it is built,
+        # get_queryset only returns them lazily
+        with metrics.tenant_scopes.time(scope='user_admin'):
+            return super().get_changelist_instance(request)
+
+    def get_search_results(self, request, queryset, search_term):
+        # Indexed search of learning.search instead of scanning search_fields
+        return search_users(queryset, search_term), False
 
     def save_model(self, request, user, form, change):
         super().save_model(request, user, form, change)
 
         if not (request.user.is_superuser or change):
             user.grant_permissions(request.user)
-            user.grant_company_permissions()
-
-        # Add company resources to the new user
-        with silk_profile(name='Get user by company'):
-            own_company_users = get_user_model().objects.filter(
-                company=user.company_id)
-
-            company_children = user.company.children
-            external_company_users = get_user_model().objects.filter(
-                company__in=company_children
-            )
-
-            users = own_company_users | external_company_users
-
-            # Profiles with Admin Permissions Template
-            if user.role == get_user_model().Role.ADMIN:
-                user.bulk_grant_permissions(
-                    'Admin Permissions Template',
-                    users
-                )
+            user.grant_own_company_permissions()
+
+        # Add company resources to the new user. Profiles with Admin
+        # Permissions Template get the users of their company tree in a
+        # background job, queued with the user and run once it commits,
+        # again when they become Admin or change company.
+        onboarding_fields = {'role', 'company'}
+        if user.role == get_user_model().Role.ADMIN and (
+                not change or onboarding_fields.intersection(form.changed_data)):
+            job = enqueue(
+                'learning.onboarding.admin_onboarding', {'user': user.pk}, unique=change)
+            self.message_user(
+                request,
+                _('Access to the company users is being granted in the background (job %(job)s).')
+                % {'job': job.pk},
+                messages.INFO)
 
         # # Profiles with Agent Permissions Template
         # users_agent_template = User.objects.filter(
@@ -170,93 +298,211 @@ class UserAdmin(GuardedModelAdminMixin, BaseUserAdmin):
         #     )
 
 
-class UserProfileAdmin(GuardedModelAdmin):
+class UserProfileAdmin(ObjectPermissionCheckerMixin, GuardedModelAdmin):
 
     def has_view_permission(self, request, obj=None):
-        if obj is None or request.user.has_perm('view_userprofile', obj):
+        if obj is None or self.has_object_permission(request, 'view_userprofile', obj):
             return super().has_view_permission(request, obj=obj)
 
         return False
 
     def has_delete_permission(self, request, obj=None):
-        if request.user.has_perm('delete_userprofile', obj):
+        if self.has_object_permission(request, 'delete_userprofile', obj):
             return super().has_delete_permission(request, obj=obj)
 
         return False
 
     def has_change_permission(self, request, obj=None):
-        if obj is None or request.user.has_perm('change_userprofile', obj):
+        if obj is None or self.has_object_permission(request, 'change_userprofile', obj):
             return super().has_change_permission(request, obj=obj)
 
         return False
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return get_objects_for_user(
-            request.user, 'view_userprofile', qs,
-            accept_global_perms=False)
+        return get_objects_for_user(request.user, 'view_userprofile', qs)
 
 
-class BotAdmin(GuardedModelAdmin):
-    list_display = ('name', 'company', 'created_by')
+class BotAdmin(KeysetPaginationMixin, VisibilityPolicyMixin, GuardedModelAdmin):
+    list_display = ('logo_preview', 'name', 'company', 'created_by', 'published_at')
+    list_display_links = ('name',)
+    list_select_related = ('company', 'created_by')
+    readonly_fields = ('logo_detail_preview',)
     actions = ['make_published']
-    paginator = NoCountPaginator
-    show_full_result_count = False
-
-    def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        if request.user.is_superuser:
-            return qs
-        return qs.filter(
-            company=request.user.company_id)
+    # Maximum queries per view, checked by learning.test_query_budgets
+    query_budgets = {'changelist': 6, 'change': 10}
 
     def make_published(self, request, queryset):
-        self.message_user(
-            request,
-            'Selected bots successfully published.',
-            messages.SUCCESS)
+        # One query tells which bots the user may publish, large
+        # selections of them are published in a job
+        permitted = request.user.get_object_permissions(PERMISSION, queryset.order_by('pk'))
+        pks = [pk for pk, granted in permitted.items() if granted]
+        if len(pks) > INLINE_LIMIT:
+            job = enqueue('learning.publishing.publish_bots_task', {
+                'user': request.user.pk, 'bots': [str(pk) for pk in pks]})
+            self.message_user(
+                request,
+                _('%(count)d bots are being published in the background (job %(job)s).')
+                % {'count': len(pks), 'job': job.pk},
+                messages.INFO)
+            result = PublishCount(0, len(permitted) - len(pks))
+        else:
+            result = publish_permitted(permitted)
+            self.message_user(
+                request,
+                _('%(count)d bots successfully published.') % {'count': result.published},
+                messages.SUCCESS)
+        if result.skipped:
+            self.message_user(
+                request,
+                _('%(count)d bots skipped, you may not publish them.') % {'count': result.skipped},
+                messages.WARNING)
+
+    def logo_preview(self, bot):
+        return render_logo(bot)
+
+    logo_preview.short_description = _('logo')
+
+    def logo_detail_preview(self, bot):
+        return render_logo(bot, 'logo_detail')
+
+    logo_detail_preview.short_description = _('logo preview')
 
     make_published.allowed_permissions = ('publish',)
     make_published.short_description = "Publish bot"
 
     def has_publish_permission(self, request):
-        """Does the user have the publish permission?"""
-        opts = self.opts
-        codename = get_permission_codename('publish', opts)
-        return request.user.has_perm('%s.%s' % (opts.app_label, codename))
+        """
+        Does the user have the publish permission, globally or on a bot?
+        Asked several times per page, the answer is kept on the request.
+        """
+        if not hasattr(request, '_can_publish_bots'):
+            opts = self.opts
+            codename = get_permission_codename('publish', opts)
+            perm = '%s.%s' % (opts.app_label, codename)
+            request._can_publish_bots = request.user.has_perm(perm) or get_objects_for_user(
+                request.user, perm, self.model.objects.all()).exists()
+        return request._can_publish_bots
+
+
+class CompanyChangeList(KeysetChangeList):
+    """
+    In the tree view, only the companies whose parent the user can not
+    see: the roots, and the companies below a hidden one.
+    """
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if not self.model_admin.is_tree_view(request):
+            return qs
+        if request.user.is_superuser:
+            return qs.filter(tn_parent__isnull=True)
+        return qs.exclude(tn_parent__in=self.root_queryset.values('pk'))
 
 
-class CompanyAdmin(GuardedModelAdmin, TreeNodeModelAdmin):
+class CompanyAdmin(
+        KeysetPaginationMixin, VisibilityPolicyMixin, ObjectPermissionCheckerMixin,
+        GuardedModelAdmin, TreeNodeModelAdmin):
     treenode_display_mode = TreeNodeModelAdmin.TREENODE_DISPLAY_MODE_ACCORDION
     # list_display = ('name', )
     form = TreeNodeForm
     inlines = (BotsInline,)
-    paginator = NoCountPaginator
-    show_full_result_count = False
+    search_fields = ('name',)
+    children_per_page = 100
+    # Maximum queries per view, checked by learning.test_query_budgets
+    query_budgets = {'changelist': 7, 'change': 12}
 
-    def has_view_permission(self, request, obj=None):
-        if obj is None or request.user.has_perm('view_company', obj):
-            return super().has_view_permission(request, obj=obj)
-
-        return False
+    class Media:
+        js = ('learning/company_tree.js',)
 
     def has_delete_permission(self, request, obj=None):
-        if request.user.has_perm('delete_company', obj):
+        if self.has_object_permission(request, 'delete_company', obj):
             return super().has_delete_permission(request, obj=obj)
 
         return False
 
     def has_change_permission(self, request, obj=None):
-        if obj is None or request.user.has_perm('change_company', obj):
+        if obj is None or self.has_object_permission(request, 'change_company', obj):
             return super().has_change_permission(request, obj=obj)
 
         return False
 
-    def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        return get_objects_for_user(
-            request.user, 'learning.view_company', qs,
-            accept_global_perms=False)
+    def get_search_results(self, request, queryset, search_term):
+        return search_companies(queryset, search_term), False
+
+    def get_changelist(self, request, **kwargs):
+        return CompanyChangeList
+
+    def is_tree_view(self, request):
+        """
+        The changelist shows the tree unless it is searched, filtered or
+        sorted. Paging through the roots keeps the tree.
+        """
+        return set(request.GET) <= {PAGE_VAR, CURSOR_VAR}
+
+    def _use_treenode_display_mode(self, request, obj):
+        return self.is_tree_view(request)
+
+    def _get_treenode_field_display_with_accordion(self, obj):
+        # Expanded by learning/company_tree.js from children_view
+        return self.get_node_display(obj, level=0)
+
+    def get_node_display(self, company, level):
+        return format_html(
+            '<span class="company-node" data-level="{}" data-children="{}" data-url="{}">{}</span>',
+            level,
+            company.tn_children_count,
+            reverse('admin:learning_company_children', args=[quote(company.pk)]),
+            company.get_display(indent=False))
+
+    def get_urls(self):
+        return [
+            path(
+                '<path:object_id>/bots/',
+                self.admin_site.admin_view(self.bots_view),
+                name='learning_company_bots'),
+            path(
+                '<path:object_id>/children/',
+                self.admin_site.admin_view(self.children_view),
+                name='learning_company_children'),
+            *super().get_urls(),
+        ]
+
+    def children_view(self, request, object_id):
+        """
+        A page of the children of the company the user can see, as JSON
+        for the changelist tree. ``children`` is the precomputed count of
+        all the children, so expanding a node may find none visible.
+        """
+        company = self.get_object(request, unquote(object_id))
+        if company is None or not self.has_view_or_change_permission(request, company):
+            raise PermissionDenied
+        queryset = self.get_queryset(request).filter(tn_parent=company).order_by('tn_order')
+        paginator = KeysetPaginator(
+            queryset, self.children_per_page, cursor=request.GET.get(CURSOR_VAR))
+        page = paginator.page(1)
+        return JsonResponse({
+            'results': [{
+                'pk': str(child.pk),
+                'str': child.get_display(indent=False),
+                'url': reverse('admin:learning_company_change', args=[quote(child.pk)]),
+                'children': child.tn_children_count,
+                'children_url': reverse('admin:learning_company_children', args=[quote(child.pk)]),
+            } for child in page],
+            'next': page.next_cursor,
+        })
+
+    def bots_view(self, request, object_id):
+        """
+        A page of the bots of the company as JSON, for BotsInline.
+        """
+        company = self.get_object(request, unquote(object_id))
+        if company is None or not self.has_view_or_change_permission(request, company):
+            raise PermissionDenied
+        for inline in self.get_inline_instances(request, company):
+            if isinstance(inline, BotsInline):
+                return JsonResponse(inline.get_page_data(request, company))
+        raise PermissionDenied
 
     def save_model(self, request, company, form, change):
         super().save_model(request, company, form, change)
@@ -265,8 +511,46 @@ class CompanyAdmin(GuardedModelAdmin, TreeNodeModelAdmin):
             company.grant_permissions(request.user)
 
 
+class JobAdmin(KeysetPaginationMixin, admin.ModelAdmin):
+    list_display = ('__str__', 'status', 'progress', 'skipped', 'attempts', 'updated_at')
+    list_filter = ('status', 'task')
+    readonly_fields = (
+        'task', 'payload', 'status', 'cursor', 'done', 'skipped', 'total', 'attempts',
+        'error', 'run_after', 'created_at', 'updated_at',
+    )
+    actions = ['retry_jobs']
+
+    def progress(self, job):
+        if job.total is None:
+            return job.done
+        return f'{job.done} / {job.total}'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def retry_jobs(self, request, queryset):
+        count = retry(queryset)
+        self.message_user(
+            request,
+            f'{count} failed jobs queued again.',
+            messages.SUCCESS)
+
+    retry_jobs.allowed_permissions = ('retry',)
+    retry_jobs.short_description = "Retry failed jobs"
+
+    def has_retry_permission(self, request):
+        """Does the user have the change permission, the jobs being read-only?"""
+        opts = self.opts
+        codename = get_permission_codename('change', opts)
+        return request.user.has_perm('%s.%s' % (opts.app_label, codename))
+
+
 # Now register the new UserAdmin...
 admin.site.register(get_user_model(), UserAdmin)
 # Register the rest of your models here
 admin.site.register(Bot, BotAdmin)
 admin.site.register(Company, CompanyAdmin)
+admin.site.register(Job, JobAdmin)
@@ -0,0 +1,208 @@
+"""
+Authentication backend caching the resolved permissions across requests.
+
+``CachedPermissionBackend`` answers the checks of Django's ModelBackend
+and guardian's ObjectPermissionBackend, or the bitmask store of
+``learning.access``, from the ``PERMISSION_CACHE`` cache. Entries are keyed by a per-user version and a global version; the
+signals in ``learning.signals`` replace a version whenever memberships,
+group permissions or object permission rows change, which orphans the
+entries of the previous version instead of deleting them one by one.
+"""
+import threading
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Permission
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db import transaction
+
+from guardian.backends import ObjectPermissionBackend
+from guardian.ctypes import get_content_type
+from guardian.exceptions import WrongAppError
+
+from . import access, metrics
+
+
+GLOBAL_VERSION_KEY = 'permissions:version'
+
+# Attributes the permission backends memoize on the user instance
+INSTANCE_CACHES = (
+    '_cached_permissions', '_perm_cache', '_user_perm_cache', '_group_perm_cache',
+)
+
+
+class CacheStats:
+    """
+    Hit and miss counters of the permission cache in this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        metrics.permission_cache.inc(result='hit' if hit else 'miss')
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def reset(self):
+        with self.lock:
+            self.hits = self.misses = 0
+
+
+stats = CacheStats()
+
+
+def get_cache():
+    return caches[getattr(settings, 'PERMISSION_CACHE', DEFAULT_CACHE_ALIAS)]
+
+
+def get_version_key(user_id):
+    return f'{GLOBAL_VERSION_KEY}:{user_id}'
+
+
+def new_version():
+    return uuid.uuid4().hex
+
+
+def get_version(user_id):
+    """
+    Return the cache key prefix of the current entries of ``user_id``.
+    A version evicted from the cache is replaced by a new one, so entries
+    stored under the old version can not be served again.
+    """
+    cache = get_cache()
+    keys = [GLOBAL_VERSION_KEY, get_version_key(user_id)]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, new_version(), None)
+            versions[key] = cache.get(key)
+    return f'permissions:{user_id}:{versions[keys[0]]}:{versions[keys[1]]}'
+
+
+def bump_versions(user_ids=None):
+    """
+    Orphan the cached permissions of ``user_ids``, or of every user when
+    None. The versions are replaced now and again when the transaction
+    commits, so a concurrent request can not keep what it read before.
+    """
+    def bump():
+        if user_ids is None:
+            get_cache().set(GLOBAL_VERSION_KEY, new_version(), None)
+        else:
+            get_cache().set_many(
+                {get_version_key(user_id): new_version() for user_id in user_ids},
+                None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def clear_instance_cache(user_obj):
+    """
+    Drop the permissions memoized on a loaded user instance.
+    """
+    for name in INSTANCE_CACHES:
+        user_obj.__dict__.pop(name, None)
+
+
+class CachedPermissionBackend(ModelBackend):
+    """
+    ModelBackend and guardian's ObjectPermissionBackend in one backend,
+    both served from the permission cache. Within a request the resolved
+    sets are also memoized on the user instance. Permissions loaded inside
+    a transaction are only memoized, the shared cache only holds
+    committed rows.
+    """
+    object_backend = ObjectPermissionBackend()
+    access_backend = access.ObjectPermissionBackend()
+
+    def get_user(self, user_id):
+        # The visibility rules of learning.policies read the company type
+        # of the request user
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.select_related('company').get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
+
+    def get_cached(self, user_obj, name, load):
+        memo = user_obj.__dict__.setdefault('_cached_permissions', {})
+        if name not in memo:
+            if 'version' not in memo:
+                memo['version'] = get_version(user_obj.pk)
+            cache = get_cache()
+            key = f"{memo['version']}:{name}"
+            value = cache.get(key)
+            stats.record(value is not None)
+            if value is None:
+                value = load()
+                # Rows read inside a transaction may still be rolled back
+                if not transaction.get_connection().in_atomic_block:
+                    cache.set(key, value)
+            memo[name] = value
+        return memo[name]
+
+    def load_global_permissions(self, user_obj):
+        permissions = {}
+        for from_name in ('user', 'group'):
+            if user_obj.is_superuser:
+                perms = Permission.objects.all()
+            else:
+                perms = getattr(self, f'_get_{from_name}_permissions')(user_obj)
+            perms = perms.values_list('content_type__app_label', 'codename').order_by()
+            permissions[from_name] = {f'{ct}.{name}' for ct, name in perms}
+        return permissions
+
+    def _get_permissions(self, user_obj, obj, from_name):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        permissions = self.get_cached(
+            user_obj, 'global', lambda: self.load_global_permissions(user_obj))
+        return permissions[from_name]
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if obj is None:
+            return super().get_all_permissions(user_obj)
+        if user_obj.is_anonymous:
+            return set()
+        ctype = get_content_type(obj)
+        if access.is_enabled(type(obj)):
+            store, backend = 'bitmask', self.access_backend
+        else:
+            store, backend = 'guardian', self.object_backend
+        return self.get_cached(
+            user_obj,
+            f'object:{store}:{ctype.pk}:{obj.pk}',
+            lambda: set(backend.get_all_permissions(user_obj, obj)))
+
+    def has_perm(self, user_obj, perm, obj=None):
+        if obj is None:
+            with metrics.permission_checks.time(scope='global'):
+                return super().has_perm(user_obj, perm)
+        if not user_obj.is_active:
+            return False
+
+        codename = perm
+        if '.' in perm:
+            app_label, codename = perm.split('.', 1)
+            if app_label != obj._meta.app_label and \
+                    app_label != get_content_type(obj).app_label:
+                raise WrongAppError(
+                    f"Passed perm has app label of '{app_label}' while given "
+                    f"obj has app label '{obj._meta.app_label}'")
+        with metrics.permission_checks.time(scope='object'):
+            return codename in self.get_all_permissions(user_obj, obj)
@@ -0,0 +1,6 @@
+"""
+Scale benchmarks of the permission model.
+
+``tenants`` builds synthetic multi-tenant data, ``scenarios`` times the
+hot paths against it. Run them with the ``run_benchmarks`` command.
+"""
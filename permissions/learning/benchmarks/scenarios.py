@@ -0,0 +1,138 @@
+"""
+Timed scenarios of the permission hot paths.
+
+Every scenario is run ``repeat`` times and reports the median, min and
+max latency and the number of queries of its last run. Scenarios that
+write run inside a transaction rolled back after each run, so they can
+be repeated on the same data.
+"""
+import statistics
+import time
+import uuid
+
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from ..jobs import run_job
+from ..models import Bot, Company, CompanyClosure, Job
+from ..permissions import get_objects_for_user
+
+
+class Rollback(Exception):
+    pass
+
+
+def measure(run, repeat, rollback=False):
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            if rollback:
+                try:
+                    with transaction.atomic():
+                        run()
+                        raise Rollback
+                except Rollback:
+                    pass
+            else:
+                run()
+            timings.append(time.perf_counter() - start)
+
+    return {
+        'queries': len(context),
+        'median_ms': round(statistics.median(timings) * 1000, 2),
+        'min_ms': round(min(timings) * 1000, 2),
+        'max_ms': round(max(timings) * 1000, 2),
+    }
+
+
+def get_model_admin(model):
+    return admin.site._registry[model]
+
+
+class MessageSink:
+    """
+    Message storage of the benchmark requests, the messages are dropped.
+    """
+
+    def add(self, level, message, extra_tags=''):
+        pass
+
+
+class Scenarios:
+    """
+    The hot paths as seen by ``viewer``, the Admin of the tenant ``root``.
+    """
+
+    def __init__(self, root, repeat=10):
+        User = get_user_model()
+        self.root = root
+        self.repeat = repeat
+        self.companies = CompanyClosure.objects.descendants(root)
+        self.viewer = User.objects.filter(
+            company=root, role=User.Role.ADMIN).order_by('pk').first()
+        self.leaf = Company.objects.filter(
+            pk__in=self.companies).order_by('-pk').first()
+        self.target = User.objects.filter(
+            company__in=self.companies).order_by('-pk').first()
+        self.request_factory = RequestFactory()
+
+    def get_request(self, method='get', data=None):
+        request = getattr(self.request_factory, method)('/', data or {})
+        # A fresh user per request, like the authentication middleware
+        request.user = get_user_model().objects.get(pk=self.viewer.pk)
+        request._dont_enforce_csrf_checks = True
+        return request
+
+    def new_user(self, role='ED'):
+        return get_user_model()(
+            username=f'bench-{uuid.uuid4().hex}', company=self.leaf, role=role)
+
+    def user_post_save(self):
+        self.new_user().save()
+
+    def save_model(self):
+        user = self.new_user(role=get_user_model().Role.ADMIN)
+        request = self.get_request('post')
+        request._messages = MessageSink()
+        get_model_admin(get_user_model()).save_model(request, user, None, False)
+
+    def admin_onboarding(self):
+        self.save_model()
+        run_job(Job.objects.latest('pk'))
+
+    def changelist(self, model):
+        def run():
+            response = get_model_admin(model).changelist_view(self.get_request())
+            response.render()
+        return run
+
+    def objects_for_user(self):
+        list(get_objects_for_user(
+            self.get_request().user,
+            'view_user',
+            get_user_model().objects.order_by('username'))[:100])
+
+    def has_perm(self):
+        self.get_request().user.has_perm('learning.view_user', self.target)
+
+    def run(self, names=None):
+        User = get_user_model()
+        scenarios = {
+            'user_post_save': (self.user_post_save, True),
+            'user_admin_save_model': (self.save_model, True),
+            'admin_onboarding_job': (self.admin_onboarding, True),
+            'user_changelist': (self.changelist(User), False),
+            'company_changelist': (self.changelist(Company), False),
+            'bot_changelist': (self.changelist(Bot), False),
+            'get_objects_for_user': (self.objects_for_user, False),
+            'has_perm': (self.has_perm, False),
+        }
+        return {
+            name: measure(run, self.repeat, rollback=rollback)
+            for name, (run, rollback) in scenarios.items()
+            if names is None or name in names
+        }
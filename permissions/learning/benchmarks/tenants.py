@@ -0,0 +1,132 @@
+"""
+Synthetic tenants: a company tree of a given depth and fan-out, users of
+every role in each company and bots in each company.
+
+Companies are created one by one so their signals provision the groups
+and the closure rows, with the treenode signals off and the tree
+denormalized once at the end. Users go through the bulk importer.
+"""
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from treenode.signals import no_signals
+
+from ..models import Bot, Company, CompanyClosure
+from ..onboarding import UserImporter
+
+
+DEFAULT_USERS = {'AD': 1, 'AG': 1, 'ED': 10}
+
+
+class TenantSpec:
+    """
+    Shape of a synthetic tenant named ``name``: ``depth`` levels of
+    companies below the root, each company having ``fan_out`` children,
+    ``users`` users per role and ``bots`` bots.
+    """
+
+    def __init__(self, name='bench', depth=2, fan_out=3, users=None, bots=5):
+        self.name = name
+        self.depth = depth
+        self.fan_out = fan_out
+        self.users = users if users is not None else dict(DEFAULT_USERS)
+        self.bots = bots
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'depth': self.depth,
+            'fan_out': self.fan_out,
+            'users': self.users,
+            'bots': self.bots,
+        }
+
+
+def get_tenant(spec):
+    """
+    Return the root company of the tenant, None if it was not built.
+    """
+    return Company.objects.filter(name=spec.name, tn_parent__isnull=True).first()
+
+
+def build_companies(spec):
+    root = Company.objects.create(name=spec.name, type=Company.Type.AGENCY)
+    companies = [root]
+    level = [root]
+    with no_signals():
+        for depth in range(1, spec.depth + 1):
+            company_type = (
+                Company.Type.AGENCY if depth < spec.depth
+                else Company.Type.REGULAR_COMPANY)
+            level = [
+                Company.objects.create(
+                    name=f'{parent.name}.{index}',
+                    type=company_type,
+                    tn_parent=parent)
+                for parent in level
+                for index in range(spec.fan_out)
+            ]
+            companies.extend(level)
+    Company.update_tree()
+    return companies
+
+
+def build_users(spec, companies, batch_size=1000):
+    rows = (
+        {
+            'username': f'{company.name}:{role}:{index}',
+            'company': company.pk,
+            'role': role,
+            'is_staff': role == 'AD',
+        }
+        for company in companies
+        for role, count in spec.users.items()
+        for index in range(count)
+    )
+    # Without a password the importer stores an unusable one,
+    # hashing would dominate the build time.
+    with UserImporter(batch_size=batch_size, workers=1) as importer:
+        for _, created, _ in importer.run(rows):
+            pass
+    return created
+
+
+def build_bots(spec, companies, batch_size=1000):
+    creators = dict(get_user_model().objects.filter(
+        company__in=companies, role='AD').values_list('company_id', 'pk'))
+    bots = [
+        Bot(name=f'{company.name}:bot:{index}',
+            company=company,
+            created_by_id=creators.get(company.pk))
+        for company in companies
+        for index in range(spec.bots)
+    ]
+    Bot.objects.bulk_create(bots, batch_size=batch_size)
+    return len(bots)
+
+
+def build_tenant(spec):
+    """
+    Build the tenant described by ``spec`` unless it exists already,
+    so that repeated runs measure the same data. Return its root company.
+    """
+    root = get_tenant(spec)
+    if root is not None:
+        return root
+
+    with transaction.atomic():
+        companies = build_companies(spec)
+    build_users(spec, companies)
+    with transaction.atomic():
+        build_bots(spec, companies)
+    return companies[0]
+
+
+def get_tenant_counts(root):
+    companies = CompanyClosure.objects.descendants(root)
+    users = get_user_model().objects.filter(company__in=companies)
+    return {
+        'companies': Company.objects.filter(pk__in=companies).count(),
+        'users': users.count(),
+        'bots': Bot.objects.filter(company__in=companies).count(),
+    }
@@ -0,0 +1,15 @@
+"""
+Query budgets: the maximum number of queries a view or signal receiver
+may run on the fixed dataset of ``learning.test_query_budgets``.
+
+Admin views declare theirs in the ``query_budgets`` attribute of their
+ModelAdmin, post_save receivers with the ``query_budget`` decorator,
+counting the whole save that sends the signal.
+"""
+
+
+def query_budget(queries):
+    def decorator(func):
+        func.query_budget = queries
+        return func
+    return decorator
@@ -2,6 +2,9 @@ from django import forms
 from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
 from django.core.exceptions import ValidationError
+from django.forms.models import BaseInlineFormSet
+
+from .pagination import KeysetPaginator
 
 
 class UserCreationForm(forms.ModelForm):
@@ -47,3 +50,20 @@ class UserChangeForm(forms.ModelForm):
         # This is done here, rather than on the field, because the
         # field does not have access to the initial value
         return self.initial["password"]
+
+
+class PaginatedInlineFormSet(BaseInlineFormSet):
+    """
+    Inline formset of the first ``per_page`` related objects only, the
+    following pages are loaded on demand by the inline template.
+    """
+    per_page = 50
+
+    def get_queryset(self):
+        # Still a QuerySet, of the objects of the page in the page order
+        if not hasattr(self, '_queryset'):
+            paginator = KeysetPaginator(self.queryset, self.per_page)
+            self.page = paginator.page(1)
+            self._queryset = self.queryset.filter(
+                pk__in=[obj.pk for obj in self.page]).order_by(*paginator.get_ordering())
+        return self._queryset
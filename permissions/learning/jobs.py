@@ -0,0 +1,194 @@
+"""
+Database-backed background jobs.
+
+A job is a row of learning.Job naming a Task by its dotted path. Workers
+started by the ``run_jobs`` command claim pending jobs with a conditional
+UPDATE, so any number of them can share the table, and run the task chunk
+by chunk: every chunk commits together with the job cursor and progress.
+A job that fails, or whose worker died, is picked up again later and
+resumes after its last committed chunk, so tasks must be idempotent.
+"""
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Job
+
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+
+# A running job whose worker has not reported progress for this long
+# is considered abandoned and claimed again.
+STALE_AFTER = timedelta(minutes=10)
+
+
+class Task:
+    """
+    Base class of the job tasks. ``run`` is a generator doing the work in
+    chunks after ``cursor`` and yielding ``(cursor, items done)`` after
+    each of them, or ``(cursor, items done, items skipped)`` for the items
+    of the chunk it could not process, counted on the job.
+    """
+    chunk_size = 500
+
+    def count(self, payload):
+        """
+        Number of items the job will process, shown as its progress.
+        """
+        return None
+
+    def run(self, payload, cursor):
+        raise NotImplementedError
+
+
+def enqueue(task, payload=None, run_after=None, unique=False):
+    """
+    Queue ``task``, the dotted path of a Task instance. Inside a transaction
+    the job only becomes visible to the workers when it commits, and is
+    discarded with it on rollback.
+
+    With ``unique`` a pending job of the same task and payload that has
+    not started yet is returned instead of queueing another.
+    """
+    payload = payload or {}
+    if unique:
+        job = Job.objects.filter(
+            task=task, payload=payload, status=Job.Status.PENDING, attempts=0,
+        ).order_by('pk').first()
+        if job is not None:
+            return job
+    return Job.objects.create(
+        task=task,
+        payload=payload,
+        run_after=run_after or timezone.now())
+
+
+def retry(jobs):
+    """
+    Queue the failed ``jobs`` again, keeping the progress they made.
+    """
+    return jobs.filter(status=Job.Status.FAILED).update(
+        status=Job.Status.PENDING,
+        attempts=0,
+        error='',
+        run_after=timezone.now(),
+        updated_at=timezone.now())
+
+
+def claim_job():
+    """
+    Mark the next runnable job as running and return it,
+    or None if there is nothing to do.
+    """
+    now = timezone.now()
+    candidates = Job.objects.filter(
+        Q(status=Job.Status.PENDING, run_after__lte=now) |
+        Q(status=Job.Status.RUNNING, updated_at__lt=now - STALE_AFTER)
+    ).order_by('run_after').values_list('pk', 'status', 'updated_at')[:10]
+
+    for pk, status, updated_at in candidates:
+        claimed = Job.objects.filter(
+            pk=pk, status=status, updated_at=updated_at
+        ).update(
+            status=Job.Status.RUNNING,
+            attempts=F('attempts') + 1,
+            updated_at=now)
+        if claimed:
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def run_job(job):
+    """
+    Run ``job`` to completion, committing its cursor after every chunk.
+    """
+    try:
+        task = import_string(job.task)
+        if job.total is None:
+            job.total = task.count(job.payload)
+            Job.objects.filter(pk=job.pk).update(total=job.total)
+
+        steps = task.run(job.payload, job.cursor)
+        while True:
+            with transaction.atomic():
+                try:
+                    cursor, done, *skipped = next(steps)
+                except StopIteration:
+                    break
+                Job.objects.filter(pk=job.pk).update(
+                    cursor=cursor,
+                    done=F('done') + done,
+                    skipped=F('skipped') + sum(skipped),
+                    updated_at=timezone.now())
+    except Exception:
+        logger.exception('Job %s failed', job)
+        failed = job.attempts >= MAX_ATTEMPTS
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.Status.FAILED if failed else Job.Status.PENDING,
+            error=traceback.format_exc(),
+            run_after=timezone.now() + timedelta(seconds=2 ** job.attempts),
+            updated_at=timezone.now())
+        return False
+
+    Job.objects.filter(pk=job.pk).update(
+        status=Job.Status.DONE,
+        error='',
+        updated_at=timezone.now())
+    return True
+
+
+class Worker:
+    """
+    Pool of ``workers`` threads running jobs until stopped. With ``burst``
+    a thread stops as soon as there is no job left instead of polling
+    every ``poll_interval`` seconds.
+    """
+
+    def __init__(self, workers=1, poll_interval=1.0, burst=False):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.burst = burst
+        self.stopped = threading.Event()
+
+    def work(self):
+        processed = 0
+        try:
+            while not self.stopped.is_set():
+                close_old_connections()
+                job = claim_job()
+                if job is None:
+                    if self.burst:
+                        break
+                    self.stopped.wait(self.poll_interval)
+                    continue
+                run_job(job)
+                processed += 1
+        finally:
+            connection.close()
+        return processed
+
+    def run(self):
+        """
+        Run the pool and return the number of jobs processed.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.work) for _ in range(self.workers)]
+            try:
+                while not all(future.done() for future in futures):
+                    time.sleep(self.poll_interval)
+            except KeyboardInterrupt:
+                self.stopped.set()
+        return sum(future.result() for future in futures)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,40 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+
+from learning.models import Bot
+from learning.thumbnails import VARIANTS, needs_variants, run_in_worker
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate the missing or outdated logo variants of the existing bots, '
+        'with a pool of worker threads.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument(
+            '--max-pending', type=int, default=100,
+            help='Maximum number of logos submitted to the workers and not resized yet')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Generate the variants of every logo, even up to date ones')
+
+    def handle(self, *args, **options):
+        bots = Bot.objects.exclude(logo='').only('pk', 'logo', *VARIANTS).order_by('pk')
+        max_pending = max(options['max_pending'], options['workers'])
+        generated = submitted = 0
+        pending = set()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for bot in bots.iterator(chunk_size=2000):
+                if not options['force'] and not needs_variants(bot):
+                    continue
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    generated += sum(future.result() for future in done)
+                pending.add(executor.submit(run_in_worker, bot.pk, bot.logo.name))
+                submitted += 1
+            generated += sum(future.result() for future in pending)
+        self.stdout.write(self.style.SUCCESS(
+            f'{generated} of {submitted} logos resized'))
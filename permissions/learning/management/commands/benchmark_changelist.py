@@ -0,0 +1,57 @@
+import json
+import statistics
+import time
+
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+
+class Command(BaseCommand):
+    help = (
+        'Time an admin changelist as seen by a user. Run it before and '
+        'after a schema change (e.g. "migrate learning 0002" and back) to '
+        'compare the latencies.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='User viewing the changelist')
+        parser.add_argument('--model', default='user', choices=('user', 'bot', 'company'))
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--page', type=int, default=1)
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        try:
+            viewer = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError('Usuario {} no existe'.format(options['username']))
+
+        model_admin = next(
+            model_admin for model, model_admin in admin.site._registry.items()
+            if model._meta.model_name == options['model'])
+        request_factory = RequestFactory()
+
+        timings = []
+        for _ in range(options['repeat']):
+            request = request_factory.get('/', {'p': options['page'] - 1})
+            # A fresh user per request, like the authentication middleware
+            request.user = User.objects.get(pk=viewer.pk)
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = model_admin.changelist_view(request)
+                response.render()
+                timings.append(time.perf_counter() - start)
+
+        self.stdout.write(json.dumps({
+            'model': options['model'],
+            'viewer': viewer.username,
+            'users': User.objects.count(),
+            'queries': len(context),
+            'median_ms': round(statistics.median(timings) * 1000, 2),
+            'min_ms': round(min(timings) * 1000, 2),
+            'max_ms': round(max(timings) * 1000, 2),
+        }))
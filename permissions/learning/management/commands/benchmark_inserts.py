@@ -0,0 +1,79 @@
+import json
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from learning.models import Bot, Company
+from learning.uuids import uuid7
+
+
+GENERATORS = {
+    'uuid4': uuid.uuid4,
+    'uuid7': uuid7,
+}
+
+
+def get_rate(rows, seconds):
+    return round(rows / seconds) if seconds else None
+
+
+class Command(BaseCommand):
+    help = (
+        'Time a create_bots style load of bots keyed by random (uuid4) and '
+        'time-ordered (uuid7) primary keys. Every load runs in a transaction '
+        'rolled back at its end, so they all start from the same table.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument(
+            '--generator', action='append', choices=sorted(GENERATORS),
+            help='Time only these key generators')
+        parser.add_argument('--output', help='Write the JSON result to this file')
+
+    def load(self, generator, rows, batch_size):
+        """
+        Insert ``rows`` bots in batches, return the seconds of every batch.
+        """
+        timings = []
+        with transaction.atomic():
+            company = Company.objects.create(name='benchmark_inserts')
+            for offset in range(0, rows, batch_size):
+                start = time.perf_counter()
+                Bot.objects.bulk_create([
+                    Bot(id=generator(), name=f'bot{number}', company=company)
+                    for number in range(offset, min(offset + batch_size, rows))
+                ])
+                timings.append(time.perf_counter() - start)
+            transaction.set_rollback(True)
+        return timings
+
+    def handle(self, *args, **options):
+        rows, batch_size = options['rows'], options['batch_size']
+        result = {'rows': rows, 'batch_size': batch_size, 'existing': Bot.objects.count()}
+
+        for name in options['generator'] or sorted(GENERATORS):
+            timings = self.load(GENERATORS[name], rows, batch_size)
+            # The rate of the last batches shows how inserts slow down
+            # as the index grows
+            tail = timings[-max(len(timings) // 10, 1):]
+            result[name] = {
+                'seconds': round(sum(timings), 3),
+                'rows_per_second': get_rate(rows, sum(timings)),
+                'first_batch_rows_per_second': get_rate(min(batch_size, rows), timings[0]),
+                'last_tenth_rows_per_second': get_rate(
+                    batch_size * len(tail), sum(tail)) if len(timings) > 1 else None,
+                'median_batch_ms': round(statistics.median(timings) * 1000, 2),
+            }
+
+        output = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Result written to {options['output']}"))
+        else:
+            self.stdout.write(output)
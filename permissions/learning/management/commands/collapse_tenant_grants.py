@@ -0,0 +1,96 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+from django.db.models.functions import Cast
+
+from guardian.ctypes import get_content_type
+
+from learning.backends import bump_versions
+from learning.models import Bot, Company, CompanyClosure, PermissionGroup
+from learning.provisioning import (
+    grant_tenant, is_tenant_scope, provision_groups, provision_memberships,
+    provision_tenant_access)
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the access of the Admins to the users of their company tree '
+        'from the per-user groups to the tenant groups of the companies. Run '
+        'it after setting ACCESS_SCOPE to "tenant".'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def chunks(self, queryset):
+        """
+        The instances of ``queryset`` in chunks, by keyset on the pk.
+        """
+        queryset = queryset.order_by('pk')
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            chunk = list(chunk[:self.batch_size])
+            if chunk:
+                yield chunk
+            if len(chunk) < self.batch_size:
+                return
+            last_pk = chunk[-1].pk
+
+    def delete_user_grants(self, admin, companies):
+        """
+        Delete the memberships of ``admin`` in the Read and Own groups of the
+        users of ``companies``, and theirs in the Read group of ``admin``,
+        which the tenant groups replace. Return how many were deleted.
+        """
+        User = get_user_model()
+        Membership = User.groups.through
+        users = User.objects.filter(company__in=companies).exclude(pk=admin.pk)
+        user_groups = PermissionGroup.objects.filter(
+            content_type=get_content_type(User),
+            object_pk__in=users.annotate(
+                object_key=Cast('pk', models.CharField())).values('object_key'),
+            access_level__in=[PermissionGroup.AccessLevel.READ, PermissionGroup.AccessLevel.OWN],
+        ).values('group_id')
+        read_id = PermissionGroup.objects.get_group_id(admin, PermissionGroup.AccessLevel.READ)
+        inherited = Membership.objects.filter(user_id=admin.pk, group_id__in=user_groups)
+        granted = Membership.objects.filter(group_id=read_id, user__in=users)
+        return inherited.delete()[0] + granted.delete()[0]
+
+    def handle(self, *args, **options):
+        if not is_tenant_scope():
+            raise CommandError('Set ACCESS_SCOPE to "tenant" first')
+        self.batch_size = options['batch_size']
+        User = get_user_model()
+
+        provisioned = 0
+        for model, provision in (
+                (Company, provision_groups),
+                (User, provision_memberships),
+                (Bot, provision_tenant_access)):
+            queryset = model.objects.all()
+            if model is User:
+                queryset = queryset.filter(is_superuser=False)
+            for chunk in self.chunks(queryset):
+                with transaction.atomic():
+                    provision(chunk)
+                provisioned += len(chunk)
+        self.stdout.write(f'{provisioned} companies, users and bots provisioned')
+
+        admins = User.objects.filter(role=User.Role.ADMIN, company__isnull=False)
+        count = inserted = deleted = 0
+        for chunk in self.chunks(admins):
+            count += len(chunk)
+            for admin in chunk:
+                companies = CompanyClosure.objects.descendants(admin.company_id)
+                with transaction.atomic():
+                    inserted += grant_tenant(
+                        admin, companies.values_list('descendant', flat=True)).inserted
+                    deleted += self.delete_user_grants(admin, companies)
+        self.stdout.write(
+            f'{count} admins: {inserted} tenant memberships inserted, '
+            f'{deleted} per-user memberships deleted')
+
+        # The memberships were deleted without m2m_changed
+        bump_versions()
+        self.stdout.write(self.style.SUCCESS('Grants collapsed into the tenant groups'))
@@ -0,0 +1,112 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from guardian.ctypes import get_content_type
+from guardian.models import GroupObjectPermission, UserObjectPermission
+from guardian.utils import get_group_obj_perms_model, get_user_obj_perms_model
+
+from learning.access import ACCESS_MODELS, add_access, get_codenames
+from learning.backends import bump_versions
+from learning.provisioning import delete_rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the bitmask object permission store of learning.access from '
+        'the guardian rows, one access row per user or group and object. Run '
+        'it before setting OBJECT_PERMISSION_STORE to "bitmask".'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model', action='append',
+            choices=sorted(model._meta.model_name for model in ACCESS_MODELS),
+            help='Convert only these models')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def get_tables(self, model):
+        """
+        The (holder, guardian table) pairs holding the object permissions
+        of ``model``, its direct tables and the generic ones.
+        """
+        for holder, direct, generic in (
+                ('user', get_user_obj_perms_model(model), UserObjectPermission),
+                ('group', get_group_obj_perms_model(model), GroupObjectPermission)):
+            for table in dict.fromkeys((direct, generic)):
+                yield holder, table
+
+    def get_rows(self, model, holder, table):
+        """
+        The (object pk, holder id, codename) rows of the guardian ``table``
+        for ``model``, ordered by object.
+        """
+        ctype = get_content_type(model)
+        generic = table.objects.is_generic()
+        rows = table.objects.filter(permission__content_type=ctype)
+        if generic:
+            rows = rows.filter(content_type=ctype)
+        pk_field = 'object_pk' if generic else 'content_object_id'
+        rows = rows.order_by(pk_field).values_list(
+            pk_field, f'{holder}_id', 'permission__codename')
+        for pk, holder_id, codename in rows.iterator(chunk_size=self.batch_size):
+            yield model._meta.pk.to_python(pk) if generic else pk, holder_id, codename
+
+    def flush(self, model, masks):
+        """
+        Insert the access rows of ``masks``, merged with the rows already
+        converted for the same objects from another guardian table.
+        """
+        access_model = ACCESS_MODELS[model]
+        pks = {pk for pk, _, _ in masks}
+        existing = access_model.objects.filter(content_object__in=pks).values_list(
+            'content_object', 'user', 'group', 'mask')
+        for pk, user_id, group_id, mask in existing:
+            key = (pk, 'user', user_id) if user_id is not None else (pk, 'group', group_id)
+            masks[key] = masks.get(key, 0) | mask
+        delete_rows(access_model, 'content_object', list(pks), existing.db)
+        add_access(model, masks, batch_size=self.batch_size)
+
+    def convert(self, model):
+        """
+        Rebuild the access rows of ``model`` from its guardian tables, a
+        batch of ``batch_size`` objects at a time. Return the number of
+        guardian rows converted.
+        """
+        bits = {codename: 1 << bit for bit, codename in enumerate(get_codenames(model))}
+        table = ACCESS_MODELS[model]._meta.db_table
+        with connections[ACCESS_MODELS[model].objects.db].cursor() as cursor:
+            # No per-row signals, the caches are bumped once by handle
+            cursor.execute(f'DELETE FROM {cursor.db.ops.quote_name(table)}')
+
+        converted = 0
+        for holder, guardian_table in self.get_tables(model):
+            masks = {}
+            batch = set()
+            for pk, holder_id, codename in self.get_rows(model, holder, guardian_table):
+                if pk not in batch and len(batch) == self.batch_size:
+                    self.flush(model, masks)
+                    masks, batch = {}, set()
+                batch.add(pk)
+                # Permissions no longer declared by the model are dropped
+                if codename in bits:
+                    key = pk, holder, holder_id
+                    masks[key] = masks.get(key, 0) | bits[codename]
+                    converted += 1
+            if masks:
+                self.flush(model, masks)
+        return converted
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        names = options['model']
+        for model, access_model in ACCESS_MODELS.items():
+            if names and model._meta.model_name not in names:
+                continue
+            with transaction.atomic():
+                converted = self.convert(model)
+            self.stdout.write(
+                f'{model._meta.model_name}: {converted} guardian rows, '
+                f'{access_model.objects.count()} access rows')
+
+        bump_versions()
+        self.stdout.write(self.style.SUCCESS('Object permissions converted'))
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
-from learning.models import Company, User
+from learning.models import Company
+from learning.onboarding import UserImporter
 
 
 class Command(BaseCommand):
@@ -7,21 +8,33 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('num_users', type=int)
+        parser.add_argument('--company', default='One', help='Company name')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int)
 
     def handle(self, *args, **options):
-        company = Company.objects.get(name='One')
-        count = 0
-        while count <= options['num_users']:
-            try:
-                user = User.objects.create(
-                    username='user {}'.format(count),
-                    password='admin1234.',
-                    company=company,
-                    role='AD')
+        try:
+            company = Company.objects.get(name=options['company'])
+        except Company.DoesNotExist:
+            raise CommandError('Empresa {} no existe'.format(options['company']))
 
-                user.save()
-                count += 1
-            except Exception as e:
-                raise CommandError('Usuario no creado {}'.format(e))
+        rows = (
+            {'username': 'user {}'.format(count)}
+            for count in range(options['num_users'])
+        )
+        importer = UserImporter(
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            defaults={
+                'password': 'admin1234.',
+                'company': company.pk,
+                'role': 'AD',
+            })
+        try:
+            with importer:
+                for read, created, rate in importer.run(rows):
+                    self.stdout.write('{} usuarios ({:.1f} por segundo)'.format(read, rate))
+        except Exception as e:
+            raise CommandError('Usuario no creado {}'.format(e))
 
-            self.stdout.write(self.style.SUCCESS('Usuario creado'))
+        self.stdout.write(self.style.SUCCESS('{} usuarios creados'.format(created)))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from learning.onboarding import UserImporter, open_stream, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Import users from a CSV or JSON lines file in batches. '
+        'Existing usernames are skipped, so a failed import can be resumed '
+        'by running the command again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, '-' for stdin")
+        parser.add_argument('--format', choices=('csv', 'jsonl'))
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--workers', type=int,
+            help='Password hashing processes, defaults to the number of CPUs')
+        parser.add_argument('--company', type=int, help='Default company id')
+        parser.add_argument('--role', default='ED', help='Default role')
+        parser.add_argument('--password', help='Default password')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        defaults = {'role': options['role']}
+        if options['company'] is not None:
+            defaults['company'] = options['company']
+        if options['password']:
+            defaults['password'] = options['password']
+
+        importer = UserImporter(
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            defaults=defaults)
+        read = created = 0
+        try:
+            with open_stream(path) as stream, importer:
+                for read, created, rate in importer.run(read_rows(stream, format)):
+                    self.stdout.write(
+                        f'{read} rows read, {created} users created ({rate:.1f} rows/s)')
+        except Exception as e:
+            raise CommandError(
+                'Import stopped after {} rows, run the command again '
+                'to resume: {}'.format(read, e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{created} users created, {read - created} already existed'))
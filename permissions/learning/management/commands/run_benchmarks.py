@@ -0,0 +1,76 @@
+import json
+import subprocess
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from learning.benchmarks.scenarios import Scenarios
+from learning.benchmarks.tenants import TenantSpec, build_tenant, get_tenant_counts
+
+
+def parse_roles(value):
+    """
+    Parse "AD=1,AG=2,ED=20" into a mapping of role to users per company.
+    """
+    try:
+        return {
+            role.strip(): int(count)
+            for role, count in (item.split('=') for item in value.split(','))
+        }
+    except ValueError:
+        raise CommandError(f'Invalid --users {value!r}, expected e.g. AD=1,ED=20')
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Build a synthetic tenant (unless it exists) and time the permission '
+        'hot paths on it. The JSON result includes the commit, so runs can '
+        'be compared across commits.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', default='bench', help='Root company of the tenant')
+        parser.add_argument('--depth', type=int, default=2)
+        parser.add_argument('--fan-out', type=int, default=3)
+        parser.add_argument(
+            '--users', type=parse_roles, default='AD=1,AG=1,ED=10',
+            help='Users per company by role')
+        parser.add_argument('--bots', type=int, default=5, help='Bots per company')
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--scenario', action='append', help='Run only these scenarios')
+        parser.add_argument('--output', help='Write the JSON result to this file')
+
+    def handle(self, *args, **options):
+        spec = TenantSpec(
+            name=options['name'],
+            depth=options['depth'],
+            fan_out=options['fan_out'],
+            users=options['users'],
+            bots=options['bots'])
+        root = build_tenant(spec)
+
+        result = {
+            'commit': get_commit(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'tenant': spec.as_dict(),
+            'counts': get_tenant_counts(root),
+            'repeat': options['repeat'],
+            'scenarios': Scenarios(root, repeat=options['repeat']).run(options['scenario']),
+        }
+
+        output = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Result written to {options['output']}"))
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from learning.jobs import Worker
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the queued background jobs with a pool of worker threads. '
+        'Several commands can run at the same time, each job is claimed '
+        'by a single worker.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help='Seconds to wait when there is no job to run')
+        parser.add_argument(
+            '--burst', action='store_true',
+            help='Exit once the queue is empty instead of waiting for jobs')
+
+    def handle(self, *args, **options):
+        worker = Worker(
+            workers=options['workers'],
+            poll_interval=options['poll_interval'],
+            burst=options['burst'])
+        processed = worker.run()
+        self.stdout.write(self.style.SUCCESS(f'{processed} jobs processed'))
@@ -0,0 +1,198 @@
+"""
+In-process metrics of the permission hot paths.
+
+Counters and latency histograms are kept in memory, per process, and
+rendered in the Prometheus text format by ``learning.views.metrics``.
+Collection is turned off with ``PERMISSION_METRICS_ENABLED = False``:
+every call then returns right after a flag check.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+enabled = getattr(settings, 'PERMISSION_METRICS_ENABLED', True)
+
+registry = []
+
+
+@receiver(setting_changed)
+def update_enabled(setting, value, **kwargs):
+    global enabled
+    if setting == 'PERMISSION_METRICS_ENABLED':
+        enabled = True if value is None else value
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def get_key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in sorted(values):
+            lines.extend(self.render_value(key, value))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.get_key(labels), 0)
+
+    def render_value(self, key, value):
+        yield f'{self.name}{format_labels(self.labelnames, key)} {value}'
+
+
+class Timer:
+    """
+    Context manager observing the time spent in its block.
+    """
+
+    def __init__(self, histogram, key):
+        self.histogram = histogram
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe_key(self.key, time.perf_counter() - self.start)
+
+
+class NoopTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NOOP_TIMER = NoopTimer()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe_key(self, key, value):
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket and +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def observe(self, value, **labels):
+        if enabled:
+            self.observe_key(self.get_key(labels), value)
+
+    def time(self, **labels):
+        if not enabled:
+            return NOOP_TIMER
+        return Timer(self, self.get_key(labels))
+
+    def get_count(self, **labels):
+        counts = self.values.get(self.get_key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def render_value(self, key, counts):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += count
+            labels = format_labels(self.labelnames, key, [('le', bound)])
+            yield f'{self.name}_bucket{labels} {cumulative}'
+        labels = format_labels(self.labelnames, key)
+        yield f'{self.name}_sum{labels} {counts[-1]}'
+        yield f'{self.name}_count{labels} {cumulative}'
+
+
+def render():
+    """
+    All the metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+permission_checks = Histogram(
+    'learning_permission_check_seconds',
+    'Permission checks answered by CachedPermissionBackend.',
+    ['scope'])
+permission_cache = Counter(
+    'learning_permission_cache_requests_total',
+    'Permission cache lookups by result.',
+    ['result'])
+grants = Histogram(
+    'learning_grant_seconds',
+    'Role template grants of grant_template.',
+    ['template'])
+grant_memberships = Counter(
+    'learning_grant_memberships_total',
+    'Memberships of role template grants, inserted or already present.',
+    ['template', 'result'])
+provisioning = Histogram(
+    'learning_provisioning_seconds',
+    'Provisioning of permission groups and memberships.',
+    ['step', 'model'])
+provisioned_instances = Counter(
+    'learning_provisioned_instances_total',
+    'Instances whose permission groups or memberships were provisioned.',
+    ['step', 'model'])
+tenant_scopes = Histogram(
+    'learning_tenant_scope_seconds',
+    'Queries restricted to the companies of a tenant.',
+    ['scope'])
@@ -0,0 +1,101 @@
+# Generated by Django 3.1.1 on 2026-10-18 15:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0013_initial_permission_templates'),
+        ('learning', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bot',
+            name='company',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bots', to='learning.company'),
+        ),
+        migrations.CreateModel(
+            name='UserUserObjectPermission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_object', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='object_user_permissions', to=settings.AUTH_USER_MODEL)),
+                ('permission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.permission')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='UserGroupObjectPermission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_object', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.group')),
+                ('permission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.permission')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='BotUserObjectPermission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_object', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='learning.bot')),
+                ('permission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.permission')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='BotGroupObjectPermission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_object', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='learning.bot')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.group')),
+                ('permission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.permission')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='useruserobjectpermission',
+            index=models.Index(fields=['content_object', 'permission'], name='learning_us_content_1aa919_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='useruserobjectpermission',
+            unique_together={('user', 'permission', 'content_object')},
+        ),
+        migrations.AddIndex(
+            model_name='usergroupobjectpermission',
+            index=models.Index(fields=['content_object', 'permission'], name='learning_us_content_b85914_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='usergroupobjectpermission',
+            unique_together={('group', 'permission', 'content_object')},
+        ),
+        migrations.AddIndex(
+            model_name='botuserobjectpermission',
+            index=models.Index(fields=['content_object', 'permission'], name='learning_bo_content_3bd48d_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='botuserobjectpermission',
+            unique_together={('user', 'permission', 'content_object')},
+        ),
+        migrations.AddIndex(
+            model_name='botgroupobjectpermission',
+            index=models.Index(fields=['content_object', 'permission'], name='learning_bo_content_193ba6_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='botgroupobjectpermission',
+            unique_together={('group', 'permission', 'content_object')},
+        ),
+    ]
@@ -0,0 +1,126 @@
+import uuid
+
+from django.db import migrations, transaction
+
+
+BATCH_SIZE = 5000
+
+# Models moved to direct FK tables and the type of their primary key
+MODELS = (
+    ('user', int),
+    ('bot', uuid.UUID),
+)
+
+HOLDERS = ('user', 'group')
+
+
+def get_tables(apps, model_name, holder):
+    generic_model = apps.get_model('guardian', f'{holder.capitalize()}ObjectPermission')
+    direct_model = apps.get_model(
+        'learning', f'{model_name.capitalize()}{holder.capitalize()}ObjectPermission')
+    return generic_model, direct_model
+
+
+def parse_pks(values, to_python):
+    pks = {}
+    for value in values:
+        try:
+            pks[value] = to_python(value)
+        except (TypeError, ValueError):
+            pass
+    return pks
+
+
+def to_direct(apps, schema_editor):
+    """
+    Move the generic guardian rows of User and Bot into their direct FK
+    tables. Each batch is copied and deleted in its own transaction, so
+    an interrupted migration resumes where it stopped. Rows of objects
+    that no longer exist are dropped.
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+
+    for model_name, to_python in MODELS:
+        ctype = ContentType.objects.filter(
+            app_label='learning', model=model_name).first()
+        if ctype is None:
+            continue
+        model = apps.get_model('learning', model_name)
+
+        for holder in HOLDERS:
+            generic_model, direct_model = get_tables(apps, model_name, holder)
+            rows = generic_model.objects.filter(
+                content_type=ctype).order_by('pk').values_list(
+                'pk', f'{holder}_id', 'permission_id', 'object_pk')
+
+            while True:
+                with transaction.atomic():
+                    batch = list(rows[:BATCH_SIZE])
+                    if not batch:
+                        break
+
+                    pks = parse_pks({row[3] for row in batch}, to_python)
+                    existing = set(model.objects.filter(
+                        pk__in=pks.values()).values_list('pk', flat=True))
+                    direct_model.objects.bulk_create([
+                        direct_model(**{
+                            f'{holder}_id': holder_id,
+                            'permission_id': permission_id,
+                            'content_object_id': pks[object_pk],
+                        })
+                        for _, holder_id, permission_id, object_pk in batch
+                        if pks.get(object_pk) in existing
+                    ], ignore_conflicts=True)
+                    generic_model.objects.filter(
+                        pk__in=[row[0] for row in batch]).delete()
+
+
+def to_generic(apps, schema_editor):
+    """
+    Move the direct FK rows back into the generic guardian tables.
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+
+    for model_name, _ in MODELS:
+        ctype = ContentType.objects.filter(
+            app_label='learning', model=model_name).first()
+        if ctype is None:
+            continue
+
+        for holder in HOLDERS:
+            generic_model, direct_model = get_tables(apps, model_name, holder)
+            rows = direct_model.objects.order_by('pk').values_list(
+                'pk', f'{holder}_id', 'permission_id', 'content_object_id')
+
+            while True:
+                with transaction.atomic():
+                    batch = list(rows[:BATCH_SIZE])
+                    if not batch:
+                        break
+
+                    generic_model.objects.bulk_create([
+                        generic_model(**{
+                            f'{holder}_id': holder_id,
+                            'permission_id': permission_id,
+                            'content_type_id': ctype.pk,
+                            'object_pk': str(object_pk),
+                        })
+                        for _, holder_id, permission_id, object_pk in batch
+                    ], ignore_conflicts=True)
+                    direct_model.objects.filter(
+                        pk__in=[row[0] for row in batch]).delete()
+
+
+class Migration(migrations.Migration):
+    # Batches are committed one by one, see to_direct
+    atomic = False
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('guardian', '0002_generic_permissions_index'),
+        ('learning', '0002_direct_fk_object_permissions'),
+    ]
+
+    operations = [
+        migrations.RunPython(to_direct, to_generic),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.1.1 on 2026-10-18 15:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0013_initial_permission_templates'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('learning', '0003_move_generic_object_permissions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PermissionGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_pk', models.CharField(max_length=255)),
+                ('access_level', models.CharField(choices=[('Read', 'Read'), ('Write', 'Write'), ('Own', 'Own'), ('Execute', 'Execute')], max_length=7)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='permission_group', to='auth.group')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='permissiongroup',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_pk', 'access_level'), name='unique_permission_group'),
+        ),
+    ]
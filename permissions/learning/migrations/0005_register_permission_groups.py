@@ -0,0 +1,110 @@
+from django.db import migrations
+
+
+BATCH_SIZE = 5000
+
+# Actions granted on the instance by each access level
+ACCESS_LEVELS = {
+    'Read': ('view',),
+    'Write': ('change', 'delete'),
+    'Own': ('change',),
+    'Execute': (),
+}
+
+# Model and the attribute its groups were named after
+MODELS = (
+    ('user', 'username'),
+    ('company', 'name'),
+)
+
+
+def register_groups(apps, schema_editor):
+    """
+    Register the groups named "<name>: <access level>" of every user and
+    company. Groups were looked up by name, so objects sharing a name also
+    shared their groups: the first object by primary key keeps them and
+    the others get new groups holding their object permissions.
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Group = apps.get_model('auth', 'Group')
+    Permission = apps.get_model('auth', 'Permission')
+    PermissionGroup = apps.get_model('learning', 'PermissionGroup')
+
+    for model_name, name_field in MODELS:
+        model = apps.get_model('learning', model_name)
+        group_model = apps.get_model(
+            'learning', f'{model_name.capitalize()}GroupObjectPermission')
+        ctype, _ = ContentType.objects.get_or_create(
+            app_label='learning', model=model_name)
+        permission_ids = dict(Permission.objects.filter(
+            content_type=ctype).values_list('codename', 'pk'))
+
+        last_pk = 0
+        while True:
+            batch = list(model.objects.filter(pk__gt=last_pk).order_by(
+                'pk').values_list('pk', name_field)[:BATCH_SIZE])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            claims = [
+                (pk, name, access_level, f"{name}: {access_level}")
+                for pk, name in batch
+                for access_level in ACCESS_LEVELS
+            ]
+            legacy = dict(Group.objects.filter(
+                name__in=[claim[3] for claim in claims]).values_list('name', 'pk'))
+            taken = set(PermissionGroup.objects.filter(
+                group_id__in=legacy.values()).values_list('group_id', flat=True))
+
+            registry = []
+            shared = []
+            for pk, name, access_level, group_name in claims:
+                group_id = legacy.get(group_name)
+                if group_id is None:
+                    continue
+                if group_id in taken:
+                    shared.append((pk, name, access_level))
+                    continue
+                taken.add(group_id)
+                registry.append((pk, access_level, group_id))
+
+            if shared:
+                names = {
+                    f"{name[:100]} ({model_name} {pk}): {access_level}": (pk, access_level)
+                    for pk, name, access_level in shared
+                }
+                Group.objects.bulk_create(
+                    [Group(name=name) for name in names], ignore_conflicts=True)
+                for name, group_id in Group.objects.filter(
+                        name__in=names).values_list('name', 'pk'):
+                    pk, access_level = names[name]
+                    registry.append((pk, access_level, group_id))
+                    group_model.objects.bulk_create([
+                        group_model(
+                            group_id=group_id,
+                            permission_id=permission_ids[f'{action}_{model_name}'],
+                            content_object_id=pk)
+                        for action in ACCESS_LEVELS[access_level]
+                    ], ignore_conflicts=True)
+
+            PermissionGroup.objects.bulk_create([
+                PermissionGroup(
+                    content_type=ctype,
+                    object_pk=str(pk),
+                    access_level=access_level,
+                    group_id=group_id)
+                for pk, access_level, group_id in registry
+            ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('learning', '0004_permission_group_registry'),
+    ]
+
+    operations = [
+        migrations.RunPython(register_groups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.1 on 2026-10-18 15:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning', '0005_register_permission_groups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompanyClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='learning.company')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='learning.company')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='companyclosure',
+            index=models.Index(fields=['descendant', 'depth'], name='learning_co_descend_e36bf7_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='companyclosure',
+            constraint=models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_company_closure'),
+        ),
+    ]
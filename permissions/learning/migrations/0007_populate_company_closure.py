@@ -0,0 +1,62 @@
+from django.db import migrations
+
+
+BATCH_SIZE = 5000
+
+
+def build_closure(apps, schema_editor):
+    """
+    Build the closure rows of the existing companies one tree level at a
+    time: every company gets its own row plus the rows of its parent's
+    ancestors, read from the level above.
+    """
+    Company = apps.get_model('learning', 'Company')
+    CompanyClosure = apps.get_model('learning', 'CompanyClosure')
+
+    level = list(Company.objects.filter(
+        tn_parent__isnull=True).values_list('pk', flat=True))
+    CompanyClosure.objects.bulk_create([
+        CompanyClosure(ancestor_id=pk, descendant_id=pk, depth=0)
+        for pk in level
+    ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+    while level:
+        next_level = []
+        for start in range(0, len(level), BATCH_SIZE):
+            parent_ids = level[start:start + BATCH_SIZE]
+            children = list(Company.objects.filter(
+                tn_parent__in=parent_ids).values_list('pk', 'tn_parent_id'))
+            if not children:
+                continue
+
+            ancestors = {}
+            for ancestor_id, descendant_id, depth in CompanyClosure.objects.filter(
+                    descendant__in=parent_ids).values_list(
+                    'ancestor_id', 'descendant_id', 'depth'):
+                ancestors.setdefault(descendant_id, []).append((ancestor_id, depth))
+
+            rows = []
+            for pk, parent_id in children:
+                rows.append(CompanyClosure(ancestor_id=pk, descendant_id=pk, depth=0))
+                rows.extend(
+                    CompanyClosure(ancestor_id=ancestor_id, descendant_id=pk, depth=depth + 1)
+                    for ancestor_id, depth in ancestors.get(parent_id, ()))
+                next_level.append(pk)
+            CompanyClosure.objects.bulk_create(
+                rows, batch_size=BATCH_SIZE, ignore_conflicts=True)
+        level = next_level
+
+
+def clear_closure(apps, schema_editor):
+    apps.get_model('learning', 'CompanyClosure').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning', '0006_company_closure'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_closure, clear_closure),
+    ]
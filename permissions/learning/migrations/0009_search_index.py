@@ -0,0 +1,60 @@
+from django.db import migrations
+
+
+USER_COLUMNS = ('username', 'first_name', 'last_name', 'email')
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE learning_user_search USING fts5("
+    "username, first_name, last_name, email, prefix='2 3')",
+    "INSERT INTO learning_user_search (rowid, username, first_name, last_name, email) "
+    "SELECT id, username, first_name, last_name, email FROM learning_user",
+    "CREATE VIRTUAL TABLE learning_company_search USING fts5(name, prefix='2 3')",
+    "INSERT INTO learning_company_search (rowid, name) SELECT id, name FROM learning_company",
+]
+
+SQLITE_BACKWARD = [
+    'DROP TABLE learning_user_search',
+    'DROP TABLE learning_company_search',
+]
+
+# Same expression as the icontains lookups of Django, so they use the index
+POSTGRESQL_FORWARD = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    *(
+        f'CREATE INDEX learning_user_{column}_trgm ON learning_user '
+        f'USING gin (UPPER({column}::text) gin_trgm_ops)'
+        for column in USER_COLUMNS
+    ),
+    'CREATE INDEX learning_company_name_trgm ON learning_company '
+    'USING gin (UPPER(name::text) gin_trgm_ops)',
+]
+
+POSTGRESQL_BACKWARD = [
+    *(f'DROP INDEX learning_user_{column}_trgm' for column in USER_COLUMNS),
+    'DROP INDEX learning_company_name_trgm',
+]
+
+
+def run(statements):
+    def run_statements(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, ()):
+            schema_editor.execute(statement)
+    return run_statements
+
+
+class Migration(migrations.Migration):
+    """
+    Search indexes of learning.search: FTS5 tables on SQLite, trigram
+    indexes serving ``icontains`` on PostgreSQL, nothing elsewhere.
+    """
+
+    dependencies = [
+        ('learning', '0008_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRESQL_BACKWARD}),
+        ),
+    ]
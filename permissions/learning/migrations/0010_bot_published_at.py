@@ -0,0 +1,18 @@
+# Generated by Django 3.1.1 on 2026-10-18 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning', '0009_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bot',
+            name='published_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
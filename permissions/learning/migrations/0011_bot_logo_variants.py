@@ -0,0 +1,23 @@
+# Generated by Django 3.1.1 on 2026-10-18 16:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning', '0010_bot_published_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bot',
+            name='logo_detail',
+            field=models.ImageField(blank=True, editable=False, max_length=255, upload_to='thumbnails/'),
+        ),
+        migrations.AddField(
+            model_name='bot',
+            name='logo_thumbnail',
+            field=models.ImageField(blank=True, editable=False, max_length=255, upload_to='thumbnails/'),
+        ),
+    ]
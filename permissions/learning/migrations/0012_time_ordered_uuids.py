@@ -0,0 +1,28 @@
+# Generated by Django 3.1.1 on 2026-10-18 16:04
+
+from django.db import migrations, models
+import learning.uuids
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning', '0011_bot_logo_variants'),
+    ]
+
+    # Only the Python default changes, existing keys stay as they are.
+    # State only, as SQLite would rebuild both tables for an AlterField.
+    operations = [
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterField(
+                model_name='bot',
+                name='id',
+                field=models.UUIDField(default=learning.uuids.uuid7, editable=False, primary_key=True, serialize=False, unique=True),
+            ),
+            migrations.AlterField(
+                model_name='company',
+                name='uuid',
+                field=models.UUIDField(default=learning.uuids.uuid7, editable=False, unique=True),
+            ),
+        ]),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 3.1.1 on 2026-10-18 16:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import learning.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0013_initial_permission_templates'),
+        ('learning', '0012_time_ordered_uuids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAccess',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mask', learning.models.AccessMaskField(default=0)),
+                ('content_object', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='object_access', to=settings.AUTH_USER_MODEL)),
+                ('group', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='auth.group')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='CompanyAccess',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mask', learning.models.AccessMaskField(default=0)),
+                ('content_object', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='learning.company')),
+                ('group', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='auth.group')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='BotAccess',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mask', learning.models.AccessMaskField(default=0)),
+                ('content_object', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='learning.bot')),
+                ('group', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='auth.group')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='useraccess',
+            constraint=models.UniqueConstraint(fields=('content_object', 'user'), name='unique_useraccess_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='useraccess',
+            constraint=models.UniqueConstraint(fields=('content_object', 'group'), name='unique_useraccess_group'),
+        ),
+        migrations.AddConstraint(
+            model_name='useraccess',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('group__isnull', False), ('user__isnull', True)), models.Q(('group__isnull', True), ('user__isnull', False)), _connector='OR'), name='useraccess_user_or_group'),
+        ),
+        migrations.AddConstraint(
+            model_name='companyaccess',
+            constraint=models.UniqueConstraint(fields=('content_object', 'user'), name='unique_companyaccess_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='companyaccess',
+            constraint=models.UniqueConstraint(fields=('content_object', 'group'), name='unique_companyaccess_group'),
+        ),
+        migrations.AddConstraint(
+            model_name='companyaccess',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('group__isnull', False), ('user__isnull', True)), models.Q(('group__isnull', True), ('user__isnull', False)), _connector='OR'), name='companyaccess_user_or_group'),
+        ),
+        migrations.AddConstraint(
+            model_name='botaccess',
+            constraint=models.UniqueConstraint(fields=('content_object', 'user'), name='unique_botaccess_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='botaccess',
+            constraint=models.UniqueConstraint(fields=('content_object', 'group'), name='unique_botaccess_group'),
+        ),
+        migrations.AddConstraint(
+            model_name='botaccess',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('group__isnull', False), ('user__isnull', True)), models.Q(('group__isnull', True), ('user__isnull', False)), _connector='OR'), name='botaccess_user_or_group'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.1 on 2026-10-18 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning', '0013_object_access'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='permissiongroup',
+            name='access_level',
+            field=models.CharField(choices=[('Read', 'Read'), ('Write', 'Write'), ('Own', 'Own'), ('Execute', 'Execute'), ('TenantRead', 'Tenant read'), ('TenantOwn', 'Tenant own'), ('Members', 'Members')], max_length=10),
+        ),
+    ]
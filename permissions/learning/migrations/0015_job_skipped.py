@@ -0,0 +1,18 @@
+# Generated by Django 3.1.1 on 2026-10-18 16:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning', '0014_tenant_access_levels'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='skipped',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,17 +1,24 @@
+from django.apps import apps
+
+
 class BotxoPermissionsMixin:
 
     def grant_permissions(self, user):
-        model_class = self.user__class__.__name__.lower()
+        PermissionGroup = apps.get_model('learning', 'PermissionGroup')
+        model_class = self._meta.model_name
         if user.has_perm(f'learning.view_{model_class}'):
-            read_permissions = Group.objects.get(name=f"{self.username}: Read")
+            read_permissions = PermissionGroup.objects.require_group_id(
+                self, PermissionGroup.AccessLevel.READ)
             user.groups.add(read_permissions)
 
         if user.has_perm(f'learning.change_{model_class}') and \
                 user.has_perm(f'learning.delete_{model_class}'):
-            write_permissions = Group.objects.get(name=f"{self.username}: Write")
+            write_permissions = PermissionGroup.objects.require_group_id(
+                self, PermissionGroup.AccessLevel.WRITE)
             user.groups.add(write_permissions)
 
         if user.has_perm(f'learning.change_{model_class}') and \
                 not user.has_perm(f'learning.delete_{model_class}'):
-            own_permissions = Group.objects.get(name=f"{self.username}: Own")
+            own_permissions = PermissionGroup.objects.require_group_id(
+                self, PermissionGroup.AccessLevel.OWN)
             user.groups.add(own_permissions)
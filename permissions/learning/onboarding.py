@@ -0,0 +1,238 @@
+"""
+Bulk onboarding of users.
+
+Rows are read as a stream, inserted with ``bulk_create`` in batches and
+provisioned per batch with the set-based helpers of ``provisioning``.
+Every batch is inserted and provisioned in its own transaction and users
+that already exist are skipped, so an interrupted import can be resumed
+by running it again.
+
+Granting a new Admin access to the users of its company tree runs as the
+background job ``admin_onboarding``, per user or, in the tenant scope, per
+company.
+"""
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from . import metrics
+from .jobs import Task
+from .models import CompanyClosure
+from .provisioning import (
+    ROLE_TEMPLATES, grant_tenant, is_tenant_scope, provision_groups,
+    provision_memberships)
+from .search import index_users
+
+
+USER_FIELDS = (
+    'username',
+    'email',
+    'first_name',
+    'last_name',
+    'company',
+    'role',
+    'work_position',
+    'is_staff',
+)
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
+
+
+def read_rows(stream, format='csv'):
+    """
+    Yield the rows of a CSV (with a header line) or a JSON lines stream
+    as dictionaries, one at a time.
+    """
+    if format == 'csv':
+        yield from csv.DictReader(stream)
+    elif format == 'jsonl':
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        raise ValueError(f"Unknown format {format!r}, use 'csv' or 'jsonl'")
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class UserImporter:
+    """
+    Insert users in batches of ``batch_size`` rows, hashing their passwords
+    in a pool of ``workers`` processes (in process when ``workers`` <= 1).
+    ``defaults`` fills the columns missing from a row.
+    """
+
+    def __init__(self, batch_size=1000, workers=None, defaults=None):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.defaults = defaults or {}
+        self.executor = None
+
+    def __enter__(self):
+        if self.workers is None:
+            self.workers = os.cpu_count() or 1
+        if self.workers > 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=django.setup)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def hash_passwords(self, passwords):
+        if self.executor is None:
+            return [make_password(password) for password in passwords]
+        chunksize = max(1, len(passwords) // (4 * self.workers))
+        return list(self.executor.map(make_password, passwords, chunksize=chunksize))
+
+    def build_user(self, row, password):
+        User = get_user_model()
+        values = {**self.defaults, **{k: v for k, v in row.items() if v not in (None, '')}}
+        user = User(password=password)
+        for field in USER_FIELDS:
+            if field not in values:
+                continue
+            value = values[field]
+            if field == 'company':
+                user.company_id = int(value)
+            elif field == 'is_staff':
+                user.is_staff = str(value).lower() in TRUE_VALUES
+            else:
+                setattr(user, field, value)
+        if user.role not in ROLE_TEMPLATES:
+            raise ValueError(f"Unknown role {user.role!r} for {user.username!r}")
+        return user
+
+    def import_batch(self, rows):
+        """
+        Insert the users of ``rows`` that do not exist yet and provision
+        them. Return the number of users created.
+        """
+        User = get_user_model()
+        rows = {row['username']: row for row in reversed(rows)}
+        existing = set(User.objects.filter(
+            username__in=rows).values_list('username', flat=True))
+        new_rows = [row for username, row in rows.items() if username not in existing]
+        if not new_rows:
+            return 0
+
+        passwords = self.hash_passwords(
+            [row.get('password') or self.defaults.get('password')
+             for row in new_rows])
+        users = [
+            self.build_user(row, password)
+            for row, password in zip(new_rows, passwords)
+        ]
+
+        with transaction.atomic():
+            User.objects.bulk_create(users, batch_size=self.batch_size)
+            # bulk_create does not send post_save nor set the primary keys
+            # on every backend, reload the batch and provision it here.
+            users = list(User.objects.filter(
+                username__in=[user.username for user in users]))
+            provision_groups(users)
+            provision_memberships(users)
+            index_users(users)
+
+        return len(new_rows)
+
+    def run(self, rows):
+        """
+        Import ``rows`` batch by batch, yielding after every batch
+        ``(rows read, users created, rows per second)``.
+        """
+        read = created = 0
+        start = time.monotonic()
+        for batch in chunked(rows, self.batch_size):
+            created += self.import_batch(batch)
+            read += len(batch)
+            elapsed = time.monotonic() - start
+            yield read, created, read / elapsed if elapsed else 0.0
+
+
+class AdminOnboardingTask(Task):
+    """
+    Give the Admin ``payload['user']`` access to every user of its company
+    and of the companies below it, and them access to the Admin, in chunks
+    of users ordered by primary key. In the tenant scope the chunks are of
+    companies, whose tenant groups the Admin joins.
+    """
+
+    def get_users(self, payload):
+        User = get_user_model()
+        admin = User.objects.get(pk=payload['user'])
+        users = User.objects.filter(
+            company__in=CompanyClosure.objects.descendants(admin.company_id))
+        return admin, users
+
+    def get_companies(self, payload):
+        admin = get_user_model().objects.get(pk=payload['user'])
+        companies = CompanyClosure.objects.descendants(
+            admin.company_id).values_list('descendant', flat=True)
+        return admin, companies
+
+    def count(self, payload):
+        with metrics.tenant_scopes.time(scope='onboarding'):
+            if is_tenant_scope():
+                return self.get_companies(payload)[1].count()
+            return self.get_users(payload)[1].count()
+
+    def run(self, payload, cursor):
+        if is_tenant_scope():
+            yield from self.run_tenant(payload, cursor)
+            return
+
+        admin, users = self.get_users(payload)
+        last_pk = int(cursor or 0)
+        while True:
+            with metrics.tenant_scopes.time(scope='onboarding'):
+                chunk = list(users.filter(pk__gt=last_pk).order_by(
+                    'pk').values_list('pk', flat=True)[:self.chunk_size])
+            if not chunk:
+                return
+            admin.bulk_grant_permissions(
+                'Admin Permissions Template',
+                get_user_model().objects.filter(pk__in=chunk))
+            last_pk = chunk[-1]
+            yield str(last_pk), len(chunk)
+
+    def run_tenant(self, payload, cursor):
+        admin, companies = self.get_companies(payload)
+        last_pk = int(cursor or 0)
+        while True:
+            chunk = list(companies.filter(descendant__gt=last_pk).order_by(
+                'descendant')[:self.chunk_size])
+            if not chunk:
+                return
+            grant_tenant(admin, chunk)
+            last_pk = chunk[-1]
+            yield str(last_pk), len(chunk)
+
+
+admin_onboarding = AdminOnboardingTask()
+
+
+def open_stream(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    return open(path, newline='', encoding='utf-8')
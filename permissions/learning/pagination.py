@@ -0,0 +1,300 @@
+"""
+Keyset pagination of the admin change lists.
+
+``KeysetPaginator`` pages on the ordering columns of its queryset: the
+next page is the rows after the last row of this one, so a deep page
+costs the same as the first, where OFFSET reads every earlier row. The
+following page is detected by fetching one extra row. The total is exact
+up to ``count_limit`` rows, past that it is estimated from the planner
+statistics, or reported as a lower bound where the backend has none.
+
+``KeysetPaginationMixin`` plugs it into a ModelAdmin, the position in
+the list travels in the ``cursor`` query string parameter.
+"""
+import base64
+import json
+import operator
+from functools import reduce
+
+from django.contrib.admin.views.main import PAGE_VAR, ChangeList
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Page, PageNotAnInteger, Paginator
+from django.db import DatabaseError, connections, transaction
+from django.db.models import F, Q
+from django.db.models.expressions import OrderBy
+from django.utils.functional import cached_property
+
+
+CURSOR_VAR = 'cursor'
+
+
+def estimate_count(queryset):
+    """
+    Number of rows of ``queryset`` according to the planner statistics,
+    or None where the backend has no estimate.
+    """
+    connection = connections[queryset.db]
+    query = queryset.order_by().query
+    try:
+        with transaction.atomic(using=queryset.db), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                sql, params = query.sql_with_params()
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                return int(plan[0]['Plan']['Plan Rows'])
+            if connection.vendor == 'mysql':
+                sql, params = query.sql_with_params()
+                cursor.execute(f'EXPLAIN {sql}', params)
+                columns = [column[0] for column in cursor.description]
+                return int(cursor.fetchone()[columns.index('rows')])
+            if connection.vendor == 'sqlite' and not query.where:
+                # Filled by ANALYZE, the first number is the rows of the table
+                cursor.execute(
+                    'SELECT stat FROM sqlite_stat1 WHERE tbl = %s',
+                    [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+                return int(row[0].split()[0]) if row else None
+    except DatabaseError:
+        pass
+    return None
+
+
+def get_keys(queryset):
+    """
+    The ``(field, descending)`` columns ordering ``queryset``, ending with
+    a unique one, or None if the ordering can not be used as a keyset.
+    """
+    opts = queryset.model._meta
+    keys = []
+    for item in queryset.query.order_by or opts.ordering:
+        if isinstance(item, OrderBy) and isinstance(item.expression, F):
+            name, descending = item.expression.name, item.descending
+        elif isinstance(item, str) and item != '?':
+            descending = item.startswith('-')
+            name = item[1:] if descending else item
+        else:
+            return None
+        try:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        # Related models are ordered by their own ordering, and NULLs
+        # do not compare
+        if not field.concrete or field.null or (field.is_relation and name != field.attname):
+            return None
+        keys.append((field, descending))
+        if field.unique:
+            return keys
+    return [*keys, (opts.pk, False)]
+
+
+def get_keyset_filter(keys, values, reverse=False):
+    """
+    Rows after ``values`` in the order of ``keys``, before them if ``reverse``.
+    """
+    clauses = []
+    for i, (field, descending) in enumerate(keys):
+        lookup = 'lt' if descending != reverse else 'gt'
+        equal = {key.attname: value for (key, _), value in zip(keys[:i], values)}
+        clauses.append(Q(**equal, **{f'{field.attname}__{lookup}': values[i]}))
+    return reduce(operator.or_, clauses)
+
+
+class KeysetPage(Page):
+
+    def __init__(self, object_list, number, paginator, has_previous, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    @property
+    def next_cursor(self):
+        if self.has_next():
+            return self.paginator.encode_cursor('next', self.object_list[-1])
+        return None
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous():
+            return self.paginator.encode_cursor('previous', self.object_list[0])
+        return None
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginator continuing from ``cursor``, the position encoded by the
+    ``next_cursor`` or ``previous_cursor`` of a page. Without a cursor
+    ``page(number)`` is read with OFFSET, so page number links still work.
+    Querysets not ordered on columns are paginated with OFFSET only.
+    """
+    count_limit = 1000
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, cursor=None):
+        super().__init__(object_list, per_page, orphans, allow_empty_first_page)
+        self.keys = get_keys(object_list)
+        self.cursor = self.decode_cursor(cursor) if cursor and self.keys else None
+        self.current_page = None
+        self.exact = True
+        self.lower_bound = False
+
+    def get_ordering(self, reverse=False):
+        return [
+            ('-' if descending != reverse else '') + field.attname
+            for field, descending in self.keys
+        ]
+
+    def encode_cursor(self, direction, obj):
+        values = [field.value_to_string(obj) for field, _ in self.keys]
+        data = json.dumps([direction, self.get_ordering(), values])
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        """
+        The direction and the key values of ``cursor``, or None if it is
+        invalid or was made for another ordering.
+        """
+        try:
+            direction, ordering, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if ordering != self.get_ordering() or direction not in ('next', 'previous'):
+                return None
+            return direction, [
+                field.to_python(value) for (field, _), value in zip(self.keys, values)]
+        except (ValueError, TypeError, ValidationError):
+            return None
+
+    def fetch(self, queryset, number, offset=0, has_previous=False, reverse=False):
+        rows = list(queryset[offset:offset + self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+            return KeysetPage(rows, number, self, has_previous=more, has_next=True)
+        return KeysetPage(rows, number, self, has_previous=has_previous, has_next=more)
+
+    def page(self, number=1):
+        try:
+            number = max(int(number), 1)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if self.current_page is None or self.current_page.number != number:
+            self.current_page = self.load_page(number)
+        return self.current_page
+
+    def load_page(self, number):
+        queryset = self.object_list
+        if self.keys is not None:
+            queryset = queryset.order_by(*self.get_ordering())
+        if self.cursor is None:
+            offset = (number - 1) * self.per_page
+            return self.fetch(queryset, number, offset, has_previous=number > 1)
+
+        direction, values = self.cursor
+        reverse = direction == 'previous'
+        queryset = self.object_list.filter(
+            get_keyset_filter(self.keys, values, reverse)
+        ).order_by(*self.get_ordering(reverse))
+        page = self.fetch(queryset, number, has_previous=True, reverse=reverse)
+        if reverse and not page.has_previous():
+            # Went back past the first page, show it in full
+            return self.fetch(self.object_list.order_by(*self.get_ordering()), 1)
+        return page
+
+    @cached_property
+    def count(self):
+        page = self.current_page
+        if page is not None and page.number == 1 and not page.has_next():
+            return len(page)
+        count = self.object_list.order_by().values('pk')[:self.count_limit + 1].count()
+        if count <= self.count_limit:
+            return count
+
+        self.exact = False
+        estimate = estimate_count(self.object_list)
+        if estimate is None or estimate <= self.count_limit:
+            self.lower_bound = True
+            return self.count_limit
+        return estimate
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Change list of the admins paginated by ``KeysetPaginator``.
+    """
+
+    def get_queryset(self, request):
+        # Like the page number, the cursor is not kept by the links of
+        # the filters, search and column headers
+        self.params.pop(CURSOR_VAR, None)
+        return super().get_queryset(request)
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        page = paginator.page(self.page_num + 1)
+        result_count = paginator.count
+
+        if self.model_admin.show_full_result_count:
+            full_result_count = self.root_queryset.count()
+        else:
+            full_result_count = None
+        can_show_all = paginator.exact and result_count <= self.list_max_show_all
+
+        if self.show_all and can_show_all:
+            result_list = self.queryset._clone()
+        else:
+            result_list = page.object_list
+
+        self.page_num = page.number - 1
+        self.result_count = result_count
+        self.show_full_result_count = self.model_admin.show_full_result_count
+        self.show_admin_actions = not self.show_full_result_count or bool(full_result_count)
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = page.has_other_pages()
+        self.paginator = paginator
+        self.page = page
+
+    def get_page_url(self, page_num, cursor):
+        if page_num == 0 or cursor is None:
+            return self.get_query_string(remove=[PAGE_VAR, CURSOR_VAR])
+        return self.get_query_string({PAGE_VAR: page_num, CURSOR_VAR: cursor})
+
+    @property
+    def first_page_url(self):
+        return self.get_page_url(0, None)
+
+    @property
+    def previous_page_url(self):
+        if self.page.has_previous():
+            return self.get_page_url(self.page_num - 1, self.page.previous_cursor)
+        return None
+
+    @property
+    def next_page_url(self):
+        if self.page.has_next():
+            return self.get_page_url(self.page_num + 1, self.page.next_cursor)
+        return None
+
+
+class KeysetPaginationMixin:
+    """
+    Paginate the change list of a ModelAdmin by keyset.
+    """
+    paginator = KeysetPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        return self.paginator(
+            queryset, per_page, orphans, allow_empty_first_page,
+            cursor=request.GET.get(CURSOR_VAR))
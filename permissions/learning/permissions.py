@@ -0,0 +1,117 @@
+from django.db.models import BooleanField, Exists, ExpressionWrapper, OuterRef, Q, QuerySet, Value
+
+from guardian.core import ObjectPermissionChecker
+from guardian.ctypes import get_content_type
+from guardian.shortcuts import get_objects_for_user as guardian_get_objects_for_user
+from guardian.utils import get_group_obj_perms_model, get_user_obj_perms_model
+
+from . import access
+
+
+def get_permission_checker(request):
+    """
+    Return the object permission checker bound to this request.
+
+    The checker keeps every object permission it loads, so all the
+    ``has_*_permission`` calls made while rendering one admin page share
+    the same queries.
+    """
+    if not hasattr(request, '_cached_permission_checker'):
+        checker = ObjectPermissionChecker(request.user)
+        if access.is_store_enabled():
+            checker = access.ObjectPermissionChecker(request.user, checker)
+        request._cached_permission_checker = checker
+    return request._cached_permission_checker
+
+
+def get_permission_filter(user, perm, model):
+    """
+    Condition on the ``model`` objects ``user`` holds the object permission
+    ``perm`` on, to combine with other conditions, see
+    ``get_objects_for_user``.
+    """
+    if access.is_enabled(model):
+        return access.get_filter(user, perm, model)
+    user_model = get_user_obj_perms_model(model)
+    group_model = get_group_obj_perms_model(model)
+    if user_model.objects.is_generic() or group_model.objects.is_generic():
+        return Q(pk__in=guardian_get_objects_for_user(
+            user, perm, model.objects.all(), accept_global_perms=False).values('pk'))
+
+    permission = {
+        'permission__content_type': get_content_type(model),
+        'permission__codename': perm.split('.', 1)[-1],
+    }
+    return (
+        Q(Exists(user_model.objects.filter(
+            user=user, content_object=OuterRef('pk'), **permission))) |
+        Q(Exists(group_model.objects.filter(
+            group__user=user, content_object=OuterRef('pk'), **permission)))
+    )
+
+
+def get_objects_for_user(user, perm, queryset):
+    """
+    Restrict ``queryset`` to the objects ``user`` holds the object
+    permission ``perm`` on, through its user or group permissions.
+    Same result as guardian's ``get_objects_for_user`` with
+    ``accept_global_perms=False``.
+
+    For models with direct FK permission tables the filter is a pair of
+    correlated EXISTS on the integer ``content_object`` column, instead of
+    guardian's ``pk IN (SELECT CAST(...))``, so the database can walk the
+    queryset ordering and stop at the page limit. With the bitmask store
+    the same pair of EXISTS probes the access rows, see learning.access.
+    """
+    if user.is_superuser:
+        return queryset
+
+    model = queryset.model
+    user_model = get_user_obj_perms_model(model)
+    group_model = get_group_obj_perms_model(model)
+    if not access.is_enabled(model) and (
+            user_model.objects.is_generic() or group_model.objects.is_generic()):
+        return guardian_get_objects_for_user(
+            user, perm, queryset, accept_global_perms=False)
+    return queryset.filter(get_permission_filter(user, perm, model))
+
+
+def get_object_permissions(user, perm, objects, accept_global_perms=True):
+    """
+    Whether ``user`` holds ``perm`` on each of ``objects``, a queryset or
+    a list of instances of one model, as a mapping of primary key to
+    boolean. The object permissions of the user and of its groups are
+    read in one query, where a ``has_perm`` per object costs one each.
+
+    The global permission, granted by the role templates and served from
+    the permission cache, grants every object unless
+    ``accept_global_perms`` is False.
+    """
+    if isinstance(objects, QuerySet):
+        model, queryset = objects.model, objects
+    else:
+        objects = list(objects)
+        if not objects:
+            return {}
+        model, queryset = type(objects[0]), None
+
+    codename = perm.split('.', 1)[-1]
+    if not user.is_active:
+        granted = False
+    elif user.is_superuser:
+        granted = True
+    elif accept_global_perms and user.has_perm(f'{model._meta.app_label}.{codename}'):
+        granted = True
+    else:
+        granted = None
+
+    if queryset is None:
+        if granted is not None:
+            return {obj.pk: granted for obj in objects}
+        queryset = model.objects.filter(pk__in=[obj.pk for obj in objects])
+    if granted is None:
+        granted = ExpressionWrapper(
+            get_permission_filter(user, codename, model), output_field=BooleanField())
+    else:
+        granted = Value(granted, output_field=BooleanField())
+    return dict(queryset.annotate(permission_granted=granted).values_list('pk', 'permission_granted'))
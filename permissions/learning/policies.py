@@ -0,0 +1,159 @@
+"""
+Declarative visibility policy of the admin.
+
+A ``Rule`` grants the users of some roles, in companies of some types, an
+action on the objects of some models, chosen by their relation to the
+company of the user in the tree: ``ALL`` objects, those of its ``OWN``
+company, of its ``CHILDREN`` or of its ``DESCENDANTS`` at any depth,
+``SELF`` for the user itself, or ``GRANTED`` for the objects it holds the
+object permission on. Like the tree relations, ``GRANTED`` stays within
+the tenant of the user, its company and the companies below it: an object
+permission on an object of another tenant does not make it visible. An
+optional ``condition`` narrows the objects further.
+
+``get_predicate`` compiles the rules matching a user into one ``Q`` of
+plain lookups and ``Exists`` on the company closure, evaluated by the
+database with the rest of the query, so the tree rules need no object
+permission rows. The rules matching a model, action, role and company
+type are selected once per process.
+"""
+import operator
+from collections import namedtuple
+from functools import lru_cache, reduce
+
+from django.contrib.auth import get_user_model
+from django.db.models import Exists, OuterRef, Q
+
+from .models import Bot, Company, CompanyClosure
+from .permissions import get_permission_filter
+
+
+User = get_user_model()
+
+ALL = 'all'
+OWN = 'own'
+CHILDREN = 'children'
+DESCENDANTS = 'descendants'
+SELF = 'self'
+GRANTED = 'granted'
+
+# ``roles`` and ``company_types`` of None match any
+Rule = namedtuple(
+    'Rule',
+    ['description', 'models', 'actions', 'relation', 'roles', 'company_types', 'condition'],
+    defaults=(None, None, None))
+
+# Field of each model holding the company of its objects
+COMPANY_FIELDS = {
+    Bot: 'company',
+    Company: 'pk',
+    User: 'company',
+}
+
+RULES = (
+    Rule(
+        'Botxo staff can view everything',
+        models=(Bot, Company, User), actions=('view',), relation=ALL,
+        company_types=(Company.Type.BOTXO,)),
+    Rule(
+        'Agency admins can view the users, bots and companies of their descendant companies',
+        models=(Bot, Company, User), actions=('view',), relation=DESCENDANTS,
+        roles=(User.Role.ADMIN,), company_types=(Company.Type.AGENCY,)),
+    Rule(
+        'Admins can view the users of their company',
+        models=(User,), actions=('view',), relation=OWN,
+        roles=(User.Role.ADMIN,)),
+    Rule(
+        'Users can view their company and its bots',
+        models=(Bot, Company), actions=('view',), relation=OWN),
+    Rule(
+        'Users can view the admins of their company',
+        models=(User,), actions=('view',), relation=OWN,
+        condition=Q(role=User.Role.ADMIN)),
+    Rule(
+        'Users can view themselves',
+        models=(User,), actions=('view',), relation=SELF),
+    Rule(
+        'Users can view what was shared with them',
+        models=(Bot, Company, User), actions=('view',), relation=GRANTED),
+)
+
+
+@lru_cache(maxsize=None)
+def compile_rules(model, action, role, company_type):
+    """
+    The (relation, condition) pairs of the rules granting ``action`` on
+    ``model`` to a user of ``role`` in a company of ``company_type``.
+    An unconditional ALL rule makes the others irrelevant.
+    """
+    terms = []
+    for rule in RULES:
+        if model not in rule.models or action not in rule.actions:
+            continue
+        if rule.roles is not None and role not in rule.roles:
+            continue
+        if rule.company_types is not None and company_type not in rule.company_types:
+            continue
+        if rule.relation == ALL and rule.condition is None:
+            return ((ALL, None),)
+        if (rule.relation, rule.condition) not in terms:
+            terms.append((rule.relation, rule.condition))
+    return tuple(terms)
+
+
+def get_relation(user, model, action, relation):
+    """
+    Condition on the ``model`` objects in ``relation`` with ``user``, or
+    None when the relation does not apply to it.
+    """
+    if relation == ALL:
+        return Q()
+    if relation == SELF:
+        return Q(pk=user.pk) if model is User else None
+    if user.company_id is None:
+        return None
+    if relation == GRANTED:
+        return (
+            get_permission_filter(user, f'{action}_{model._meta.model_name}', model) &
+            get_relation(user, model, action, DESCENDANTS))
+    field = COMPANY_FIELDS[model]
+    if relation == OWN:
+        return Q(**{field: user.company_id})
+    if relation == CHILDREN:
+        return Q(**{f'{field}__in': Company.objects.filter(
+            tn_parent=user.company_id).values('pk')})
+    if relation == DESCENDANTS:
+        return Q(Exists(CompanyClosure.objects.filter(
+            ancestor=user.company_id, descendant=OuterRef(field))))
+    raise ValueError(f'Unknown relation {relation!r}')
+
+
+def get_predicate(user, model, action='view'):
+    """
+    One condition on the ``model`` objects ``user`` may ``action``
+    according to the RULES. Superusers may act on everything.
+    """
+    if user.is_superuser:
+        return Q()
+    company_type = user.company.type if user.company_id is not None else None
+    conditions = []
+    for relation, condition in compile_rules(model, action, user.role, company_type):
+        predicate = get_relation(user, model, action, relation)
+        if predicate is None:
+            continue
+        if condition is not None:
+            predicate &= condition
+        if not predicate:
+            # Unconditional ALL
+            return Q()
+        conditions.append(predicate)
+    if not conditions:
+        return Q(pk__in=[])
+    return reduce(operator.or_, conditions)
+
+
+def filter_queryset(user, queryset, action='view'):
+    """
+    Restrict ``queryset`` to the objects ``user`` may ``action``.
+    """
+    return queryset.filter(get_predicate(user, queryset.model, action))
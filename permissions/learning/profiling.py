@@ -0,0 +1,260 @@
+"""
+Sampled request profiler, cheap enough to stay on in production.
+
+``RequestProfilerMiddleware`` profiles a fraction ``SAMPLE_RATE`` of the
+requests under ``PATH_PREFIXES``, and every request slower than
+``SLOW_REQUEST_MS``. A profile holds the SQL queries of the request and
+the stacks sampled every ``STACK_INTERVAL_MS`` by a background thread,
+from the start of a sampled request or from the moment a request turns
+slow. The last ``BUFFER_SIZE`` profiles are kept in memory, for the admin
+page of ``learning.views.profiles_view``, and appended asynchronously as
+JSON lines to ``OUTPUT``.
+
+Configure it with the ``REQUEST_PROFILER`` setting, see DEFAULTS.
+"""
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+
+
+DEFAULTS = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 0.01,
+    'SLOW_REQUEST_MS': 1000,
+    'PATH_PREFIXES': ('/admin/',),
+    'BUFFER_SIZE': 200,
+    'MAX_QUERIES': 200,
+    'STACK_INTERVAL_MS': 10,
+    'STACK_DEPTH': 30,
+    'OUTPUT': None,
+    'FLUSH_INTERVAL': 5,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'REQUEST_PROFILER', {})}
+
+
+class ActiveRequest:
+    """
+    Queries and stack samples of a request being profiled.
+    """
+
+    def __init__(self, request, sampled, config):
+        self.request = request
+        self.sampled = sampled
+        self.max_queries = config['MAX_QUERIES']
+        self.stack_depth = config['STACK_DEPTH']
+        self.start = time.perf_counter()
+        self.started_at = datetime.now(timezone.utc)
+        self.queries = []
+        self.query_count = 0
+        self.query_ms = 0.0
+        self.stacks = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = (time.perf_counter() - start) * 1000
+            self.query_count += 1
+            self.query_ms += duration
+            if len(self.queries) < self.max_queries:
+                self.queries.append({'sql': sql, 'ms': round(duration, 3)})
+
+    def add_stack(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.stack_depth:
+            code = frame.f_code
+            stack.append(f'{code.co_filename}:{frame.f_lineno} {code.co_name}')
+            frame = frame.f_back
+        self.stacks[tuple(reversed(stack))] += 1
+
+    def finish(self, response):
+        duration = (time.perf_counter() - self.start) * 1000
+        return {
+            'id': uuid.uuid4().hex,
+            'method': self.request.method,
+            'path': self.request.get_full_path(),
+            'status': getattr(response, 'status_code', None),
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': round(duration, 2),
+            'sampled': self.sampled,
+            'query_count': self.query_count,
+            'query_ms': round(self.query_ms, 2),
+            'queries': self.queries,
+            'stacks': [
+                {'count': count, 'frames': list(stack)}
+                for stack, count in self.stacks.most_common()
+            ],
+        }
+
+
+class StackSampler(threading.Thread):
+    """
+    Sample the stack of the threads serving a profiled request: sampled
+    requests from their start, the others once they are slow.
+    """
+
+    def __init__(self, interval, slow_after):
+        super().__init__(name='request-profiler-sampler', daemon=True)
+        self.interval = interval
+        self.slow_after = slow_after
+        self.active = {}
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.active:
+                continue
+            frames = sys._current_frames()
+            now = time.perf_counter()
+            for thread_id, active in list(self.active.items()):
+                frame = frames.get(thread_id)
+                if frame is not None and (
+                        active.sampled or now - active.start >= self.slow_after):
+                    active.add_stack(frame)
+
+
+class ProfileRecorder:
+    """
+    Ring buffer of the recent profiles, flushed as JSON lines to ``output``
+    by a background thread every ``flush_interval`` seconds.
+    """
+
+    def __init__(self, size, output=None, flush_interval=5):
+        self.lock = threading.Lock()
+        self.profiles = deque(maxlen=size)
+        self.pending = deque(maxlen=size)
+        self.output = output
+        self.flush_interval = flush_interval
+        self.flusher = None
+
+    def add(self, profile):
+        with self.lock:
+            self.profiles.append(profile)
+            if self.output:
+                self.pending.append(profile)
+                if self.flusher is None:
+                    self.flusher = threading.Thread(
+                        target=self.flush_forever, name='request-profiler-flusher', daemon=True)
+                    self.flusher.start()
+
+    def flush(self):
+        with self.lock:
+            profiles = list(self.pending)
+            self.pending.clear()
+        if profiles:
+            with open(self.output, 'a', encoding='utf-8') as f:
+                for profile in profiles:
+                    f.write(json.dumps(profile) + '\n')
+
+    def flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def get_slowest(self, limit=50):
+        with self.lock:
+            profiles = list(self.profiles)
+        return sorted(profiles, key=lambda profile: profile['duration_ms'], reverse=True)[:limit]
+
+    def get(self, profile_id):
+        with self.lock:
+            return next(
+                (profile for profile in self.profiles if profile['id'] == profile_id), None)
+
+
+recorder = None
+sampler = None
+
+# Held while the recorder and the sampler are replaced, so that concurrent
+# first requests start a single sampler
+setup_lock = threading.RLock()
+
+
+def setup(config=None):
+    """
+    Create the recorder and the stack sampler of this process, stopping
+    the previous sampler.
+    """
+    global recorder, sampler
+    config = config or get_config()
+    with setup_lock:
+        if sampler is not None:
+            sampler.stop()
+        recorder = ProfileRecorder(
+            config['BUFFER_SIZE'], config['OUTPUT'], config['FLUSH_INTERVAL'])
+        sampler = None
+        if config['STACK_INTERVAL_MS']:
+            sampler = StackSampler(
+                config['STACK_INTERVAL_MS'] / 1000, config['SLOW_REQUEST_MS'] / 1000)
+            sampler.start()
+
+
+def get_profiler(config):
+    """
+    Return the recorder and the sampler, set up on the first call.
+    """
+    with setup_lock:
+        if recorder is None:
+            setup(config)
+        return recorder, sampler
+
+
+@receiver(setting_changed)
+def reset_profiler(setting, **kwargs):
+    global recorder, sampler
+    if setting == 'REQUEST_PROFILER':
+        with setup_lock:
+            if sampler is not None:
+                sampler.stop()
+            recorder = sampler = None
+
+
+class RequestProfilerMiddleware:
+    """
+    Profile the requests selected by the ``REQUEST_PROFILER`` setting.
+    Place it first, to include the time of the other middlewares.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        config = get_config()
+        if not config['ENABLED'] or not request.path.startswith(tuple(config['PATH_PREFIXES'])):
+            return self.get_response(request)
+
+        profile_recorder, stack_sampler = get_profiler(config)
+        active = ActiveRequest(request, random.random() < config['SAMPLE_RATE'], config)
+        thread_id = threading.get_ident()
+        if stack_sampler is not None:
+            stack_sampler.active[thread_id] = active
+        response = None
+        try:
+            with connection.execute_wrapper(active):
+                response = self.get_response(request)
+        finally:
+            if stack_sampler is not None:
+                stack_sampler.active.pop(thread_id, None)
+            profile = active.finish(response)
+            if active.sampled or profile['duration_ms'] >= config['SLOW_REQUEST_MS']:
+                profile_recorder.add(profile)
+        return response
@@ -0,0 +1,619 @@
+"""
+Set-based provisioning of the per-object permission groups.
+
+Every user and company owns a Read, a Write and an Own group holding the
+object permissions on that instance, registered in PermissionGroup. Users
+are also members of their role template, of their own Read and Own groups
+and of the groups of their company allowed by the template. The helpers
+below create all of that for one or many instances with a handful of
+``bulk_create`` statements instead of one
+``get_or_create``/``assign_perm``/``groups.add`` per row.
+
+``grant_template`` shares a user's groups with other users the way a
+role template prescribes, in chunks of users.
+
+With ``ACCESS_SCOPE = 'tenant'`` every company also owns the groups of
+``TENANT_ACCESS_LEVELS``, holding their permissions on each user and bot
+of the company, and a Members group joined by its users. An Admin joins
+the tenant groups of the companies of its tree and their Members groups
+may view the Admin, a few rows per company whatever the number of users,
+where ``grant_template`` inserts rows per user. ``collapse_tenant_grants``
+moves the existing per-user grants of the Admins to the tenant groups.
+
+``schedule_group_deletion`` tears the groups and search index entries of
+deleted instances down once the transaction commits, for every instance
+of a cascade or a queryset delete together, with a few DELETE statements
+per chunk.
+"""
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.db import connections, transaction
+from django.db.models import Case, Value, When
+
+from guardian.ctypes import get_content_type
+from guardian.models import GroupObjectPermission
+from guardian.utils import get_group_obj_perms_model
+
+from . import access, metrics, search
+from .backends import bump_versions
+from .models import (
+    Company, PermissionGroup, BotGroupObjectPermission,
+    CompanyGroupObjectPermission, UserGroupObjectPermission,
+    BotAccess, CompanyAccess, UserAccess)
+
+
+# Actions granted on the instance by each of its permission groups
+ACCESS_LEVELS = {
+    PermissionGroup.AccessLevel.READ: ('view',),
+    PermissionGroup.AccessLevel.WRITE: ('change', 'delete'),
+    PermissionGroup.AccessLevel.OWN: ('change',),
+}
+
+# Search index of the models with one, see learning.search
+SEARCH_INDEXES = {
+    get_user_model(): search.USER_INDEX,
+    Company: search.COMPANY_INDEX,
+}
+
+ROLE_TEMPLATES = {
+    'ED': 'Employee Permissions Template',
+    'AD': 'Admin Permissions Template',
+    'AG': 'Agent Permissions Template',
+}
+
+# Groups of the granting user that the users of each template join
+TEMPLATE_ACCESS_LEVELS = {
+    'Admin Permissions Template': (
+        PermissionGroup.AccessLevel.READ,
+    ),
+    'Agent Permissions Template': (
+        PermissionGroup.AccessLevel.READ,
+        PermissionGroup.AccessLevel.WRITE,
+    ),
+    'Employee Permissions Template': (
+        PermissionGroup.AccessLevel.READ,
+        PermissionGroup.AccessLevel.WRITE,
+    ),
+}
+
+# Templates whose granting user also joins the object permission groups
+# of the users
+INHERITING_TEMPLATES = {'Admin Permissions Template'}
+
+# Actions granted on every user and bot of a company by its tenant groups,
+# which the Admins of the company tree join
+TENANT_ACCESS_LEVELS = {
+    PermissionGroup.AccessLevel.TENANT_READ: ('view',),
+    PermissionGroup.AccessLevel.TENANT_OWN: ('change',),
+}
+
+# Actions granted on the Admins of the company tree to the Members group
+MEMBERS_ACTIONS = ('view',)
+
+TENANT_GROUPS = (*TENANT_ACCESS_LEVELS, PermissionGroup.AccessLevel.MEMBERS)
+
+BATCH_SIZE = 1000
+
+GrantCount = namedtuple('GrantCount', ('inserted', 'present'))
+
+
+def get_group_prefix(instance):
+    """
+    Groups are named by the username of a User and
+    by the name attribute of any other instance.
+    """
+    if isinstance(instance, get_user_model()):
+        return instance.username
+    return instance.name
+
+
+def is_tenant_scope():
+    return getattr(settings, 'ACCESS_SCOPE', 'user') == 'tenant'
+
+
+def get_group_access_levels(model):
+    """
+    Access levels of the groups owned by every ``model`` instance.
+    """
+    if model is Company and is_tenant_scope():
+        return [*ACCESS_LEVELS, *TENANT_GROUPS]
+    return list(ACCESS_LEVELS)
+
+
+def get_group_name(instance, access_level):
+    """
+    Readable and unique group name. Lookups go through the
+    PermissionGroup registry, the name is only for display.
+    """
+    return (
+        f"{get_group_prefix(instance)[:100]} "
+        f"({instance._meta.model_name} {instance.pk}): {access_level}"
+    )
+
+
+def provision_groups(instances):
+    """
+    Create and register the Read, Write and Own groups of every instance,
+    and the tenant groups of companies in the tenant scope, and assign
+    their object permissions. ``instances`` must share the same model.
+    Existing groups and permissions are left untouched.
+
+    Return a mapping of (pk, access level) to group id.
+    """
+    instances = list(instances)
+    if not instances:
+        return {}
+
+    start = time.perf_counter()
+    model = type(instances[0])
+    ctype = get_content_type(model)
+    access_levels = get_group_access_levels(model)
+    group_ids = PermissionGroup.objects.get_group_ids(
+        model, [instance.pk for instance in instances], access_levels)
+
+    missing = {
+        get_group_name(instance, access_level): (instance, access_level)
+        for instance in instances
+        for access_level in access_levels
+        if (instance.pk, access_level) not in group_ids
+    }
+    if missing:
+        Group.objects.bulk_create(
+            [Group(name=name) for name in missing],
+            batch_size=BATCH_SIZE,
+            ignore_conflicts=True)
+        created = Group.objects.filter(
+            name__in=missing).values_list('name', 'pk')
+        registry = []
+        for name, group_id in created:
+            instance, access_level = missing[name]
+            group_ids[instance.pk, access_level] = group_id
+            registry.append(PermissionGroup(
+                content_type=ctype,
+                object_pk=str(instance.pk),
+                access_level=access_level,
+                group_id=group_id))
+        PermissionGroup.objects.bulk_create(
+            registry, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+    add_group_object_permissions(model, {
+        (instance.pk, group_ids[instance.pk, access_level]): actions
+        for instance in instances
+        for access_level, actions in ACCESS_LEVELS.items()
+    })
+
+    labels = {'step': 'groups', 'model': model._meta.model_name}
+    metrics.provisioning.observe(time.perf_counter() - start, **labels)
+    metrics.provisioned_instances.inc(len(instances), **labels)
+    return group_ids
+
+
+def add_group_object_permissions(model, grants):
+    """
+    Give groups object permissions on ``model`` instances, ``grants``
+    mapping (pk, group id) to the actions granted: guardian rows, one per
+    codename, or one row per group and instance in the bitmask store.
+    Existing permissions are left untouched.
+    """
+    if not grants:
+        return
+    name = model._meta.model_name
+    if access.is_enabled(model):
+        access.add_access(model, {
+            (pk, 'group', group_id): access.get_bits(
+                model, [f'{action}_{name}' for action in actions])
+            for (pk, group_id), actions in grants.items()
+        }, batch_size=BATCH_SIZE)
+        return
+
+    ctype = get_content_type(model)
+    codenames = {
+        f'{action}_{name}'
+        for actions in grants.values()
+        for action in actions
+    }
+    permission_ids = dict(Permission.objects.filter(
+        content_type=ctype,
+        codename__in=codenames).values_list('codename', 'pk'))
+
+    group_model = get_group_obj_perms_model(model)
+    if group_model.objects.is_generic():
+        def target(pk):
+            return {'content_type': ctype, 'object_pk': str(pk)}
+    else:
+        def target(pk):
+            return {'content_object_id': pk}
+
+    rows = [
+        group_model(
+            group_id=group_id,
+            permission_id=permission_ids[f'{action}_{name}'],
+            **target(pk))
+        for (pk, group_id), actions in grants.items()
+        for action in actions
+    ]
+    group_model.objects.bulk_create(
+        rows, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def get_template_codenames(template_names):
+    """
+    Return a mapping of template name to the codenames it grants.
+    """
+    codenames = defaultdict(set)
+    permissions = Permission.objects.filter(
+        group__name__in=template_names).values_list('group__name', 'codename')
+    for name, codename in permissions:
+        codenames[name].add(codename)
+    return codenames
+
+
+def get_company_access_levels(codenames):
+    """
+    Company groups a role template gives access to,
+    see User.grant_own_company_permissions.
+    """
+    access_levels = []
+    if 'view_company' in codenames:
+        access_levels.append(PermissionGroup.AccessLevel.READ)
+    if 'change_company' in codenames and 'delete_company' not in codenames:
+        access_levels.append(PermissionGroup.AccessLevel.OWN)
+    return access_levels
+
+
+def provision_tenant_access(instances):
+    """
+    Give the tenant groups of their company access to ``instances``, users
+    or bots of the same model. The company groups must have been
+    provisioned already.
+    """
+    instances = [instance for instance in instances if instance.company_id is not None]
+    if not instances:
+        return
+
+    start = time.perf_counter()
+    group_ids = PermissionGroup.objects.get_group_ids(
+        Company, {instance.company_id for instance in instances}, TENANT_ACCESS_LEVELS)
+    add_group_object_permissions(type(instances[0]), {
+        (instance.pk, group_ids[instance.company_id, access_level]): actions
+        for instance in instances
+        for access_level, actions in TENANT_ACCESS_LEVELS.items()
+        if (instance.company_id, access_level) in group_ids
+    })
+
+    labels = {'step': 'tenant', 'model': instances[0]._meta.model_name}
+    metrics.provisioning.observe(time.perf_counter() - start, **labels)
+    metrics.provisioned_instances.inc(len(instances), **labels)
+
+
+def get_tenant_grants(admin_companies, group_ids):
+    """
+    The memberships and object permissions on the Admins giving Admins
+    access to companies through their tenant groups. ``admin_companies``
+    are (Admin pk, company pk) pairs, ``group_ids`` maps (company pk,
+    access level) to the tenant group ids.
+    """
+    memberships = set()
+    grants = {}
+    for admin_pk, company_pk in admin_companies:
+        memberships.update(
+            (admin_pk, group_ids[company_pk, access_level])
+            for access_level in TENANT_ACCESS_LEVELS
+            if (company_pk, access_level) in group_ids)
+        members_id = group_ids.get((company_pk, PermissionGroup.AccessLevel.MEMBERS))
+        if members_id is not None:
+            grants[admin_pk, members_id] = MEMBERS_ACTIONS
+    return memberships, grants
+
+
+def grant_tenant(admin, company_ids):
+    """
+    Give the Admin ``admin`` access to the users and bots of the companies
+    ``company_ids`` and their users access to ``admin``, through the
+    tenant groups of the companies: a few rows per company whatever their
+    number of users. Return a GrantCount of the memberships.
+    """
+    start = time.perf_counter()
+    company_ids = list(company_ids)
+    group_ids = PermissionGroup.objects.get_group_ids(Company, company_ids, TENANT_GROUPS)
+    memberships, grants = get_tenant_grants(
+        [(admin.pk, company_id) for company_id in company_ids], group_ids)
+    Membership = get_user_model().groups.through
+    count = insert_memberships(memberships, Membership.objects.filter(
+        user_id=admin.pk, group_id__in={group_id for _, group_id in memberships}))
+    add_group_object_permissions(type(admin), grants)
+    if grants:
+        # Every member of the companies may now view the Admin
+        bump_versions()
+
+    metrics.grants.observe(time.perf_counter() - start, template='Tenant')
+    metrics.grant_memberships.inc(count.inserted, template='Tenant', result='inserted')
+    metrics.grant_memberships.inc(count.present, template='Tenant', result='present')
+    return count
+
+
+def provision_memberships(users):
+    """
+    Add every user to its role template, to its own Read and Own groups
+    and to the groups of its company granted by the template. In the
+    tenant scope every user also joins the Members group of its company
+    and an Admin its tenant groups, and the tenant groups get access to
+    the users. The user and company groups must have been provisioned
+    already.
+    """
+    users = [user for user in users if user.role in ROLE_TEMPLATES]
+    if not users:
+        return 0
+
+    start = time.perf_counter()
+    templates = {ROLE_TEMPLATES[user.role] for user in users}
+    template_ids = dict(
+        Group.objects.filter(name__in=templates).values_list('name', 'pk'))
+    template_codenames = get_template_codenames(templates)
+
+    own_access_levels = [
+        PermissionGroup.AccessLevel.READ,
+        PermissionGroup.AccessLevel.OWN,
+    ]
+    tenant_scope = is_tenant_scope()
+    user_group_ids = PermissionGroup.objects.get_group_ids(
+        type(users[0]), [user.pk for user in users], own_access_levels)
+    company_group_ids = PermissionGroup.objects.get_group_ids(
+        Company,
+        {user.company_id for user in users if user.company_id is not None},
+        [*own_access_levels, *TENANT_GROUPS] if tenant_scope else own_access_levels)
+
+    memberships = set()
+    grants = {}
+    for user in users:
+        template = ROLE_TEMPLATES[user.role]
+        group_ids = [template_ids.get(template)]
+        group_ids.extend(
+            user_group_ids.get((user.pk, access_level))
+            for access_level in own_access_levels)
+        if user.company_id is not None:
+            group_ids.extend(
+                company_group_ids.get((user.company_id, access_level))
+                for access_level in get_company_access_levels(
+                    template_codenames[template]))
+            if tenant_scope:
+                group_ids.append(company_group_ids.get(
+                    (user.company_id, PermissionGroup.AccessLevel.MEMBERS)))
+                grants.update(
+                    ((user.pk, company_group_ids[user.company_id, access_level]), actions)
+                    for access_level, actions in TENANT_ACCESS_LEVELS.items()
+                    if (user.company_id, access_level) in company_group_ids)
+        memberships.update(
+            (user.pk, group_id) for group_id in group_ids
+            if group_id is not None)
+
+    if tenant_scope:
+        # The companies below its own are granted by the admin_onboarding job
+        admin_memberships, admin_grants = get_tenant_grants([
+            (user.pk, user.company_id) for user in users
+            if user.role == user.Role.ADMIN and user.company_id is not None
+        ], company_group_ids)
+        memberships.update(admin_memberships)
+        grants.update(admin_grants)
+        add_group_object_permissions(type(users[0]), grants)
+
+    Membership = get_user_model().groups.through
+    Membership.objects.bulk_create(
+        [Membership(user_id=user_id, group_id=group_id)
+         for user_id, group_id in memberships],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True)
+    # bulk_create does not send m2m_changed nor post_save
+    bump_versions(None if grants else [user.pk for user in users])
+
+    labels = {'step': 'memberships', 'model': users[0]._meta.model_name}
+    metrics.provisioning.observe(time.perf_counter() - start, **labels)
+    metrics.provisioned_instances.inc(len(users), **labels)
+    return len(memberships)
+
+
+def rename_groups(instance):
+    """
+    Rename the permission groups of an instance whose name changed,
+    keeping their members and object permissions.
+    """
+    registered = list(PermissionGroup.objects.for_instance(
+        instance).values_list('group_id', 'access_level'))
+    if not registered:
+        return 0
+    return Group.objects.filter(
+        pk__in=[group_id for group_id, _ in registered]
+    ).update(name=Case(*[
+        When(pk=group_id, then=Value(get_group_name(instance, access_level)))
+        for group_id, access_level in registered
+    ]))
+
+
+def insert_memberships(memberships, existing):
+    """
+    Insert the (user id, group id) pairs of ``memberships`` missing from
+    the ``existing`` membership queryset. Return a GrantCount.
+    """
+    if not memberships:
+        return GrantCount(0, 0)
+    present = memberships & set(existing.values_list('user_id', 'group_id'))
+    Membership = get_user_model().groups.through
+    missing = memberships - present
+    Membership.objects.bulk_create(
+        [Membership(user_id=user_id, group_id=group_id)
+         for user_id, group_id in missing],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True)
+    # bulk_create does not send m2m_changed
+    if missing:
+        bump_versions({user_id for user_id, _ in missing})
+    return GrantCount(len(missing), len(present))
+
+
+def grant_template(user, template, users, chunk_size=BATCH_SIZE):
+    """
+    Give the ``users`` queryset the access of ``template`` to ``user``:
+    they join the groups of ``user`` listed in TEMPLATE_ACCESS_LEVELS and,
+    for INHERITING_TEMPLATES, ``user`` joins their object permission
+    groups. Users are read by primary key in chunks of ``chunk_size``, so
+    memory does not grow with ``users``.
+
+    Return a GrantCount of the memberships inserted and already present.
+    """
+    if template not in TEMPLATE_ACCESS_LEVELS:
+        raise ValueError(f"Unknown permission template {template!r}")
+
+    start = time.perf_counter()
+    Membership = get_user_model().groups.through
+    own_group_ids = set(PermissionGroup.objects.get_group_ids(
+        type(user), [user.pk], TEMPLATE_ACCESS_LEVELS[template]).values())
+    user_ids = users.order_by('pk').values_list('pk', flat=True)
+
+    inserted = present = 0
+    last_pk = None
+    while True:
+        chunk = user_ids if last_pk is None else user_ids.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1]
+
+        counts = [insert_memberships(
+            {(user_id, group_id) for user_id in chunk for group_id in own_group_ids},
+            Membership.objects.filter(user_id__in=chunk, group_id__in=own_group_ids))]
+        if template in INHERITING_TEMPLATES:
+            group_ids = Membership.objects.filter(
+                user_id__in=chunk,
+                group__permission_group__isnull=False,
+            ).values_list('group_id', flat=True).distinct()
+            counts.append(insert_memberships(
+                {(user.pk, group_id) for group_id in group_ids},
+                Membership.objects.filter(user_id=user.pk, group_id__in=group_ids)))
+
+        inserted += sum(count.inserted for count in counts)
+        present += sum(count.present for count in counts)
+
+    metrics.grants.observe(time.perf_counter() - start, template=template)
+    metrics.grant_memberships.inc(inserted, template=template, result='inserted')
+    metrics.grant_memberships.inc(present, template=template, result='present')
+    return GrantCount(inserted, present)
+
+
+# Object permissions held by the groups, in guardian and in the bitmask
+# store, their delete signals only bump the permission caches
+GROUP_OBJECT_PERMISSION_MODELS = (
+    GroupObjectPermission,
+    BotGroupObjectPermission,
+    CompanyGroupObjectPermission,
+    UserGroupObjectPermission,
+    BotAccess,
+    CompanyAccess,
+    UserAccess,
+)
+
+
+def delete_rows(model, field, values, using='default'):
+    """
+    Delete the ``model`` rows whose ``field`` is in ``values`` with one
+    DELETE statement, without loading them nor sending their signals.
+    """
+    if not values:
+        return
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    field = model._meta.get_field(field)
+    placeholders = ', '.join(['%s'] * len(values))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {quote_name(model._meta.db_table)} '
+            f'WHERE {quote_name(field.column)} IN ({placeholders})',
+            [field.get_db_prep_value(value, connection) for value in values])
+
+
+def delete_groups(model, pks, chunk_size=BATCH_SIZE):
+    """
+    Delete the permission groups of the ``model`` instances ``pks``, with
+    their object permissions, registry entries, memberships and group
+    permissions, one chunk of instances per transaction.
+
+    The object permissions and registry entries are deleted by
+    ``delete_rows``, so without their per-row signals: the registry cache
+    is evicted and the permission caches are bumped once instead. What is
+    left has no signals nor cascades, the collector of the groups deletes
+    it with a statement per table.
+
+    Return the number of groups deleted.
+    """
+    start = time.perf_counter()
+    ctype = get_content_type(model)
+    object_pks = [str(pk) for pk in pks]
+    deleted = 0
+    for offset in range(0, len(object_pks), chunk_size):
+        registered = PermissionGroup.objects.filter(
+            content_type=ctype, object_pk__in=object_pks[offset:offset + chunk_size])
+        with transaction.atomic():
+            entries = list(registered.values_list('object_pk', 'access_level', 'group_id'))
+            if not entries:
+                continue
+            group_ids = [group_id for _, _, group_id in entries]
+            for group_model in (*GROUP_OBJECT_PERMISSION_MODELS, PermissionGroup):
+                delete_rows(group_model, 'group', group_ids, registered.db)
+            Group.objects.filter(pk__in=group_ids).delete()
+        for object_pk, access_level, _ in entries:
+            PermissionGroup.objects.evict(PermissionGroup(
+                content_type=ctype, object_pk=object_pk, access_level=access_level))
+        deleted += len(group_ids)
+
+    if deleted:
+        bump_versions()
+    labels = {'step': 'teardown', 'model': model._meta.model_name}
+    metrics.provisioning.observe(time.perf_counter() - start, **labels)
+    metrics.provisioned_instances.inc(len(object_pks), **labels)
+    return deleted
+
+
+# Per thread and database, the instances deleted since the last flush
+_deletions = threading.local()
+
+
+def get_deletion_queue(using):
+    queues = _deletions.__dict__.setdefault('queues', {})
+    return queues.setdefault(using, defaultdict(set))
+
+
+def schedule_group_deletion(instance, using='default'):
+    """
+    Delete the permission groups and search index entry of the deleted
+    ``instance`` once the transaction commits, with those of the other
+    deleted instances, see ``flush_group_deletions``.
+    """
+    get_deletion_queue(using)[type(instance)].add(instance.pk)
+    transaction.on_commit(lambda: flush_group_deletions(using), using)
+
+
+def flush_group_deletions(using='default'):
+    """
+    Tear down the instances queued by ``schedule_group_deletion``.
+
+    Every deletion registers this hook: the first one to run after the
+    commit empties the queue, the others find it empty. The instances of
+    a rolled back transaction or savepoint stay queued until the next
+    flush, which drops them as they still exist, or as they were created
+    in the rolled back transaction and own no groups.
+    """
+    queue = get_deletion_queue(using)
+    batch = {model: queue.pop(model) for model in list(queue)}
+    for model, pks in batch.items():
+        remaining = set(model._base_manager.using(using).filter(
+            pk__in=pks).values_list('pk', flat=True))
+        pks = [pk for pk in pks if pk not in remaining]
+        if not pks:
+            continue
+        delete_groups(model, pks)
+        if model in SEARCH_INDEXES:
+            search.delete_from_index(SEARCH_INDEXES[model], pks, using)
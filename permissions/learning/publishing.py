@@ -0,0 +1,95 @@
+"""
+Publishing of bots.
+
+The admin action tells in one query which bots of the selection the
+user may publish, through the global ``publish_bot`` permission or an
+object permission on the bot, with
+``learning.permissions.get_object_permissions``. ``publish_permitted``
+publishes the permitted bots with one UPDATE per chunk. Selections of
+more than ``INLINE_LIMIT`` permitted bots are published by the background
+job ``publish_bots_task`` instead, whose progress shows in the jobs
+admin. The job checks the permission again in the UPDATE of every chunk,
+as it may have been revoked since.
+"""
+import logging
+from collections import namedtuple
+
+from django.contrib.auth import get_user_model
+from django.db import models
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .jobs import Task
+from .models import Bot
+from .permissions import get_objects_for_user
+
+
+logger = logging.getLogger(__name__)
+
+PERMISSION = 'learning.publish_bot'
+
+CHUNK_SIZE = 1000
+
+# Larger selections are published by a background job
+INLINE_LIMIT = 10000
+
+PublishCount = namedtuple('PublishCount', ['published', 'skipped'])
+
+
+def get_publishable(user, queryset):
+    """
+    Restrict ``queryset`` to the bots ``user`` may publish.
+    """
+    if user.has_perm(PERMISSION):
+        return queryset
+    return get_objects_for_user(user, PERMISSION, queryset)
+
+
+def publish_chunk(publishable, pks):
+    """
+    Publish the bots of ``pks`` in ``publishable`` with one UPDATE and
+    return their number. Bots published before keep their date.
+    """
+    now = models.Value(timezone.now(), output_field=models.DateTimeField())
+    return publishable.filter(pk__in=pks).update(
+        published_at=Coalesce('published_at', now))
+
+
+def publish_permitted(permitted, chunk_size=CHUNK_SIZE):
+    """
+    Publish the bots of ``permitted``, a mapping of bot pk to whether the
+    user may publish it from learning.permissions.get_object_permissions,
+    one UPDATE per chunk. Return how many were published and skipped.
+    """
+    pks = [pk for pk, granted in permitted.items() if granted]
+    published = sum(
+        publish_chunk(Bot.objects.all(), pks[start:start + chunk_size])
+        for start in range(0, len(pks), chunk_size))
+    return PublishCount(published, len(permitted) - len(pks))
+
+
+class PublishBotsTask(Task):
+    """
+    Publish the bots ``payload['bots']`` as the user ``payload['user']``.
+    The cursor is the number of bots processed.
+    """
+    chunk_size = CHUNK_SIZE
+
+    def count(self, payload):
+        return len(payload['bots'])
+
+    def run(self, payload, cursor):
+        user = get_user_model().objects.get(pk=payload['user'])
+        publishable = get_publishable(user, Bot.objects.all())
+        bots = payload['bots']
+        for start in range(int(cursor or 0), len(bots), self.chunk_size):
+            chunk = bots[start:start + self.chunk_size]
+            published = publish_chunk(publishable, chunk)
+            if published < len(chunk):
+                logger.info(
+                    '%d bots skipped, %s may not publish them',
+                    len(chunk) - published, user)
+            yield str(start + len(chunk)), len(chunk), len(chunk) - published
+
+
+publish_bots_task = PublishBotsTask()
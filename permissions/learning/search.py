@@ -0,0 +1,124 @@
+"""
+Indexed search of the users and companies in the admin.
+
+On SQLite the searchable columns are copied to FTS5 tables keyed by the
+primary key, kept in sync by the signals in ``learning.signals`` and by
+the bulk imports, and every word searched matches as a word prefix.
+Deleted rows leave the index with the permission groups of the deleted
+instances, once the transaction commits. Writes that send no signal,
+``QuerySet.update()`` and ``bulk_update()`` of a searchable column,
+leave the index stale: index the rows again with ``index_users`` or
+``index_companies``. On PostgreSQL the columns have trigram GIN indexes,
+which serve the ``icontains`` lookups directly. Other backends scan the
+table.
+
+The search only narrows the queryset it is given, so the visibility
+filter of the admin still applies.
+"""
+import operator
+from functools import reduce
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.text import smart_split, unescape_string_literal
+
+
+USER_INDEX = 'learning_user_search'
+USER_COLUMNS = ('username', 'first_name', 'last_name', 'email')
+COMPANY_INDEX = 'learning_company_search'
+COMPANY_COLUMNS = ('name',)
+
+
+def has_index(using):
+    return connections[using].vendor == 'sqlite'
+
+
+def get_terms(search_term):
+    """
+    The words of ``search_term``, quoted phrases kept together,
+    like the admin search.
+    """
+    for bit in smart_split(search_term):
+        if bit.startswith(('"', "'")) and bit[0] == bit[-1]:
+            bit = unescape_string_literal(bit)
+        if bit:
+            yield bit
+
+
+def match(index, term):
+    """
+    Subquery of the primary keys whose ``index`` entry has a word
+    starting with ``term``.
+    """
+    query = '"{}"*'.format(term.replace('"', '""'))
+    return RawSQL(f'SELECT rowid FROM {index} WHERE {index} MATCH %s', [query])
+
+
+def contains(columns, term):
+    return reduce(operator.or_, [Q(**{f'{column}__icontains': term}) for column in columns])
+
+
+def search_users(queryset, search_term):
+    """
+    Users of ``queryset`` matching every word of ``search_term`` on their
+    names, email or company name.
+    """
+    for term in get_terms(search_term):
+        if has_index(queryset.db):
+            queryset = queryset.filter(
+                Q(pk__in=match(USER_INDEX, term)) |
+                Q(company__in=match(COMPANY_INDEX, term)))
+        else:
+            queryset = queryset.filter(
+                contains(USER_COLUMNS, term) | Q(company__name__icontains=term))
+    return queryset
+
+
+def search_companies(queryset, search_term):
+    """
+    Companies of ``queryset`` matching every word of ``search_term``.
+    """
+    for term in get_terms(search_term):
+        if has_index(queryset.db):
+            queryset = queryset.filter(pk__in=match(COMPANY_INDEX, term))
+        else:
+            queryset = queryset.filter(contains(COMPANY_COLUMNS, term))
+    return queryset
+
+
+def update_index(index, columns, objs, using='default'):
+    """
+    Write the ``columns`` of ``objs`` to ``index``, replacing their
+    previous entries.
+    """
+    if not objs or not has_index(using):
+        return
+    placeholders = ', '.join(['%s'] * (len(columns) + 1))
+    with connections[using].cursor() as cursor:
+        cursor.executemany(
+            f'INSERT OR REPLACE INTO {index} (rowid, {", ".join(columns)}) '
+            f'VALUES ({placeholders})',
+            [[obj.pk, *(getattr(obj, column) for column in columns)] for obj in objs])
+
+
+def delete_from_index(index, pks, using='default', chunk_size=500):
+    """
+    Delete the entries of ``pks`` from ``index``, one statement per chunk.
+    """
+    if not pks or not has_index(using):
+        return
+    pks = list(pks)
+    with connections[using].cursor() as cursor:
+        for start in range(0, len(pks), chunk_size):
+            chunk = pks[start:start + chunk_size]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute(f'DELETE FROM {index} WHERE rowid IN ({placeholders})', chunk)
+
+
+def index_users(users, using='default'):
+    update_index(USER_INDEX, USER_COLUMNS, users, using)
+
+
+def index_companies(companies, using='default'):
+    update_index(COMPANY_INDEX, COMPANY_COLUMNS, companies, using)
@@ -1,174 +1,275 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import m2m_changed, post_init, post_save, post_delete
 from django.dispatch import receiver
 
 from django.contrib.auth.models import Group
 
-from guardian.shortcuts import assign_perm
+from guardian.models import GroupObjectPermission, UserObjectPermission
+
+from . import access, search, thumbnails
+from .backends import bump_versions, clear_instance_cache
+from .budgets import query_budget
+from .models import (
+    Company, CompanyClosure, Bot, PermissionGroup,
+    CompanyUserObjectPermission, CompanyGroupObjectPermission,
+    UserUserObjectPermission, UserGroupObjectPermission,
+    BotUserObjectPermission, BotGroupObjectPermission,
+    BotAccess, CompanyAccess, UserAccess)
+from .provisioning import (
+    get_group_prefix, is_tenant_scope, provision_groups, provision_memberships,
+    provision_tenant_access, rename_groups, schedule_group_deletion)
+
+
+@receiver(post_save, sender=PermissionGroup)
+@receiver(post_delete, sender=PermissionGroup)
+def evict_permission_group(sender, **kwargs):
+    """
+    Keep the in-process registry cache in sync with the table.
+    """
+    PermissionGroup.objects.evict(kwargs["instance"])
 
-from .models import Company, Bot
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+@receiver(m2m_changed, sender=get_user_model().user_permissions.through)
+def user_permissions_changed(sender, **kwargs):
+    """
+    Invalidate the cached permissions of the users whose groups
+    or permissions changed.
+    """
+    if not kwargs["action"].startswith('post_'):
+        return
+
+    instance = kwargs["instance"]
+    if not kwargs["reverse"]:
+        clear_instance_cache(instance)
+        bump_versions([instance.pk])
+    elif kwargs["pk_set"] is None:
+        bump_versions()
+    else:
+        bump_versions(kwargs["pk_set"])
 
 
-def delete_groups(instance):
+@receiver(m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, **kwargs):
+    """
+    Group permissions are shared by all its members, invalidate every user.
     """
-    Delete all permission groups for the instance.
-    All instances have the groups Read, Write, Execute and Own.
-    The groups are named by the name attribute of the instance
-    or username attribute in the case of instance type User.
+    if kwargs["action"].startswith('post_'):
+        bump_versions()
+
+
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_save, sender=CompanyUserObjectPermission)
+@receiver(post_save, sender=UserUserObjectPermission)
+@receiver(post_save, sender=BotUserObjectPermission)
+@receiver(post_delete, sender=UserObjectPermission)
+@receiver(post_delete, sender=CompanyUserObjectPermission)
+@receiver(post_delete, sender=UserUserObjectPermission)
+@receiver(post_delete, sender=BotUserObjectPermission)
+def user_object_permission_changed(sender, **kwargs):
+    bump_versions([kwargs["instance"].user_id])
+
+
+@receiver(post_save, sender=GroupObjectPermission)
+@receiver(post_save, sender=CompanyGroupObjectPermission)
+@receiver(post_save, sender=UserGroupObjectPermission)
+@receiver(post_save, sender=BotGroupObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+@receiver(post_delete, sender=CompanyGroupObjectPermission)
+@receiver(post_delete, sender=UserGroupObjectPermission)
+@receiver(post_delete, sender=BotGroupObjectPermission)
+def group_object_permission_changed(sender, **kwargs):
+    bump_versions()
+
+
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_save, sender=CompanyUserObjectPermission)
+@receiver(post_save, sender=UserUserObjectPermission)
+@receiver(post_save, sender=BotUserObjectPermission)
+@receiver(post_save, sender=GroupObjectPermission)
+@receiver(post_save, sender=CompanyGroupObjectPermission)
+@receiver(post_save, sender=UserGroupObjectPermission)
+@receiver(post_save, sender=BotGroupObjectPermission)
+def object_permission_saved(sender, instance, created, raw=False, **kwargs):
     """
+    Mirror the permissions assigned through guardian into the bitmask store.
+    """
+    if created and not raw and access.is_store_enabled():
+        access.mirror_guardian_row(instance, granted=True)
+
+
+@receiver(post_delete, sender=UserObjectPermission)
+@receiver(post_delete, sender=CompanyUserObjectPermission)
+@receiver(post_delete, sender=UserUserObjectPermission)
+@receiver(post_delete, sender=BotUserObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+@receiver(post_delete, sender=CompanyGroupObjectPermission)
+@receiver(post_delete, sender=UserGroupObjectPermission)
+@receiver(post_delete, sender=BotGroupObjectPermission)
+def object_permission_deleted(sender, instance, **kwargs):
+    """
+    Mirror the permissions removed through guardian from the bitmask store.
+    """
+    if access.is_store_enabled():
+        access.mirror_guardian_row(instance, granted=False)
+
+
+@receiver(post_save, sender=BotAccess)
+@receiver(post_save, sender=CompanyAccess)
+@receiver(post_save, sender=UserAccess)
+@receiver(post_delete, sender=BotAccess)
+@receiver(post_delete, sender=CompanyAccess)
+@receiver(post_delete, sender=UserAccess)
+def object_access_changed(sender, **kwargs):
+    user_id = kwargs["instance"].user_id
+    bump_versions(None if user_id is None else [user_id])
 
-    if isinstance(instance, get_user_model()):
-        group_name = instance.username
-    else:
-        group_name = instance.name
-
-    try:
-        read_permissions_group = Group.objects.get(
-            name=f"{group_name}: Read")
-        read_permissions_group.delete()
-    except Group.DoesNotExist:
-        pass
-
-    try:
-        write_permissions_group = Group.objects.get(
-            name=f"{group_name}: Write")
-        write_permissions_group.delete()
-    except Group.DoesNotExist:
-        pass
-
-    try:
-        own_permissions_group = Group.objects.get(
-            name=f"{group_name}: Own")
-        own_permissions_group.delete()
-    except Group.DoesNotExist:
-        pass
-
-    try:
-        execute_permissions_group = Group.objects.get(
-            name=f"{group_name}: Execute")
-        execute_permissions_group.delete()
-    except Group.DoesNotExist:
-        pass
+
+@receiver(post_init, sender=get_user_model())
+@receiver(post_init, sender=Company)
+def track_group_prefix(sender, **kwargs):
+    """
+    Remember the name the permission groups are displayed with,
+    so that a rename can be detected on save without extra queries.
+    """
+    instance = kwargs["instance"]
+    instance._group_prefix = instance.__dict__.get(
+        sender.USERNAME_FIELD if sender is get_user_model() else 'name')
+
+
+def sync_group_prefix(instance, created):
+    """
+    Rename the permission groups of an existing instance whose name changed.
+    Return whether the groups need to be provisioned.
+    """
+    old_prefix = instance._group_prefix
+    new_prefix = get_group_prefix(instance)
+    instance._group_prefix = new_prefix
+
+    if created:
+        return True
+    if old_prefix is not None and old_prefix != new_prefix:
+        rename_groups(instance)
+    return False
 
 
 @receiver(post_save, sender=get_user_model())
+@query_budget(13)
 def user_post_save(sender, **kwargs):
     """
-    Create all permission groups for the new created user: Read, Write, Own.
+    Create all permission groups for the new created user: Read, Write, Own,
+    and add the user to its role template, its own groups and its company
+    groups.
     """
     user, created = kwargs["instance"], kwargs["created"]
 
-    if not user.is_superuser:
-        user_role = user.role
-
-        if created and user.username != settings.ANONYMOUS_USER_NAME:
-            # Global permissions
-            if user_role == get_user_model().Role.EDITOR:
-                global_permissions_template = Group.objects.get(name=f"Employee Permissions Template")
-                # global_permissions = Permission.objects.filter(codename__in=[
-                #     'view_bot',
-                #     'add_bot',
-                #     'change_bot',
-                #     'delete_bot',
-                #     'view_company',
-                #     'view_user',
-                #     'change_user',
-                # ])
-
-            if user_role == get_user_model().Role.ADMIN:
-                global_permissions_template = Group.objects.get(name=f"Admin Permissions Template")
-                # global_permissions = Permission.objects.filter(codename__in=[
-                #     'view_bot',
-                #     'add_bot',
-                #     'change_bot',
-                #     'delete_bot',
-                #     'view_company',
-                #     'change_company',
-                #     'view_user',
-                #     'add_user',
-                #     'change_user',
-                #     'delete_user',
-                # ])
-
-            if user_role == get_user_model().Role.AGENT:
-                global_permissions_template = Group.objects.get(name=f"Agent Permissions Template")
-                # global_permissions = Permission.objects.filter(codename__in=[
-                #     'view_bot',
-                #     'add_bot',
-                #     'change_bot',
-                #     'delete_bot',
-                #     'view_company',
-                #     'add_company',
-                #     'change_company',
-                #     'delete_company',
-                #     'view_user',
-                #     'add_user',
-                #     'change_user',
-                #     'delete_user',
-                # ])
-
-            # User permissions
-            user_read_permissions, _ = Group.objects.get_or_create(name=f"{user.username}: Read")
-            user_write_permissions, _ = Group.objects.get_or_create(name=f"{user.username}: Write")
-            user_own_permissions, _ = Group.objects.get_or_create(name=f"{user.username}: Own")
-
-            # Read
-            assign_perm('view_user', user_read_permissions, user)
-
-            # Write
-            assign_perm('change_user', user_write_permissions, user)
-            assign_perm('delete_user', user_write_permissions, user)
-
-            # Own
-            assign_perm('change_user', user_own_permissions, user)
-
-            user.groups.add(global_permissions_template)
-            user.groups.add(user_read_permissions)
-            user.groups.add(user_own_permissions)
-
-            # Company permissions
-            user.grant_own_company_permissions()
+    # is_active and is_superuser change what the permissions resolve to
+    clear_instance_cache(user)
+    bump_versions([user.pk])
+
+    if not sync_group_prefix(user, created):
+        return
+
+    if user.is_superuser or user.username == settings.ANONYMOUS_USER_NAME:
+        return
+
+    provision_groups([user])
+    provision_memberships([user])
 
 
 @receiver(post_delete, sender=get_user_model())
 def user_post_delete(sender, **kwargs):
     """
-    Delete all permission groups for the deleted user: Read, Write, Own.
+    Delete all permission groups for the deleted user: Read, Write, Own,
+    after the commit and together with the other deleted instances.
     """
     user = kwargs["instance"]
 
     if user.username != settings.ANONYMOUS_USER_NAME:
-        delete_groups(user)
+        schedule_group_deletion(user, kwargs["using"])
 
 
-@receiver(post_save, sender=Company)
-def company_post_save(sender, **kwargs):
+@receiver(post_init, sender=Company)
+def track_company_parent(sender, **kwargs):
     """
-    Create all permission groups for the new created company: Read, Write, Own.
+    Remember the parent the closure rows were built for,
+    so that a move can be detected on save without extra queries.
     """
-    company = kwargs["instance"]
+    instance = kwargs["instance"]
+    instance._closure_parent_id = instance.__dict__.get('tn_parent_id')
 
-    # Specific permissions
-    read_permissions_group, _ = Group.objects.get_or_create(name=f"{company.name}: Read")
-    write_permissions_group, _ = Group.objects.get_or_create(name=f"{company.name}: Write")
-    own_permissions_group, _ = Group.objects.get_or_create(name=f"{company.name}: Own")
 
-    # Read
-    assign_perm('view_company', read_permissions_group, company)
+def sync_company_closure(company, created):
+    """
+    Add the closure rows of a new company or re-link a moved subtree.
+    """
+    old_parent_id = company._closure_parent_id
+    company._closure_parent_id = company.tn_parent_id
 
-    # Write
-    assign_perm('change_company', write_permissions_group, company)
-    assign_perm('delete_company', write_permissions_group, company)
+    if created:
+        CompanyClosure.objects.insert_node(company)
+    elif old_parent_id != company.tn_parent_id:
+        CompanyClosure.objects.move_subtree(company)
 
-    # Own
-    assign_perm('change_company', own_permissions_group, company)
+
+@receiver(post_save, sender=Company)
+@query_budget(18)
+def company_post_save(sender, **kwargs):
+    """
+    Create all permission groups for the new created company: Read, Write, Own,
+    and keep the company tree closure in sync.
+    """
+    company, created = kwargs["instance"], kwargs["created"]
+
+    sync_company_closure(company, created)
+
+    if sync_group_prefix(company, created):
+        provision_groups([company])
 
 
 @receiver(post_delete, sender=Company)
 def company_post_delete(sender, **kwargs):
     """
-    Delete all permission groups for the deleted company: Read, Write, Own.
+    Delete all permission groups for the deleted company: Read, Write, Own,
+    after the commit and together with its cascaded users.
     """
     company = kwargs["instance"]
-    delete_groups(company)
+    schedule_group_deletion(company, kwargs["using"])
+
+
+@receiver(post_save, sender=get_user_model())
+def index_user(sender, instance, using, update_fields=None, **kwargs):
+    """
+    Keep the search index of the user in sync, see learning.search.
+    Saves of other columns, like last_login, are skipped.
+    """
+    if update_fields is None or not update_fields.isdisjoint(search.USER_COLUMNS):
+        search.index_users([instance], using)
+
+
+@receiver(post_save, sender=Company)
+def index_company(sender, instance, using, update_fields=None, **kwargs):
+    if update_fields is None or not update_fields.isdisjoint(search.COMPANY_COLUMNS):
+        search.index_companies([instance], using)
+
+
+@receiver(post_save, sender=Bot)
+def bot_post_save(sender, instance, created, raw=False, **kwargs):
+    """
+    Give the tenant groups of its company access to the new created bot.
+    """
+    if created and not raw and is_tenant_scope():
+        provision_tenant_access([instance])
+
+
+@receiver(post_save, sender=Bot)
+def schedule_logo_variants(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    Generate the resized variants of a new logo once the save commits,
+    see learning.thumbnails.
+    """
+    if raw or (update_fields is not None and 'logo' not in update_fields):
+        return
+    if thumbnails.needs_variants(instance):
+        thumbnails.schedule_variants(instance)
@@ -0,0 +1,120 @@
+/*
+ * Accordion of the CompanyAdmin changelist. Only the top of the tree is
+ * rendered, the children of a company are fetched from its children
+ * endpoint when it is expanded and removed when it is collapsed.
+ */
+(function() {
+    'use strict';
+
+    const INDENT = 20;
+
+    function getLevel(row) {
+        return Number(row.dataset.level || 0);
+    }
+
+    function collapse(row) {
+        const level = getLevel(row);
+        let next = row.nextElementSibling;
+        while (next && next.dataset.level !== undefined && getLevel(next) > level) {
+            const current = next;
+            next = next.nextElementSibling;
+            current.remove();
+        }
+    }
+
+    function addChild(template, after, child, level) {
+        const row = template.cloneNode(true);
+        row.classList.remove('selected');
+        delete row.dataset.expanded;
+        row.querySelectorAll('.company-node-toggle').forEach(toggle => toggle.remove());
+        const checkbox = row.querySelector('input.action-select');
+        if (checkbox) {
+            checkbox.value = child.pk;
+            checkbox.checked = false;
+        }
+        const node = row.querySelector('.company-node');
+        node.textContent = child.str;
+        node.dataset.level = level;
+        node.dataset.children = child.children;
+        node.dataset.url = child.children_url;
+        const link = node.closest('a');
+        if (link) {
+            link.href = child.url;
+        }
+        after.after(row);
+        init(node);
+        return row;
+    }
+
+    function addMore(row, after, url, level) {
+        const more = document.createElement('tr');
+        more.dataset.level = level;
+        const cell = more.insertCell();
+        cell.colSpan = row.cells.length;
+        const link = document.createElement('a');
+        link.href = '#';
+        link.textContent = 'Load more';
+        link.style.marginLeft = (INDENT * level) + 'px';
+        cell.append(link);
+        after.after(more);
+        link.addEventListener('click', event => {
+            event.preventDefault();
+            load(row, more, url, level);
+        });
+    }
+
+    function load(row, placeholder, url, level) {
+        fetch(url, {credentials: 'same-origin'})
+            .then(response => response.json())
+            .then(data => {
+                let after = placeholder;
+                for (const child of data.results) {
+                    after = addChild(row, after, child, level);
+                }
+                if (data.next) {
+                    const next = new URL(url, window.location.href);
+                    next.searchParams.set('cursor', data.next);
+                    addMore(row, after, next.toString(), level);
+                }
+                if (placeholder !== row) {
+                    placeholder.remove();
+                } else if (!data.results.length) {
+                    row.querySelector('.company-node-toggle').textContent = '';
+                }
+            });
+    }
+
+    function init(node) {
+        const row = node.closest('tr');
+        const level = Number(node.dataset.level);
+        row.dataset.level = level;
+        const toggle = document.createElement('a');
+        toggle.href = '#';
+        toggle.className = 'company-node-toggle';
+        toggle.style.display = 'inline-block';
+        toggle.style.width = '1.5em';
+        toggle.style.marginLeft = (INDENT * level) + 'px';
+        toggle.textContent = Number(node.dataset.children) ? '+' : '';
+        const anchor = node.closest('a') || node;
+        anchor.parentNode.insertBefore(toggle, anchor);
+        toggle.addEventListener('click', event => {
+            event.preventDefault();
+            if (!toggle.textContent) {
+                return;
+            }
+            if (row.dataset.expanded) {
+                delete row.dataset.expanded;
+                toggle.textContent = '+';
+                collapse(row);
+            } else {
+                row.dataset.expanded = '1';
+                toggle.textContent = '−';
+                load(row, row, node.dataset.url, level + 1);
+            }
+        });
+    }
+
+    document.addEventListener('DOMContentLoaded', () => {
+        document.querySelectorAll('#result_list .company-node').forEach(init);
+    });
+})();
@@ -0,0 +1,113 @@
+"""
+Query-count budgets of the admin views and signals on a fixed synthetic
+tenant. A budget exceeded fails with the SQL that ran more than once,
+usually the N+1 query responsible.
+"""
+import re
+from collections import Counter
+
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .benchmarks.tenants import TenantSpec, build_tenant
+from .jobs import enqueue, run_job
+from .models import Bot, Company, CompanyClosure
+from .signals import company_post_save, user_post_save
+
+
+User = get_user_model()
+
+# Literals replaced to group the queries that only differ by parameters
+LITERALS = re.compile(r"'[^']*'|\b\d+\b")
+
+
+def get_duplicates(queries):
+    counts = Counter(LITERALS.sub('?', query['sql']) for query in queries)
+    return [(sql, count) for sql, count in counts.most_common() if count > 1]
+
+
+class QueryBudgetTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = build_tenant(TenantSpec(
+            name='budget', depth=2, fan_out=2, users={'AD': 1, 'ED': 3}, bots=2))
+        companies = CompanyClosure.objects.descendants(cls.root)
+        cls.admin = User.objects.get(company=cls.root, role=User.Role.ADMIN)
+        run_job(enqueue('learning.onboarding.admin_onboarding', {'user': cls.admin.pk}))
+        cls.user = User.objects.filter(
+            company__in=companies, role=User.Role.EDITOR).order_by('-pk').first()
+        cls.bot = Bot.objects.filter(company=cls.root).order_by('name').first()
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def assertWithinBudget(self, budget, run):
+        with CaptureQueriesContext(connection) as context:
+            result = run()
+        if len(context) > budget:
+            duplicates = '\n'.join(
+                f'{count}x {sql}' for sql, count in get_duplicates(context.captured_queries))
+            self.fail(
+                f'{len(context)} queries, budget {budget}. '
+                f'Duplicated queries:\n{duplicates or "none"}')
+        return result
+
+    def assertViewWithinBudget(self, model, view, url, method='get', data=None):
+        budget = admin.site._registry[model].query_budgets[view]
+        response = self.assertWithinBudget(
+            budget, lambda: getattr(self.client, method)(url, data))
+        self.assertLess(response.status_code, 400)
+
+
+class AdminQueryBudgetTest(QueryBudgetTestCase):
+
+    def test_user_changelist(self):
+        self.assertViewWithinBudget(
+            User, 'changelist', reverse('admin:learning_user_changelist'))
+
+    def test_user_change(self):
+        self.assertViewWithinBudget(
+            User, 'change', reverse('admin:learning_user_change', args=[self.user.pk]))
+
+    def test_company_changelist(self):
+        self.assertViewWithinBudget(
+            Company, 'changelist', reverse('admin:learning_company_changelist'))
+
+    def test_company_change(self):
+        self.assertViewWithinBudget(
+            Company, 'change', reverse('admin:learning_company_change', args=[self.root.pk]))
+
+    def test_bot_changelist(self):
+        self.assertViewWithinBudget(
+            Bot, 'changelist', reverse('admin:learning_bot_changelist'))
+
+    def test_bot_change(self):
+        self.assertViewWithinBudget(
+            Bot, 'change', reverse('admin:learning_bot_change', args=[self.bot.pk]))
+
+    def test_user_save_model(self):
+        model_admin = admin.site._registry[User]
+        request = self.client.get(reverse('admin:index')).wsgi_request
+        request.user = User.objects.get(pk=self.admin.pk)
+        user = User(username='new admin', company=self.root, role=User.Role.ADMIN)
+        self.assertWithinBudget(
+            model_admin.query_budgets['save_model'],
+            lambda: model_admin.save_model(request, user, None, False))
+
+
+class SignalQueryBudgetTest(QueryBudgetTestCase):
+
+    def test_user_post_save(self):
+        self.assertWithinBudget(
+            user_post_save.query_budget,
+            lambda: User.objects.create(username='new user', company=self.root))
+
+    def test_company_post_save(self):
+        self.assertWithinBudget(
+            company_post_save.query_budget,
+            lambda: Company.objects.create(name='new company', tn_parent=self.root))
@@ -1,3 +1,1581 @@
-from django.test import TestCase
+import json
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import QuerySet
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from guardian.shortcuts import assign_perm, get_objects_for_user as guardian_get_objects_for_user, remove_perm
+
+from PIL import Image
+
+from . import access, metrics, profiling, thumbnails
+from .backends import stats
+from .benchmarks.scenarios import Scenarios
+from .benchmarks.tenants import TenantSpec, build_tenant, get_tenant_counts
+from .jobs import claim_job, enqueue, run_job
+from .models import (
+    Bot, BotAccess, BotGroupObjectPermission, Company, CompanyAccess, CompanyClosure,
+    CompanyGroupObjectPermission, Job, PermissionGroup, UserAccess, UserGroupObjectPermission)
+from .onboarding import UserImporter
+from .pagination import KeysetPaginator
+from .permissions import get_objects_for_user, get_permission_checker
+from .policies import compile_rules, filter_queryset
+from .provisioning import (
+    delete_groups, get_deletion_queue, grant_template, provision_groups, provision_memberships)
+from .publishing import PublishCount, publish_permitted
+from .search import search_companies, search_users
+from .uuids import uuid7
+
+
+User = get_user_model()
+
+
+class AdminObjectPermissionQueriesTest(TestCase):
+    """
+    Object permission checks on admin pages are answered by the
+    request-scoped checker, so the number of queries does not depend
+    on the number of objects on the page.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+        cls.users = [
+            User.objects.create(username=f'user {i}', company=cls.company)
+            for i in range(12)
+        ]
+        cls.admin = User.objects.create(
+            username='admin',
+            company=cls.company,
+            role=User.Role.ADMIN,
+            is_staff=True)
+        cls.admin.bulk_grant_permissions(
+            'Admin Permissions Template',
+            User.objects.filter(company=cls.company))
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def count_queries(self, method, url, data=None):
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url, data)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_changelist_queries_are_constant(self):
+        url = reverse('admin:learning_user_changelist')
+        many = self.count_queries('get', url)
+        User.objects.filter(pk__in=[user.pk for user in self.users[2:]]).delete()
+        few = self.count_queries('get', url)
+        self.assertEqual(few, many)
+
+    def test_delete_selected_queries_are_constant(self):
+        url = reverse('admin:learning_user_changelist')
+
+        def delete_selected(users):
+            return self.count_queries('post', url, {
+                'action': 'delete_selected',
+                '_selected_action': [user.pk for user in users],
+            })
+
+        self.assertEqual(
+            delete_selected(self.users[:2]),
+            delete_selected(self.users))
+
+
+class PermissionGroupRegistryTest(TestCase):
+    """
+    Permission groups are found through the registry, not by their name.
+    """
+
+    def test_rename_keeps_groups(self):
+        company = Company.objects.create(name='One')
+        group_id = PermissionGroup.objects.get_group_id(
+            company, PermissionGroup.AccessLevel.READ)
+        self.assertIsNotNone(group_id)
+
+        company.name = 'Two'
+        company.save()
+
+        self.assertEqual(
+            PermissionGroup.objects.get_group_id(
+                company, PermissionGroup.AccessLevel.READ),
+            group_id)
+        self.assertTrue(
+            Group.objects.get(pk=group_id).name.startswith('Two '))
+
+    def test_grant_of_unregistered_group_raises(self):
+        company = Company.objects.create(name='One')
+        PermissionGroup.objects.for_instance(company).filter(
+            access_level=PermissionGroup.AccessLevel.READ).delete()
+        user = User.objects.create(username='root', is_superuser=True)
+
+        with self.assertRaisesMessage(
+                Group.DoesNotExist, f'No Read permission group is registered for company {company.pk}'):
+            company.grant_permissions(user)
+
+
+class ProvisioningTest(TestCase):
+    """
+    New users and companies get their groups and memberships in a fixed
+    number of queries, once.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+        cls.crowded = Company.objects.create(name='Two')
+        for number in range(5):
+            User.objects.create(username=f'user{number}', company=cls.crowded)
+
+    def count_queries(self, create):
+        with CaptureQueriesContext(connection) as context:
+            create()
+        # Without the updates of the treenode fields of the other companies,
+        # which depend on the shape of the tree
+        return len([
+            query for query in context.captured_queries
+            if not query['sql'].startswith('UPDATE "learning_company"')
+        ])
+
+    def count_rows(self):
+        return {
+            model.__name__: model.objects.count()
+            for model in (
+                Group, PermissionGroup, CompanyGroupObjectPermission,
+                UserGroupObjectPermission, User.groups.through)
+        }
+
+    def test_creation_query_count_is_constant(self):
+        # The first creation caches the content types
+        Company.objects.create(name='Warm up', tn_parent=self.company)
+        self.assertEqual(
+            self.count_queries(lambda: Company.objects.create(name='Three', tn_parent=self.company)),
+            self.count_queries(lambda: Company.objects.create(name='Four', tn_parent=self.crowded)))
+        # Whatever the number of users of the company
+        self.assertEqual(
+            self.count_queries(lambda: User.objects.create(username='ada', company=self.company)),
+            self.count_queries(lambda: User.objects.create(username='alan', company=self.crowded)))
+
+    def test_rename_only_save_does_not_reprovision(self):
+        user = User.objects.create(username='ada', company=self.company)
+        rows = self.count_rows()
+        with mock.patch('learning.signals.provision_groups') as groups, \
+                mock.patch('learning.signals.provision_memberships') as memberships:
+            user.first_name = 'Ada'
+            user.save()
+            user.username = 'lovelace'
+            user.save()
+            self.company.name = 'Renamed'
+            self.company.save()
+        groups.assert_not_called()
+        memberships.assert_not_called()
+        self.assertEqual(self.count_rows(), rows)
+        self.assertTrue(Group.objects.get(pk=PermissionGroup.objects.get_group_id(
+            user, PermissionGroup.AccessLevel.READ)).name.startswith('lovelace '))
+
+    def test_provisioning_twice_is_idempotent(self):
+        user = User.objects.create(username='ada', company=self.company)
+        rows = self.count_rows()
+        group_ids = provision_groups([self.company])
+
+        self.assertEqual(provision_groups([self.company]), group_ids)
+        provision_groups([user])
+        provision_memberships([user])
+        self.assertEqual(self.count_rows(), rows)
+
+
+class CompanyClosureTest(TestCase):
+    """
+    The closure table follows the company tree at any depth.
+    """
+
+    def descendants(self, company):
+        return set(Company.objects.filter(
+            pk__in=CompanyClosure.objects.descendants(company)))
+
+    def test_descendants_at_any_depth(self):
+        agency = Company.objects.create(name='Agency', type=Company.Type.AGENCY)
+        child = Company.objects.create(name='Child', tn_parent=agency)
+        grandchild = Company.objects.create(name='Grandchild', tn_parent=child)
+
+        self.assertEqual(self.descendants(agency), {agency, child, grandchild})
+        self.assertEqual(
+            CompanyClosure.objects.get(ancestor=agency, descendant=grandchild).depth, 2)
+
+    def test_move_subtree(self):
+        agency = Company.objects.create(name='Agency', type=Company.Type.AGENCY)
+        other = Company.objects.create(name='Other', type=Company.Type.AGENCY)
+        child = Company.objects.create(name='Child', tn_parent=agency)
+        grandchild = Company.objects.create(name='Grandchild', tn_parent=child)
+
+        child.tn_parent = other
+        child.save()
+
+        self.assertEqual(self.descendants(agency), {agency})
+        self.assertEqual(self.descendants(other), {other, child, grandchild})
+        self.assertEqual(
+            CompanyClosure.objects.get(ancestor=other, descendant=grandchild).depth, 2)
+
+
+class AdminOnboardingJobTest(TestCase):
+    """
+    The Admin onboarding fan-out runs as a resumable background job.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+        cls.users = [
+            User.objects.create(username=f'user {i}', company=cls.company)
+            for i in range(5)
+        ]
+        cls.admin = User.objects.create(
+            username='admin', company=cls.company, role=User.Role.ADMIN)
+
+    def test_job_grants_access_in_chunks(self):
+        enqueue('learning.onboarding.admin_onboarding', {'user': self.admin.pk})
+        job = claim_job()
+        self.assertTrue(run_job(job))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.DONE)
+        self.assertEqual(job.done, job.total)
+        read_group = PermissionGroup.objects.get_group_id(
+            self.admin, PermissionGroup.AccessLevel.READ)
+        self.assertEqual(
+            User.objects.filter(groups=read_group).count(), len(self.users) + 1)
+        self.assertIsNone(claim_job())
+
+    def test_admin_edits_queue_one_job(self):
+        model_admin = admin.site._registry[User]
+        request = self.client.get(reverse('admin:index')).wsgi_request
+        request.user = User.objects.create(username='root', is_staff=True, is_superuser=True)
+        jobs = Job.objects.filter(task='learning.onboarding.admin_onboarding')
+
+        def save(user, change, *changed_data):
+            form = mock.Mock(changed_data=list(changed_data))
+            model_admin.save_model(request, user, form, change)
+            return jobs.count()
+
+        self.assertEqual(save(self.admin, True, 'first_name'), 0)
+        self.assertEqual(save(self.admin, True, 'role'), 1)
+        # Still pending
+        self.assertEqual(save(self.admin, True, 'company'), 1)
+        self.assertEqual(save(User(username='new', company=self.company, role=User.Role.ADMIN), False), 2)
+
+        claim_job()
+        self.assertEqual(save(self.admin, True, 'company'), 3)
+
+    def test_failed_job_is_queued_again(self):
+        enqueue('learning.onboarding.missing_task')
+        job = claim_job()
+        self.assertFalse(run_job(job))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertGreater(job.run_after, job.created_at)
+
+
+class ImportUsersTest(TestCase):
+    """
+    Users are imported from CSV or JSON lines in batches, each batch
+    provisioned in its own transaction so a failed import resumes.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def write(self, name, text):
+        path = self.directory / name
+        path.write_text(text)
+        return str(path)
+
+    def import_users(self, path, *args):
+        stdout = StringIO()
+        call_command(
+            'import_users', path, '--workers', '1', '--company', str(self.company.pk),
+            *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_batches(self):
+        rows = [{'username': f'user{number}', 'company': self.company.pk} for number in range(5)]
+        with UserImporter(batch_size=2, workers=1) as importer, \
+                mock.patch.object(importer, 'import_batch', wraps=importer.import_batch) as batch:
+            progress = [(read, created) for read, created, _ in importer.run(rows)]
+        self.assertEqual(progress, [(2, 2), (4, 4), (5, 5)])
+        self.assertEqual([len(call.args[0]) for call in batch.call_args_list], [2, 2, 1])
+        self.assertEqual(User.objects.filter(company=self.company).count(), 5)
+
+    def test_failed_batch_resumes(self):
+        rows = 'username,role\nada,ED\nalan,ED\ngrace,XX\nlinus,ED\n'
+        with self.assertRaisesMessage(CommandError, 'Import stopped after 2 rows'):
+            self.import_users(self.write('users.csv', rows), '--batch-size', '2')
+        self.assertEqual(
+            set(User.objects.filter(company=self.company).values_list('username', flat=True)),
+            {'ada', 'alan'})
+
+        output = self.import_users(
+            self.write('users.csv', rows.replace('XX', 'AD')), '--batch-size', '2')
+        self.assertIn('2 users created, 2 already existed', output)
+        grace = User.objects.get(username='grace')
+        self.assertEqual(grace.role, User.Role.ADMIN)
+        self.assertTrue(PermissionGroup.objects.for_instance(grace).exists())
+
+    def test_passwords_are_hashed(self):
+        self.import_users(
+            self.write('users.csv', 'username,password\nada,secret\nalan,\n'),
+            '--password', 'default')
+        ada, alan = User.objects.get(username='ada'), User.objects.get(username='alan')
+        self.assertNotEqual(ada.password, 'secret')
+        self.assertTrue(ada.check_password('secret'))
+        self.assertTrue(alan.check_password('default'))
+
+    def test_csv_and_jsonl(self):
+        self.import_users(self.write(
+            'users.csv', 'username,last_name,is_staff\nada,Lovelace,yes\n'))
+        self.import_users(self.write(
+            'users.jsonl', '{"username": "alan", "last_name": "Turing", "is_staff": "yes"}\n\n'))
+        self.assertEqual(
+            list(User.objects.filter(company=self.company).order_by('username').values_list(
+                'username', 'last_name', 'is_staff')),
+            [('ada', 'Lovelace', True), ('alan', 'Turing', True)])
+
+
+class GrantTemplateTest(TestCase):
+    """
+    Template grants insert only the missing memberships, chunk by chunk.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+        cls.users = [
+            User.objects.create(username=f'user {i}', company=cls.company)
+            for i in range(5)
+        ]
+        cls.owner = User.objects.create(username='owner', company=cls.company)
+
+    def test_employee_template_is_idempotent(self):
+        users = User.objects.filter(pk__in=[user.pk for user in self.users])
+
+        first = grant_template(
+            self.owner, 'Employee Permissions Template', users, chunk_size=2)
+        second = grant_template(
+            self.owner, 'Employee Permissions Template', users, chunk_size=2)
+
+        self.assertEqual(first, (10, 0))
+        self.assertEqual(second, (0, 10))
+        write_group = PermissionGroup.objects.get_group_id(
+            self.owner, PermissionGroup.AccessLevel.WRITE)
+        self.assertEqual(users.filter(groups=write_group).count(), 5)
+
+    def test_unknown_template(self):
+        with self.assertRaises(ValueError):
+            grant_template(self.owner, 'Unknown', User.objects.all())
+
+
+class BenchmarkTenantTest(TestCase):
+    """
+    Synthetic tenants have the requested shape and the scenarios run on them.
+    """
+
+    def test_build_tenant_and_run_scenarios(self):
+        spec = TenantSpec(depth=2, fan_out=2, users={'AD': 1, 'ED': 2}, bots=1)
+        root = build_tenant(spec)
+
+        self.assertEqual(build_tenant(spec), root)
+        self.assertEqual(
+            get_tenant_counts(root), {'companies': 7, 'users': 21, 'bots': 7})
+        results = Scenarios(root, repeat=1).run(['user_changelist', 'has_perm'])
+        self.assertEqual(set(results), {'user_changelist', 'has_perm'})
+        self.assertGreater(results['user_changelist']['queries'], 0)
+
+
+class CachedPermissionBackendTest(TransactionTestCase):
+    """
+    Resolved permissions are shared between user instances through the
+    permission cache and invalidated when memberships change.
+    """
+    # Keep the permission templates created by the migrations
+    serialized_rollback = True
+
+    def setUp(self):
+        self.company = Company.objects.create(name='One')
+        self.user = User.objects.create(username='user', company=self.company)
+        self.read_group = PermissionGroup.objects.get_group_id(
+            self.company, PermissionGroup.AccessLevel.READ)
+
+    def has_view_company(self):
+        user = User.objects.get(pk=self.user.pk)
+        return user.has_perm('learning.view_company', self.company)
+
+    def test_permissions_are_cached_across_instances(self):
+        self.assertTrue(self.has_view_company())
+        stats.reset()
+        with self.assertNumQueries(1):
+            self.assertTrue(self.has_view_company())
+        self.assertEqual((stats.hits, stats.misses), (1, 0))
+
+    def test_membership_change_invalidates(self):
+        self.assertTrue(self.has_view_company())
+        self.user.groups.remove(self.read_group)
+        self.assertFalse(self.has_view_company())
+
+    def test_rolled_back_change_is_not_cached(self):
+        with transaction.atomic():
+            self.user.groups.remove(self.read_group)
+            self.assertFalse(self.has_view_company())
+            transaction.set_rollback(True)
+        self.assertTrue(self.has_view_company())
+
+    def test_instance_cache_follows_own_changes(self):
+        user = User.objects.get(pk=self.user.pk)
+        self.assertTrue(user.has_perm('learning.view_company', self.company))
+        user.groups.remove(self.read_group)
+        self.assertFalse(user.has_perm('learning.view_company', self.company))
+
+
+class MetricsTest(TestCase):
+    """
+    Hot path metrics are collected in process and served to superusers
+    in the Prometheus text format.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+        cls.superuser = User.objects.create(
+            username='root', is_staff=True, is_superuser=True)
+        cls.staff = User.objects.create(
+            username='staff', company=cls.company, is_staff=True)
+
+    def test_provisioning_is_measured(self):
+        count = metrics.provisioning.get_count(step='groups', model='company')
+        Company.objects.create(name='Two')
+        self.assertEqual(
+            metrics.provisioning.get_count(step='groups', model='company'), count + 1)
+
+    def test_user_changelist_is_measured(self):
+        self.client.force_login(self.superuser)
+        count = metrics.tenant_scopes.get_count(scope='user_admin')
+        self.client.get(reverse('admin:learning_user_changelist'))
+        self.assertEqual(metrics.tenant_scopes.get_count(scope='user_admin'), count + 1)
+        # The change form only fetches one user
+        self.client.get(reverse('admin:learning_user_change', args=[self.staff.pk]))
+        self.assertEqual(metrics.tenant_scopes.get_count(scope='user_admin'), count + 1)
+
+    @override_settings(PERMISSION_METRICS_ENABLED=False)
+    def test_disabled_collection(self):
+        count = metrics.provisioning.get_count(step='groups', model='company')
+        Company.objects.create(name='Two')
+        self.assertEqual(
+            metrics.provisioning.get_count(step='groups', model='company'), count)
+
+    def test_render_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ['kind'], buckets=(0.1, 1))
+        metrics.registry.remove(histogram)
+        histogram.observe(0.5, kind='a"b')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{kind="a\\"b",le="0.1"} 0',
+            'test_seconds_bucket{kind="a\\"b",le="1"} 1',
+            'test_seconds_bucket{kind="a\\"b",le="+Inf"} 1',
+            'test_seconds_sum{kind="a\\"b"} 0.5',
+            'test_seconds_count{kind="a\\"b"} 1',
+        ])
+
+    def test_metrics_view_is_superuser_only(self):
+        url = reverse('metrics')
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_login(self.superuser)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE learning_provisioning_seconds histogram', response.content)
+
+
+class RequestProfilerTest(TestCase):
+    """
+    Sampled and slow admin requests are profiled into a bounded buffer,
+    flushed to a file and listed to superusers.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.superuser = User.objects.create(
+            username='root', is_staff=True, is_superuser=True)
+
+    def setUp(self):
+        self.client.force_login(self.superuser)
+
+    @override_settings(REQUEST_PROFILER={'SAMPLE_RATE': 1, 'STACK_INTERVAL_MS': 0})
+    def test_sampled_requests(self):
+        self.client.get(reverse('admin:learning_company_changelist'))
+        profile, = profiling.recorder.get_slowest()
+        self.assertEqual(profile['path'], '/admin/learning/company/')
+        self.assertEqual(profile['status'], 200)
+        self.assertTrue(profile['sampled'])
+        self.assertEqual(profile['query_count'], len(profile['queries']))
+        self.assertGreater(profile['query_count'], 0)
+
+        response = self.client.get(reverse('profile', args=[profile['id']]))
+        self.assertContains(response, 'FROM &quot;learning_company&quot;')
+        self.assertContains(self.client.get(reverse('profiles')), profile['id'])
+
+    @override_settings(REQUEST_PROFILER={'SAMPLE_RATE': 0, 'SLOW_REQUEST_MS': 0, 'BUFFER_SIZE': 2})
+    def test_slow_requests_ring_buffer(self):
+        for _ in range(3):
+            self.client.get(reverse('admin:index'))
+        profiles = profiling.recorder.get_slowest()
+        self.assertEqual(len(profiles), 2)
+        self.assertFalse(any(profile['sampled'] for profile in profiles))
+
+    @override_settings(REQUEST_PROFILER={'SAMPLE_RATE': 0})
+    def test_unsampled_fast_requests_are_dropped(self):
+        self.client.get(reverse('admin:index'))
+        self.assertEqual(profiling.recorder.get_slowest(), [])
+
+    def test_flush(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = Path(directory) / 'profiles.jsonl'
+            recorder = profiling.ProfileRecorder(10, output, flush_interval=3600)
+            recorder.add({'id': 'a', 'duration_ms': 1})
+            recorder.add({'id': 'b', 'duration_ms': 2})
+            recorder.flush()
+            lines = output.read_text().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], ['a', 'b'])
+        self.assertEqual(len(recorder.pending), 0)
+
+    def test_stack_samples(self):
+        active = profiling.ActiveRequest(None, True, profiling.DEFAULTS)
+        for _ in range(2):
+            active.add_stack(sys._getframe())
+        (stack, count), = active.stacks.items()
+        self.assertEqual(count, 2)
+        self.assertIn('test_stack_samples', stack[-1])
+
+    def test_single_sampler(self):
+        with override_settings(REQUEST_PROFILER={'STACK_INTERVAL_MS': 1}):
+            config = profiling.get_config()
+            samplers = []
+            threads = [
+                threading.Thread(target=lambda: samplers.append(profiling.get_profiler(config)[1]))
+                for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            sampler, = set(samplers)
+            self.assertTrue(sampler.is_alive())
+        self.assertFalse(sampler.is_alive())
+        self.assertIsNone(profiling.sampler)
+
+    def test_profiles_view_is_superuser_only(self):
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        self.assertEqual(self.client.get(reverse('profiles')).status_code, 403)
+
+
+class KeysetPaginatorTest(TestCase):
+    """
+    Pages continue from the keys of the previous page instead of an OFFSET,
+    and the total is exact up to a limit.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.superuser = User.objects.create(
+            username='root', is_staff=True, is_superuser=True)
+        for i in range(7):
+            User.objects.create(username=f'user{i}', last_name=str(i % 2))
+        cls.usernames = list(User.objects.order_by('username').values_list('username', flat=True))
+
+    def walk(self, queryset, per_page=3):
+        pages = []
+        cursor = None
+        while True:
+            page = KeysetPaginator(queryset, per_page, cursor=cursor).page(len(pages) + 1)
+            pages.append([user.username for user in page])
+            if not page.has_next():
+                return pages, page
+            cursor = page.next_cursor
+
+    def test_walk_forward_and_back(self):
+        pages, page = self.walk(User.objects.order_by('username'))
+        self.assertEqual(sum(pages, []), self.usernames)
+        self.assertEqual([len(rows) for rows in pages], [3, 3, 2])
+
+        previous = KeysetPaginator(
+            User.objects.order_by('username'), 3, cursor=page.previous_cursor).page(2)
+        self.assertEqual([user.username for user in previous], pages[1])
+        self.assertTrue(previous.has_previous())
+        self.assertTrue(previous.has_next())
+
+    def test_non_unique_ordering(self):
+        queryset = User.objects.order_by('-last_name')
+        paginator = KeysetPaginator(queryset, 3)
+        self.assertEqual(paginator.get_ordering(), ['-last_name', 'id'])
+        pages, _ = self.walk(queryset)
+        self.assertEqual(
+            sum(pages, []),
+            list(queryset.order_by('-last_name', 'id').values_list('username', flat=True)))
+
+    def test_cursor_page_does_not_offset(self):
+        page = KeysetPaginator(User.objects.order_by('username'), 3).page(1)
+        paginator = KeysetPaginator(User.objects.order_by('username'), 3, cursor=page.next_cursor)
+        with CaptureQueriesContext(connection) as context:
+            paginator.page(2)
+        sql, = [query['sql'] for query in context.captured_queries]
+        self.assertNotIn('OFFSET', sql)
+        self.assertIn('LIMIT 4', sql)
+
+    def test_invalid_or_stale_cursor_starts_over(self):
+        page = KeysetPaginator(User.objects.order_by('username'), 3).page(1)
+        for cursor in ('garbage', page.next_cursor):
+            paginator = KeysetPaginator(User.objects.order_by('-username'), 3, cursor=cursor)
+            self.assertIsNone(paginator.cursor)
+
+    def test_count(self):
+        paginator = KeysetPaginator(User.objects.order_by('username'), 3)
+        paginator.page(1)
+        self.assertEqual(paginator.count, len(self.usernames))
+        self.assertTrue(paginator.exact)
+
+        paginator = KeysetPaginator(User.objects.order_by('username'), 3)
+        paginator.count_limit = 5
+        self.assertEqual(paginator.count, 5)
+        self.assertFalse(paginator.exact)
+        self.assertTrue(paginator.lower_bound)
+
+    def test_changelist_links(self):
+        self.client.force_login(self.superuser)
+        model_admin = admin.site._registry[User]
+        with mock.patch.object(model_admin, 'list_per_page', 3):
+            url = reverse('admin:learning_user_changelist')
+            response = self.client.get(url)
+            self.assertContains(response, '8 users')
+            cl = response.context['cl']
+            self.assertEqual([user.username for user in cl.result_list], self.usernames[:3])
+
+            response = self.client.get(url + cl.next_page_url)
+            cl = response.context['cl']
+            self.assertEqual([user.username for user in cl.result_list], self.usernames[3:6])
+            self.assertEqual(cl.page.number, 2)
+            self.assertNotIn('cursor', cl.get_query_string({'o': '1'}))
+
+
+class SearchTest(TestCase):
+    """
+    Users and companies are searched through the FTS5 index, kept in
+    sync on save and bulk import, and on delete by GroupTeardownTest.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.acme = Company.objects.create(name='Acme Robotics')
+        cls.globex = Company.objects.create(name='Globex')
+        cls.ada = User.objects.create(
+            username='ada', first_name='Ada', last_name='Lovelace',
+            email='ada@example.com', company=cls.acme)
+        cls.alan = User.objects.create(
+            username='alan', first_name='Alan', last_name='Turing', company=cls.globex)
+
+    def search(self, term, queryset=None):
+        queryset = User.objects.all() if queryset is None else queryset
+        return set(search_users(queryset, term).values_list('username', flat=True))
+
+    def test_search_users(self):
+        self.assertEqual(self.search('love'), {'ada'})
+        self.assertEqual(self.search('ada@exam'), {'ada'})
+        self.assertEqual(self.search('a'), {'ada', 'alan'})
+        self.assertEqual(self.search('rob'), {'ada'})
+        self.assertEqual(self.search('alan glob'), {'alan'})
+        self.assertEqual(self.search('alan acme'), set())
+        self.assertEqual(self.search('"acme robotics"'), {'ada'})
+        self.assertEqual(self.search('love', User.objects.filter(company=self.globex)), set())
+
+    def test_search_uses_index(self):
+        with CaptureQueriesContext(connection) as context:
+            self.search('love')
+        sql, = [query['sql'] for query in context.captured_queries]
+        self.assertIn('MATCH', sql)
+        self.assertNotIn('LIKE', sql)
+
+    def test_index_follows_changes(self):
+        self.ada.last_name = 'Byron'
+        self.ada.save()
+        self.assertEqual(self.search('love'), set())
+        self.assertEqual(self.search('byr'), {'ada'})
+
+        self.acme.name = 'Initech'
+        self.acme.save()
+        self.assertEqual(self.search('acme'), set())
+        self.assertEqual(self.search('initech'), {'ada'})
+        self.assertEqual(
+            list(search_companies(Company.objects.all(), 'ini')), [self.acme])
+
+    def test_imported_users_are_indexed(self):
+        with UserImporter(workers=1) as importer:
+            list(importer.run([{'username': 'grace', 'last_name': 'Hopper', 'company': self.acme.pk}]))
+        self.assertEqual(self.search('hop'), {'grace'})
+
+    def test_changelist_search(self):
+        self.client.force_login(User.objects.create(
+            username='root', is_staff=True, is_superuser=True))
+        response = self.client.get(reverse('admin:learning_user_changelist'), {'q': 'tur'})
+        self.assertEqual([user.username for user in response.context['cl'].result_list], ['alan'])
+        response = self.client.get(reverse('admin:learning_company_changelist'), {'q': 'glo'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.globex])
+
+
+class LazyBotsInlineTest(TestCase):
+    """
+    The company change page renders the first page of bots, the next
+    pages and searches are served as JSON to users who can see the company.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+        cls.other = Company.objects.create(name='Two')
+        for name in ('alpha', 'beta', 'gamma'):
+            Bot.objects.create(name=name, company=cls.company)
+        Bot.objects.create(name='delta', company=cls.other)
+        cls.superuser = User.objects.create(
+            username='root', is_staff=True, is_superuser=True)
+
+    def setUp(self):
+        self.client.force_login(self.superuser)
+        inline = mock.patch('learning.admin.BotsInline.per_page', 2)
+        inline.start()
+        self.addCleanup(inline.stop)
+        self.url = reverse('admin:learning_company_bots', args=[self.company.pk])
+
+    def get_names(self, data):
+        return [bot['cells'][0] for bot in data['results']]
+
+    def test_change_page_renders_first_page(self):
+        response = self.client.get(reverse('admin:learning_company_change', args=[self.company.pk]))
+        formset = response.context['inline_admin_formsets'][0].formset
+        self.assertIsInstance(formset.get_queryset(), QuerySet)
+        self.assertEqual([bot.name for bot in formset.get_queryset()], ['alpha', 'beta'])
+        self.assertContains(response, f'data-cursor="{formset.page.next_cursor}"')
+
+    def test_next_page_and_search(self):
+        response = self.client.get(reverse('admin:learning_company_change', args=[self.company.pk]))
+        cursor = response.context['inline_admin_formsets'][0].formset.page.next_cursor
+
+        data = self.client.get(self.url, {'cursor': cursor}).json()
+        self.assertEqual(self.get_names(data), ['gamma'])
+        self.assertIsNone(data['next'])
+
+        data = self.client.get(self.url, {'q': 'ta'}).json()
+        self.assertEqual(self.get_names(data), ['beta'])
+
+    def test_requires_company_permission(self):
+        self.client.force_login(User.objects.create(
+            username='staff', company=self.other, is_staff=True))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+class CompanyTreeAdminTest(TestCase):
+    """
+    The company changelist renders the top of the tree the user can see,
+    children are served by a permission-filtered endpoint.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = Company.objects.create(name='A')
+        cls.b = Company.objects.create(name='B', tn_parent=cls.a)
+        cls.c = Company.objects.create(name='C', tn_parent=cls.b)
+        cls.d = Company.objects.create(name='D', tn_parent=cls.c)
+        cls.e = Company.objects.create(name='E', tn_parent=cls.b)
+        cls.superuser = User.objects.create(
+            username='root', is_staff=True, is_superuser=True)
+        cls.staff = User.objects.create(username='staff', company=cls.b, is_staff=True)
+        cls.staff.user_permissions.add(Permission.objects.get(codename='view_company'))
+        cls.staff.groups.add(*[
+            PermissionGroup.objects.get_group_id(company, PermissionGroup.AccessLevel.READ)
+            for company in (cls.b, cls.d, cls.e)
+        ])
+
+    def get_roots(self, user):
+        self.client.force_login(user)
+        response = self.client.get(reverse('admin:learning_company_changelist'))
+        return [company.name for company in response.context['cl'].result_list]
+
+    def get_children(self, user, company):
+        self.client.force_login(user)
+        return self.client.get(reverse('admin:learning_company_children', args=[company.pk]))
+
+    def test_roots(self):
+        self.assertEqual(self.get_roots(self.superuser), ['A'])
+        # D is below C, hidden from the user
+        self.assertEqual(self.get_roots(self.staff), ['B', 'D'])
+
+    def test_children(self):
+        data = self.get_children(self.superuser, self.b).json()
+        self.assertEqual(
+            [(child['str'], child['children']) for child in data['results']],
+            [('C', 1), ('E', 0)])
+        self.assertIsNone(data['next'])
+
+        data = self.get_children(self.staff, self.b).json()
+        self.assertEqual([child['str'] for child in data['results']], ['E'])
+        self.assertEqual(self.get_children(self.staff, self.a).status_code, 403)
+
+    def test_search_lists_every_match(self):
+        self.client.force_login(self.superuser)
+        response = self.client.get(reverse('admin:learning_company_changelist'), {'q': 'D'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.d])
+
+
+class PublishBotsTest(TestCase):
+    """
+    Publishing stores the date on the bots the user may publish, globally
+    or per object, and counts the others as skipped.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+        cls.bots = [
+            Bot.objects.create(name=name, company=cls.company)
+            for name in ('alpha', 'beta', 'gamma')
+        ]
+        cls.staff = User.objects.create(username='staff', company=cls.company, is_staff=True)
+        cls.staff.user_permissions.add(Permission.objects.get(codename='view_bot'))
+        for bot in cls.bots[:2]:
+            assign_perm('learning.publish_bot', cls.staff, bot)
+
+    def get_published(self):
+        return set(Bot.objects.filter(published_at__isnull=False).values_list('name', flat=True))
+
+    def publish(self, user, queryset, chunk_size=1000):
+        return publish_permitted(
+            user.get_object_permissions('learning.publish_bot', queryset.order_by('pk')),
+            chunk_size=chunk_size)
+
+    def test_object_permissions(self):
+        # The global permissions of the user, the object permissions of
+        # the selection, then an UPDATE per chunk of permitted bots
+        with self.assertNumQueries(5):
+            result = self.publish(self.staff, Bot.objects.all(), chunk_size=1)
+        self.assertEqual(result, PublishCount(published=2, skipped=1))
+        self.assertEqual(self.get_published(), {'alpha', 'beta'})
+
+    def test_global_permission_and_published_date_kept(self):
+        self.publish(self.staff, Bot.objects.filter(pk=self.bots[0].pk))
+        published_at = Bot.objects.get(pk=self.bots[0].pk).published_at
+        self.staff.user_permissions.add(Permission.objects.get(codename='publish_bot'))
+        self.staff = User.objects.get(pk=self.staff.pk)
+
+        result = self.publish(self.staff, Bot.objects.all())
+        self.assertEqual(result, PublishCount(published=3, skipped=0))
+        self.assertEqual(Bot.objects.get(pk=self.bots[0].pk).published_at, published_at)
+
+    def test_admin_action(self):
+        self.client.force_login(self.staff)
+        response = self.client.post(reverse('admin:learning_bot_changelist'), {
+            'action': 'make_published',
+            '_selected_action': [bot.pk for bot in self.bots],
+        }, follow=True)
+        messages = [str(message) for message in response.context['messages']]
+        self.assertEqual(messages, [
+            '2 bots successfully published.',
+            '1 bots skipped, you may not publish them.',
+        ])
+
+    def test_large_selection_runs_in_a_job(self):
+        self.client.force_login(self.staff)
+        with mock.patch('learning.admin.INLINE_LIMIT', 1):
+            response = self.client.post(reverse('admin:learning_bot_changelist'), {
+                'action': 'make_published',
+                '_selected_action': [bot.pk for bot in self.bots],
+            }, follow=True)
+        self.assertEqual(self.get_published(), set())
+
+        job = Job.objects.get(task='learning.publishing.publish_bots_task')
+        messages = [str(message) for message in response.context['messages']]
+        self.assertEqual(messages, [
+            f'2 bots are being published in the background (job {job.pk}).',
+            '1 bots skipped, you may not publish them.',
+        ])
+        self.assertEqual(
+            sorted(job.payload['bots']), sorted(str(bot.pk) for bot in self.bots[:2]))
+        # Revoked since the job was queued
+        remove_perm('learning.publish_bot', self.staff, self.bots[1])
+        run_job(claim_job())
+        job.refresh_from_db()
+        self.assertEqual(
+            (job.status, job.done, job.skipped, job.total), (Job.Status.DONE, 2, 1, 2))
+        self.assertEqual(self.get_published(), {'alpha'})
+
+        self.client.force_login(User.objects.create(
+            username='root', is_staff=True, is_superuser=True))
+        response = self.client.get(reverse('admin:learning_job_changelist'))
+        self.assertContains(response, '<td class="field-skipped">1</td>', html=True)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class LogoThumbnailTest(TestCase):
+    """
+    Logo variants are generated outside of the save, a placeholder is
+    served until they are stored for the current logo.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+
+    def get_logo(self, name='logo.jpg', size=(1000, 800)):
+        buffer = BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, 'JPEG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+    def create_bot(self):
+        with mock.patch('learning.thumbnails.schedule_variants') as schedule:
+            bot = Bot.objects.create(name='alpha', company=self.company, logo=self.get_logo())
+        schedule.assert_called_once_with(bot)
+        return bot
+
+    def test_generate_variants(self):
+        bot = self.create_bot()
+        self.assertEqual(thumbnails.get_logo_url(bot), '/static/learning/logo_placeholder.svg')
+
+        self.assertTrue(thumbnails.generate_variants(bot.pk, bot.logo.name))
+        bot.refresh_from_db()
+        self.assertFalse(thumbnails.needs_variants(bot))
+        self.assertEqual((bot.logo_thumbnail.width, bot.logo_thumbnail.height), (64, 51))
+        self.assertEqual((bot.logo_detail.width, bot.logo_detail.height), (320, 256))
+        self.assertEqual(thumbnails.get_logo_url(bot), bot.logo_thumbnail.url)
+
+    def test_logo_replaced_meanwhile(self):
+        bot = self.create_bot()
+        old_name = bot.logo.name
+        bot.logo = self.get_logo('other.jpg')
+        with mock.patch('learning.thumbnails.schedule_variants') as schedule:
+            bot.save()
+            bot.save(update_fields=['name'])
+        self.assertEqual(schedule.call_count, 1)
+
+        self.assertFalse(thumbnails.generate_variants(bot.pk, old_name))
+        bot.refresh_from_db()
+        self.assertTrue(thumbnails.needs_variants(bot))
+
+    def test_backfill(self):
+        bot = self.create_bot()
+        Bot.objects.create(name='beta', company=self.company)
+        with mock.patch(
+                'learning.management.commands.backfill_thumbnails.run_in_worker',
+                return_value=True) as run:
+            call_command('backfill_thumbnails', workers=2, stdout=StringIO())
+        run.assert_called_once_with(bot.pk, bot.logo.name)
+
+    def test_backfill_bounds_pending_logos(self):
+        bots = [self.create_bot() for _ in range(3)]
+        stdout = StringIO()
+        with mock.patch(
+                'learning.management.commands.backfill_thumbnails.run_in_worker',
+                return_value=True) as run:
+            call_command(
+                'backfill_thumbnails', workers=1, max_pending=1, force=True, stdout=stdout)
+        self.assertEqual(run.call_count, len(bots))
+        self.assertIn('3 of 3 logos resized', stdout.getvalue())
+
+
+class TimeOrderedUuidTest(TestCase):
+    """
+    New bots and companies get version 7 keys, increasing in creation order.
+    """
+
+    def test_uuid7(self):
+        keys = [uuid7() for _ in range(10000)]
+        self.assertEqual({key.version for key in keys}, {7})
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertAlmostEqual(keys[0].int >> 80, time.time() * 1000, delta=1000)
+
+    def test_defaults(self):
+        company = Company.objects.create(name='One')
+        bots = [Bot.objects.create(name=name, company=company) for name in ('a', 'b', 'c')]
+        self.assertEqual(company.uuid.version, 7)
+        self.assertEqual(list(Bot.objects.order_by('pk')), bots)
+
+    def test_benchmark_inserts(self):
+        stdout = StringIO()
+        call_command('benchmark_inserts', rows=30, batch_size=10, stdout=stdout)
+        result = json.loads(stdout.getvalue())
+        self.assertEqual(set(result), {'rows', 'batch_size', 'existing', 'uuid4', 'uuid7'})
+        self.assertFalse(Bot.objects.exists())
+
+
+class GroupTeardownTest(TransactionTestCase):
+    """
+    The permission groups of deleted instances are deleted once the
+    transaction commits, for a whole cascade at once.
+    """
+    # Keep the permission templates created by the migrations
+    serialized_rollback = True
+
+    def setUp(self):
+        # Left queued by the deletions of the TestCases, never committed
+        get_deletion_queue('default').clear()
+
+    def get_group_ids(self, *instances):
+        return [
+            group_id
+            for instance in instances
+            for group_id in PermissionGroup.objects.for_instance(
+                instance).values_list('group_id', flat=True)
+        ]
+
+    def test_delete_removes_groups(self):
+        user = User.objects.create(username='user')
+        group_ids = self.get_group_ids(user)
+        self.assertEqual(len(group_ids), 3)
+
+        user.delete()
+
+        self.assertFalse(Group.objects.filter(pk__in=group_ids).exists())
+
+    def test_cascade_is_deleted_in_one_batch(self):
+        company = Company.objects.create(name='One')
+        users = [
+            User.objects.create(username=f'user{number}', company=company)
+            for number in range(3)
+        ]
+        group_ids = self.get_group_ids(company, *users)
+
+        with mock.patch('learning.provisioning.delete_groups', wraps=delete_groups) as delete:
+            company.delete()
+
+        self.assertEqual(
+            {(call.args[0], len(call.args[1])) for call in delete.call_args_list},
+            {(Company, 1), (User, 3)})
+        self.assertFalse(Group.objects.filter(pk__in=group_ids).exists())
+        self.assertFalse(PermissionGroup.objects.filter(group_id__in=group_ids).exists())
+        self.assertFalse(User.groups.through.objects.filter(group_id__in=group_ids).exists())
+
+    def test_cascade_is_unindexed_in_one_statement(self):
+        company = Company.objects.create(name='One')
+        company_pk = company.pk
+        user_pks = [
+            User.objects.create(username=f'user{number}', company=company).pk
+            for number in range(3)
+        ]
+
+        with CaptureQueriesContext(connection) as context:
+            company.delete()
+
+        unindexed = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('DELETE FROM learning_user_search')
+        ]
+        self.assertEqual(len(unindexed), 1)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT COUNT(*) FROM learning_user_search WHERE rowid IN (%s, %s, %s)', user_pks)
+            self.assertEqual(cursor.fetchone(), (0,))
+            cursor.execute(
+                'SELECT COUNT(*) FROM learning_company_search WHERE rowid = %s', [company_pk])
+            self.assertEqual(cursor.fetchone(), (0,))
+
+    def test_rolled_back_delete_keeps_groups(self):
+        kept, deleted = User.objects.create(username='kept'), User.objects.create(username='deleted')
+        kept_ids, deleted_ids = self.get_group_ids(kept), self.get_group_ids(deleted)
+        with transaction.atomic():
+            kept.delete()
+            transaction.set_rollback(True)
+        deleted.delete()
+
+        self.assertEqual(Group.objects.filter(pk__in=kept_ids).count(), 3)
+        self.assertFalse(Group.objects.filter(pk__in=deleted_ids).exists())
+
+    def test_rolled_back_savepoint_keeps_groups(self):
+        kept, deleted = User.objects.create(username='kept'), User.objects.create(username='deleted')
+        kept_ids, deleted_ids = self.get_group_ids(kept), self.get_group_ids(deleted)
+        with transaction.atomic():
+            deleted.delete()
+            try:
+                with transaction.atomic():
+                    kept.delete()
+                    raise DatabaseError
+            except DatabaseError:
+                pass
+
+        self.assertEqual(Group.objects.filter(pk__in=kept_ids).count(), 3)
+        self.assertFalse(Group.objects.filter(pk__in=deleted_ids).exists())
+
+    def test_queue_is_flushed_once(self):
+        users = [User.objects.create(username=f'user{number}') for number in range(3)]
+        with mock.patch('learning.provisioning.delete_groups', wraps=delete_groups) as delete:
+            with transaction.atomic():
+                for user in users[:2]:
+                    user.delete()
+                with transaction.atomic():
+                    users[2].delete()
+
+        self.assertEqual(
+            [(call.args[0], len(call.args[1])) for call in delete.call_args_list], [(User, 3)])
+        self.assertEqual(get_deletion_queue('default'), {})
+
+    def test_queries_do_not_grow_with_instances(self):
+        users = [User.objects.create(username=f'user{number}') for number in range(6)]
+
+        def count_queries(users):
+            with CaptureQueriesContext(connection) as context:
+                delete_groups(User, [user.pk for user in users])
+            return len(context)
+
+        self.assertEqual(count_queries(users[:2]), count_queries(users[2:]))
+
+
+class ObjectPermissionFilterTest(TestCase):
+    """
+    The EXISTS filter on the direct FK tables selects the same objects as
+    guardian, through the permissions of the user and of its groups.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+        cls.bots = [Bot.objects.create(name=f'bot{number}', company=cls.company) for number in range(4)]
+        cls.user = User.objects.create(username='user')
+        cls.other = User.objects.create(username='other')
+        group = Group.objects.create(name='Publishers')
+        cls.user.groups.add(group)
+        assign_perm('learning.publish_bot', cls.user, cls.bots[0])
+        assign_perm('learning.publish_bot', group, cls.bots[1])
+        assign_perm('learning.publish_bot', cls.other, cls.bots[2])
+        assign_perm('learning.change_bot', cls.user, cls.bots[3])
+        assign_perm('learning.change_user', group, cls.other)
+
+    def test_same_objects_as_guardian(self):
+        for perm, queryset in (
+                ('learning.publish_bot', Bot.objects.all()),
+                ('learning.change_bot', Bot.objects.all()),
+                ('learning.change_user', User.objects.all()),
+                ('learning.change_company', Company.objects.all())):
+            with self.subTest(perm=perm):
+                objects = get_objects_for_user(self.user, perm, queryset)
+                self.assertIn('EXISTS', str(objects.query))
+                self.assertEqual(
+                    set(objects),
+                    set(guardian_get_objects_for_user(
+                        self.user, perm, queryset, accept_global_perms=False)))
+        self.assertEqual(
+            set(get_objects_for_user(self.user, 'learning.publish_bot', Bot.objects.all())),
+            set(self.bots[:2]))
+
+
+class MoveGenericObjectPermissionsTest(TransactionTestCase):
+    """
+    Migration 0003 moves the generic guardian rows of users and bots to
+    their direct FK tables.
+    """
+    # Keep the permission templates created by the migrations
+    serialized_rollback = True
+
+    before = [('learning', '0002_direct_fk_object_permissions')]
+    after = [('learning', '0003_move_generic_object_permissions')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        # The state of the other apps used by the migration
+        return executor.loader.project_state(
+            [*targets, ('guardian', '0002_generic_permissions_index')]).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+        super().tearDown()
+
+    def test_generic_rows_are_moved(self):
+        apps = self.migrate(self.before)
+        UserObjectPermission = apps.get_model('guardian', 'UserObjectPermission')
+        GroupObjectPermission = apps.get_model('guardian', 'GroupObjectPermission')
+        user = apps.get_model('learning', 'User').objects.create(username='ada')
+        company = apps.get_model('learning', 'Company').objects.create(name='One')
+        bot = apps.get_model('learning', 'Bot').objects.create(name='alpha', company=company)
+        group = apps.get_model('auth', 'Group').objects.create(name='Publishers')
+
+        def get_permission(codename):
+            return apps.get_model('auth', 'Permission').objects.get(
+                content_type__app_label='learning', codename=codename)
+
+        def get_ctype(model):
+            return apps.get_model('contenttypes', 'ContentType').objects.get(
+                app_label='learning', model=model)
+
+        UserObjectPermission.objects.create(
+            user=user, permission=get_permission('change_user'),
+            content_type=get_ctype('user'), object_pk=str(user.pk))
+        # Of a deleted user, dropped
+        UserObjectPermission.objects.create(
+            user=user, permission=get_permission('change_user'),
+            content_type=get_ctype('user'), object_pk='999999')
+        GroupObjectPermission.objects.create(
+            group=group, permission=get_permission('publish_bot'),
+            content_type=get_ctype('bot'), object_pk=str(bot.pk))
+        # Companies keep the generic tables
+        GroupObjectPermission.objects.create(
+            group=group, permission=get_permission('change_company'),
+            content_type=get_ctype('company'), object_pk=str(company.pk))
+
+        apps = self.migrate(self.after)
+        self.assertEqual(
+            list(apps.get_model('learning', 'UserUserObjectPermission').objects.values_list(
+                'user', 'permission__codename', 'content_object')),
+            [(user.pk, 'change_user', user.pk)])
+        self.assertEqual(
+            list(apps.get_model('learning', 'BotGroupObjectPermission').objects.values_list(
+                'group', 'permission__codename', 'content_object')),
+            [(group.pk, 'publish_bot', bot.pk)])
+        self.assertFalse(apps.get_model('guardian', 'UserObjectPermission').objects.exists())
+        self.assertEqual(
+            list(apps.get_model('guardian', 'GroupObjectPermission').objects.values_list(
+                'permission__codename', 'object_pk')),
+            [('change_company', str(company.pk))])
+
+
+class BitmaskAccessStoreTest(TestCase):
+    """
+    The bitmask store keeps one row per group and object, and answers the
+    permission checks and visibility filters like the guardian rows.
+    """
+
+    def setUp(self):
+        self.company = Company.objects.create(name='One')
+        self.other = Company.objects.create(name='Two')
+        self.bot = Bot.objects.create(name='alpha', company=self.company)
+        self.user = User.objects.create(username='user', is_staff=True)
+        self.user.groups.add(PermissionGroup.objects.get_group_id(
+            self.company, PermissionGroup.AccessLevel.WRITE))
+        assign_perm('learning.publish_bot', self.user, self.bot)
+
+    def get_answers(self):
+        user = User.objects.get(pk=self.user.pk)
+        return {
+            'company': sorted(user.get_all_permissions(self.company)),
+            'other': sorted(user.get_all_permissions(self.other)),
+            'bot': sorted(user.get_all_permissions(self.bot)),
+            'visible': list(get_objects_for_user(
+                user, 'learning.change_company', Company.objects.order_by('pk'))),
+        }
+
+    def test_provisioning(self):
+        with override_settings(OBJECT_PERMISSION_STORE='bitmask'):
+            company = Company.objects.create(name='Three')
+        self.assertEqual(CompanyAccess.objects.filter(content_object=company).count(), 3)
+        self.assertFalse(CompanyGroupObjectPermission.objects.filter(content_object=company).exists())
+        # Write holds change and delete in one row
+        self.assertEqual(
+            access.get_perms(Company, CompanyAccess.objects.get(
+                content_object=company,
+                group=PermissionGroup.objects.get_group_id(
+                    company, PermissionGroup.AccessLevel.WRITE)).mask),
+            {'change_company', 'delete_company'})
+
+    def test_converted_store_gives_the_same_answers(self):
+        expected = self.get_answers()
+        self.assertEqual(expected['company'], ['change_company', 'delete_company'])
+        self.assertEqual(expected['bot'], ['publish_bot'])
+
+        call_command('convert_object_permissions', stdout=StringIO())
+        self.assertEqual(
+            BotAccess.objects.count() + CompanyAccess.objects.count() + UserAccess.objects.count(),
+            PermissionGroup.objects.count() + 1)
+        with override_settings(OBJECT_PERMISSION_STORE='bitmask'):
+            self.assertEqual(self.get_answers(), expected)
+
+    def test_conversion_is_batched_by_object(self):
+        def get_rows():
+            return sorted(
+                (access_model.__name__, row)
+                for access_model in (BotAccess, CompanyAccess, UserAccess)
+                for row in access_model.objects.values_list(
+                    'content_object', 'user', 'group', 'mask'))
+
+        call_command('convert_object_permissions', stdout=StringIO())
+        expected = get_rows()
+        call_command('convert_object_permissions', batch_size=1, stdout=StringIO())
+        self.assertEqual(get_rows(), expected)
+
+    def test_guardian_writes_are_mirrored(self):
+        call_command('convert_object_permissions', stdout=StringIO())
+        with override_settings(OBJECT_PERMISSION_STORE='bitmask'):
+            assign_perm('learning.delete_bot', self.user, self.bot)
+            self.assertEqual(self.get_answers()['bot'], ['delete_bot', 'publish_bot'])
+
+            remove_perm('learning.publish_bot', self.user, self.bot)
+            self.assertEqual(self.get_answers()['bot'], ['delete_bot'])
+            remove_perm('learning.delete_bot', self.user, self.bot)
+            self.assertEqual(self.get_answers()['bot'], [])
+            self.assertFalse(BotAccess.objects.filter(user=self.user).exists())
+
+    def test_admin_checker_prefetches(self):
+        call_command('convert_object_permissions', stdout=StringIO())
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(pk=self.user.pk)
+        with override_settings(OBJECT_PERMISSION_STORE='bitmask'):
+            checker = get_permission_checker(request)
+            with self.assertNumQueries(1):
+                checker.prefetch_perms([self.company, self.other])
+            with self.assertNumQueries(0):
+                self.assertTrue(checker.has_perm('delete_company', self.company))
+                self.assertFalse(checker.has_perm('view_company', self.other))
+
+
+class TenantAccessTest(TestCase):
+    """
+    In the tenant scope an Admin gets access to its company tree through
+    the groups of the companies, with a number of rows independent of
+    the number of users.
+    """
+
+    def create_tenant(self, name, size):
+        company = Company.objects.create(name=name)
+        users = [
+            User.objects.create(username=f'{name} user {i}', company=company)
+            for i in range(size)
+        ]
+        bot = Bot.objects.create(name=f'{name} bot', company=company)
+        return company, users, bot
+
+    def count_rows(self):
+        return (
+            User.groups.through.objects.count() +
+            UserGroupObjectPermission.objects.count() +
+            BotGroupObjectPermission.objects.count())
+
+    def onboard_admin(self, company):
+        admin = User.objects.create(
+            username=f'{company.name} admin', company=company, role=User.Role.ADMIN)
+        enqueue('learning.onboarding.admin_onboarding', {'user': admin.pk})
+        self.assertTrue(run_job(claim_job()))
+        return User.objects.get(pk=admin.pk)
+
+    def assertHasAccess(self, admin, users, bot):
+        for user in users:
+            self.assertTrue(admin.has_perm('learning.view_user', user))
+            self.assertTrue(admin.has_perm('learning.change_user', user))
+            self.assertFalse(admin.has_perm('learning.delete_user', user))
+            self.assertTrue(User.objects.get(pk=user.pk).has_perm('learning.view_user', admin))
+        self.assertTrue(admin.has_perm('learning.view_bot', bot))
+        self.assertTrue(admin.has_perm('learning.change_bot', bot))
+
+    @override_settings(ACCESS_SCOPE='tenant')
+    def test_company_owns_tenant_groups(self):
+        company = Company.objects.create(name='One')
+        self.assertEqual(
+            set(PermissionGroup.objects.for_instance(company).values_list('access_level', flat=True)),
+            {'Read', 'Write', 'Own', 'TenantRead', 'TenantOwn', 'Members'})
+
+    @override_settings(ACCESS_SCOPE='tenant')
+    def test_admin_onboarding_inserts_constant_rows(self):
+        inserted = []
+        for name, size in (('Small', 2), ('Large', 12)):
+            company, users, bot = self.create_tenant(name, size)
+            before = self.count_rows()
+            admin = self.onboard_admin(company)
+            inserted.append(self.count_rows() - before)
+
+            self.assertHasAccess(admin, users, bot)
+        self.assertEqual(inserted[0], inserted[1])
+
+    def test_collapse_per_user_grants(self):
+        company, users, bot = self.create_tenant('One', 4)
+        admin = User.objects.create(username='admin', company=company, role=User.Role.ADMIN)
+        admin.bulk_grant_permissions('Admin Permissions Template', User.objects.filter(company=company))
+        before = User.groups.through.objects.count()
+
+        with override_settings(ACCESS_SCOPE='tenant'):
+            call_command('collapse_tenant_grants', stdout=StringIO())
+            admin = User.objects.get(pk=admin.pk)
+            self.assertHasAccess(admin, users, bot)
+        # The admin joined the Read and Own groups of each user and each
+        # user the Read group of the admin, replaced by the 2 tenant groups
+        # joined by the admin and the Members group joined by everyone
+        self.assertEqual(User.groups.through.objects.count(), before - 3 * 4 + 2 + 5)
+
+    def test_collapse_requires_the_tenant_scope(self):
+        with self.assertRaises(CommandError):
+            call_command('collapse_tenant_grants', stdout=StringIO())
+
+
+class VisibilityPolicyTest(TestCase):
+    """
+    The visibility rules compile to one condition evaluated with the
+    queryset, without object permission rows for the tree relations.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agency = Company.objects.create(name='Agency', type=Company.Type.AGENCY)
+        cls.client_company = Company.objects.create(name='Client', tn_parent=cls.agency)
+        cls.other = Company.objects.create(name='Other')
+        cls.botxo = Company.objects.create(name='Botxo', type=Company.Type.BOTXO)
+        cls.admin = User.objects.create(
+            username='admin', company=cls.agency, role=User.Role.ADMIN)
+        cls.editor = User.objects.create(username='editor', company=cls.client_company)
+        cls.client_admin = User.objects.create(
+            username='client admin', company=cls.client_company, role=User.Role.ADMIN)
+        cls.stranger = User.objects.create(username='stranger', company=cls.other)
+        cls.staff = User.objects.create(username='staff', company=cls.botxo)
+        cls.bot = Bot.objects.create(name='client bot', company=cls.client_company)
+        cls.other_bot = Bot.objects.create(name='other bot', company=cls.other)
+
+    def get_visible(self, user, model):
+        user = User.objects.select_related('company').get(pk=user.pk)
+        queryset = filter_queryset(user, model.objects.all())
+        with self.assertNumQueries(1):
+            return set(queryset)
+
+    def test_agency_admin_sees_descendants(self):
+        self.assertEqual(
+            self.get_visible(self.admin, User),
+            {self.admin, self.editor, self.client_admin})
+        self.assertEqual(self.get_visible(self.admin, Bot), {self.bot})
+        self.assertEqual(
+            self.get_visible(self.admin, Company), {self.agency, self.client_company})
+
+    def test_user_sees_itself_its_admins_and_grants(self):
+        self.assertEqual(self.get_visible(self.editor, User), {self.editor, self.client_admin})
+        self.assertEqual(self.get_visible(self.editor, Bot), {self.bot})
+        below = Company.objects.create(name='Below', tn_parent=self.client_company)
+        shared = Bot.objects.create(name='shared bot', company=below)
+        assign_perm('learning.view_bot', self.editor, shared)
+        self.assertEqual(self.get_visible(self.editor, Bot), {self.bot, shared})
+
+    def test_grants_stay_within_the_tenant(self):
+        assign_perm('learning.view_bot', self.editor, self.other_bot)
+        assign_perm('learning.view_user', self.editor, self.stranger)
+        self.assertEqual(self.get_visible(self.editor, Bot), {self.bot})
+        self.assertNotIn(self.stranger, self.get_visible(self.editor, User))
+
+    def test_botxo_staff_sees_everything(self):
+        self.assertEqual(self.get_visible(self.staff, User), set(User.objects.all()))
+        self.assertEqual(self.get_visible(self.staff, Company), set(Company.objects.all()))
+
+    def test_admin_opens_and_expands_the_companies_it_lists(self):
+        grandchild = Company.objects.create(name='Grandchild', tn_parent=self.client_company)
+        User.objects.filter(pk=self.admin.pk).update(is_staff=True)
+        self.client.force_login(self.admin)
+        for company in (self.client_company, grandchild):
+            response = self.client.get(reverse('admin:learning_company_change', args=[company.pk]))
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get(
+            reverse('admin:learning_company_children', args=[self.client_company.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([child['str'] for child in response.json()['results']], ['Grandchild'])
+        response = self.client.get(reverse('admin:learning_user_change', args=[self.editor.pk]))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('admin:learning_company_change', args=[self.other.pk]))
+        self.assertNotEqual(response.status_code, 200)
+
+    def test_rules_are_compiled_per_role_and_company_type(self):
+        compile_rules.cache_clear()
+        filter_queryset(self.editor, User.objects.all())
+        filter_queryset(self.stranger, User.objects.all())
+        info = compile_rules.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 1))
+
+
+class BulkPermissionCheckTest(TestCase):
+    """
+    The permission of a user on many objects is answered in one query,
+    from its global, user object and group object permissions.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='One')
+        cls.other = Company.objects.create(name='Two')
+        cls.bots = [
+            Bot.objects.create(name=name, company=cls.company)
+            for name in ('alpha', 'beta', 'gamma')
+        ]
+        cls.user = User.objects.create(username='user', company=cls.company)
+        assign_perm('learning.publish_bot', cls.user, cls.bots[0])
+        group = Group.objects.create(name='Publishers')
+        assign_perm('learning.publish_bot', group, cls.bots[1])
+        cls.user.groups.add(group)
+
+    def get_user(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.has_perm('learning.publish_bot')
+        return user
+
+    def test_object_permissions_in_one_query(self):
+        user = self.get_user()
+        with self.assertNumQueries(1):
+            permitted = user.get_object_permissions('learning.publish_bot', self.bots)
+        self.assertEqual(
+            permitted, {self.bots[0].pk: True, self.bots[1].pk: True, self.bots[2].pk: False})
+        with self.assertNumQueries(1):
+            permitted = user.get_object_permissions(
+                'publish_bot', Bot.objects.filter(name__in=['beta', 'gamma']))
+        self.assertEqual(permitted, {self.bots[1].pk: True, self.bots[2].pk: False})
+
+    def test_global_permission_grants_every_object(self):
+        self.user.user_permissions.add(Permission.objects.get(codename='publish_bot'))
+        user = self.get_user()
+        with self.assertNumQueries(0):
+            permitted = user.get_object_permissions('learning.publish_bot', self.bots)
+        self.assertTrue(all(permitted.values()))
+        permitted = user.get_object_permissions(
+            'learning.publish_bot', self.bots, accept_global_perms=False)
+        self.assertFalse(permitted[self.bots[2].pk])
+
+    def test_companies_and_users(self):
+        user = self.get_user()
+        self.assertEqual(
+            user.get_object_permissions('learning.change_company', Company.objects.all()),
+            {self.company.pk: False, self.other.pk: False})
+        # The Editor template grants view_company globally, and the Read
+        # group of the company
+        self.assertEqual(
+            user.get_object_permissions('learning.view_company', [self.company, self.other]),
+            {self.company.pk: True, self.other.pk: True})
+        self.assertEqual(
+            user.get_object_permissions(
+                'learning.view_company', [self.company, self.other], accept_global_perms=False),
+            {self.company.pk: True, self.other.pk: False})
+        self.assertEqual(
+            user.get_object_permissions('learning.change_user', [user], accept_global_perms=False),
+            {user.pk: True})
+
+    def test_bitmask_store(self):
+        expected = self.get_user().get_object_permissions('learning.publish_bot', self.bots)
+        call_command('convert_object_permissions', stdout=StringIO())
+        with override_settings(OBJECT_PERMISSION_STORE='bitmask'):
+            self.assertEqual(
+                self.get_user().get_object_permissions('learning.publish_bot', self.bots),
+                expected)
@@ -0,0 +1,130 @@
+"""
+Resized variants of the bot logos, generated off the request path.
+
+Saving a bot with a new logo submits the generation of its ``VARIANTS``
+to a pool of worker threads once the transaction commits, Pillow releases
+the GIL while it decodes and resizes. The storage name of a variant is
+derived from the name of the logo, so a variant belongs to the current
+logo only when the names match: until then ``get_logo_url`` returns a
+placeholder. The ``backfill_thumbnails`` command generates the variants
+of the existing bots.
+
+The pool size is the ``LOGO_THUMBNAIL_WORKERS`` setting.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.templatetags.static import static
+
+from PIL import Image
+
+from .models import Bot
+
+
+logger = logging.getLogger(__name__)
+
+# The field storing each variant, and the box the logo is resized to fit
+VARIANTS = {
+    'logo_detail': (320, 320),
+    'logo_thumbnail': (64, 64),
+}
+
+PLACEHOLDER = 'learning/logo_placeholder.svg'
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_variant_name(logo_name, field):
+    root, _ = os.path.splitext(logo_name)
+    width, height = VARIANTS[field]
+    return f'thumbnails/{root}_{width}x{height}.png'
+
+
+def needs_variants(bot):
+    """
+    Does ``bot`` have a logo whose variants are missing or outdated?
+    """
+    return bool(bot.logo) and any(
+        getattr(bot, field).name != get_variant_name(bot.logo.name, field)
+        for field in VARIANTS)
+
+
+def get_logo_url(bot, field='logo_thumbnail'):
+    """
+    URL of the variant ``field`` of the logo of ``bot``, the placeholder
+    while it is generated, or an empty string without logo.
+    """
+    if not bot.logo:
+        return ''
+    variant = getattr(bot, field)
+    if variant.name != get_variant_name(bot.logo.name, field):
+        return static(PLACEHOLDER)
+    return variant.url
+
+
+def resize(image, size):
+    image = image.copy()
+    image.thumbnail(size, Image.LANCZOS)
+    if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    buffer = BytesIO()
+    image.save(buffer, 'PNG', optimize=True)
+    return image, ContentFile(buffer.getvalue())
+
+
+def generate_variants(pk, logo_name):
+    """
+    Write the variants of the logo ``logo_name`` of the bot ``pk`` and
+    store their names, unless the bot changed logo meanwhile. Return
+    whether the bot was updated.
+    """
+    storage = Bot._meta.get_field('logo').storage
+    names = {}
+    with storage.open(logo_name) as f, Image.open(f) as image:
+        # JPEG logos are decoded at a reduced scale, close to the largest size
+        image.draft(image.mode, max(VARIANTS.values()))
+        image.load()
+        # Largest first, each variant is resized from the previous one
+        for field, size in sorted(VARIANTS.items(), key=lambda item: item[1], reverse=True):
+            image, content = resize(image, size)
+            name = get_variant_name(logo_name, field)
+            if storage.exists(name):
+                storage.delete(name)
+            names[field] = storage.save(name, content)
+    return bool(Bot.objects.filter(pk=pk, logo=logo_name).update(**names))
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'LOGO_THUMBNAIL_WORKERS', 2),
+                thread_name_prefix='logo-thumbnails')
+    return executor
+
+
+def run_in_worker(pk, logo_name):
+    try:
+        return generate_variants(pk, logo_name)
+    except Exception:
+        logger.exception('Variants of the logo %s of bot %s failed', logo_name, pk)
+        return False
+    finally:
+        connection.close()
+
+
+def schedule_variants(bot):
+    """
+    Generate the variants of the logo of ``bot`` in the pool once the
+    current transaction commits.
+    """
+    pk, logo_name = bot.pk, bot.logo.name
+    transaction.on_commit(lambda: get_executor().submit(run_in_worker, pk, logo_name))
@@ -0,0 +1,36 @@
+"""
+Time-ordered UUIDs, in the version 7 layout of RFC 9562.
+
+The first 48 bits are the Unix time in milliseconds, so keys generated
+one after the other sort together and inserts append to the right edge of
+the primary key index, where random version 4 keys land on any page of
+it. Within a millisecond the 12 bits of ``rand_a`` are a counter started
+at a random value, keys of one process are strictly increasing.
+"""
+import os
+import secrets
+import threading
+import time
+import uuid
+
+
+lock = threading.Lock()
+last_ms = 0
+counter = 0
+
+
+def uuid7():
+    global last_ms, counter
+    with lock:
+        ms = time.time_ns() // 1_000_000
+        if ms > last_ms:
+            last_ms, counter = ms, secrets.randbits(11)
+        else:
+            # Same millisecond, or the clock went back
+            counter += 1
+            if counter > 0xfff:
+                last_ms, counter = last_ms + 1, secrets.randbits(11)
+        ms, sequence = last_ms, counter
+
+    rand_b = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    return uuid.UUID(int=(ms << 80) | (0x7 << 76) | (sequence << 64) | (0b10 << 62) | rand_b)
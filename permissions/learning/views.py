@@ -1,3 +1,38 @@
-from django.shortcuts import render
+from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
+from django.template.response import TemplateResponse
 
-# Create your views here.
+from . import metrics, profiling
+
+
+@admin.site.admin_view
+def metrics_view(request):
+    """
+    The permission metrics of this process in the Prometheus text format,
+    for superusers only.
+    """
+    if not request.user.is_superuser:
+        raise PermissionDenied
+    return HttpResponse(
+        metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@admin.site.admin_view
+def profiles_view(request, profile_id=None):
+    """
+    The slowest requests profiled by this process, or the queries and
+    stack samples of one of them, for superusers only.
+    """
+    if not request.user.is_superuser:
+        raise PermissionDenied
+    recorder = profiling.recorder
+    context = {**admin.site.each_context(request), 'title': 'Slowest requests'}
+    if profile_id is None:
+        context['profiles'] = recorder.get_slowest() if recorder else []
+    else:
+        profile = recorder.get(profile_id) if recorder else None
+        if profile is None:
+            raise Http404
+        context.update(title=f"{profile['method']} {profile['path']}", profile=profile)
+    return TemplateResponse(request, 'admin/learning/profiles.html', context)
@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'learning.profiling.RequestProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,10 +54,15 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
-    'silk.middleware.SilkyMiddleware'
 ]
 
+# Development profilers, too heavy to run on every production request
+if DEBUG:
+    MIDDLEWARE += [
+        'debug_toolbar.middleware.DebugToolbarMiddleware',
+        'silk.middleware.SilkyMiddleware',
+    ]
+
 DEBUG_TOOLBAR_CONFIG = {
     "DISABLE_PANELS": ["debug_toolbar.panels.redirects.RedirectsPanel"],
     "SHOW_TEMPLATE_CONTEXT": True,
@@ -87,10 +93,18 @@ WSGI_APPLICATION = 'permissions.wsgi.application'
 AUTH_USER_MODEL = 'learning.User'
 
 AUTHENTICATION_BACKENDS = (
-    'django.contrib.auth.backends.ModelBackend',  # this is default
-    'guardian.backends.ObjectPermissionBackend',
+    # ModelBackend and guardian's ObjectPermissionBackend behind a cache
+    'learning.backends.CachedPermissionBackend',
 )
+# The guardian backend is wrapped by CachedPermissionBackend
+SILENCED_SYSTEM_CHECKS = ['guardian.W001']
 ANONYMOUS_USER_NAME = None
+# Object permissions of users, companies and bots: 'guardian' rows, or the
+# 'bitmask' store of learning.access, filled by convert_object_permissions
+OBJECT_PERMISSION_STORE = 'guardian'
+# Access to the users and bots granted per 'user', or per 'tenant' through
+# the groups of their company, see learning.provisioning
+ACCESS_SCOPE = 'user'
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
@@ -148,6 +162,12 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+MEDIA_URL = '/media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Threads generating the bot logo variants, see learning.thumbnails
+LOGO_THUMBNAIL_WORKERS = 2
+
 
 SILKY_MAX_REQUEST_BODY_SIZE = 0  # Silk takes anything <0 as no limit
 SILKY_MAX_RESPONSE_BODY_SIZE = 0  # If response body>1024kb, ignore
@@ -155,9 +175,37 @@ SILKY_META = True
 SILKY_INTERCEPT_PERCENT = 0
 
 
-# TreeNode
-# CACHES = {
-#     'treenode': {
-#         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-#     },
-# }
+# Caches
+# LocMem is per process: to share the permission cache between runserver
+# and the run_jobs workers when testing locally, use the file cache:
+#     'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#     'LOCATION': BASE_DIR / '.cache' / 'permissions',
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'permissions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'permissions',
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    # TreeNode
+    # 'treenode': {
+    #     'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    # },
+}
+
+# Cache alias of learning.backends.CachedPermissionBackend
+PERMISSION_CACHE = 'permissions'
+
+# In-process metrics of learning.metrics, served at /admin/metrics/
+PERMISSION_METRICS_ENABLED = True
+
+# Sampled profiler of learning.profiling, slowest requests at /admin/profiles/
+REQUEST_PROFILER = {
+    'SAMPLE_RATE': 0.01,
+    'SLOW_REQUEST_MS': 1000,
+    'PATH_PREFIXES': ['/admin/'],
+    'OUTPUT': BASE_DIR / 'profiles.jsonl',
+}
@@ -14,12 +14,22 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 import debug_toolbar
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 
+from learning.views import metrics_view, profiles_view
+
 urlpatterns = [
+    path('admin/metrics/', metrics_view, name='metrics'),
+    path('admin/profiles/', profiles_view, name='profiles'),
+    path('admin/profiles/<str:profile_id>/', profiles_view, name='profile'),
     path('admin/', admin.site.urls),
     path('__debug__/', include(debug_toolbar.urls)),
 ]
 
 urlpatterns += [path('silk/', include('silk.urls', namespace='silk'))]
+
+# Uploaded files, served by the development server only
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)